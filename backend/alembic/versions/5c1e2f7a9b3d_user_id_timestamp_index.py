@@ -0,0 +1,27 @@
+"""user_id timestamp index for keyset pagination
+
+Revision ID: 5c1e2f7a9b3d
+Revises: 4697debfd8ae
+Create Date: 2026-10-18 10:12:41.516203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c1e2f7a9b3d'
+down_revision: Union[str, None] = '4697debfd8ae'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # id is the tie-breaker of the (timestamp, id) keyset, so it is part of the index
+    op.create_index('ix_questionnaire_results_user_id_timestamp', 'questionnaire_results', ['user_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_questionnaire_results_user_id_timestamp', table_name='questionnaire_results')
@@ -0,0 +1,35 @@
+"""questionnaire result sketches
+
+Revision ID: 7d3e9b15a2c8
+Revises: e2a7c4d90f16
+Create Date: 2026-10-18 16:40:52.118305
+
+The sketches start empty; python -m api.database.sketches --rebuild builds them from the
+existing results.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7d3e9b15a2c8'
+down_revision: Union[str, None] = 'e2a7c4d90f16'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('questionnaire_result_sketches',
+    sa.Column('metric', sa.String(), nullable=False),
+    sa.Column('gender', sa.String(), nullable=False),
+    sa.Column('digest', sa.JSON(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('metric', 'gender')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('questionnaire_result_sketches')
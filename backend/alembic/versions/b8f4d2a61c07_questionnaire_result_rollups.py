@@ -0,0 +1,55 @@
+"""questionnaire result rollups
+
+Revision ID: b8f4d2a61c07
+Revises: 5c1e2f7a9b3d
+Create Date: 2026-10-18 11:03:17.228410
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8f4d2a61c07'
+down_revision: Union[str, None] = '5c1e2f7a9b3d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('questionnaire_result_rollups',
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('gender', sa.String(), nullable=False),
+    sa.Column('classification', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('score_sum', sa.Numeric(), nullable=False),
+    sa.Column('score_sumsq', sa.Numeric(), nullable=False),
+    sa.Column('vo2max_sum', sa.Numeric(), nullable=False),
+    sa.Column('vo2max_sumsq', sa.Numeric(), nullable=False),
+    sa.Column('bmi_count', sa.Integer(), nullable=False),
+    sa.Column('bmi_sum', sa.Numeric(), nullable=False),
+    sa.Column('bmi_sumsq', sa.Numeric(), nullable=False),
+    sa.Column('fmi_count', sa.Integer(), nullable=False),
+    sa.Column('fmi_sum', sa.Numeric(), nullable=False),
+    sa.Column('fmi_sumsq', sa.Numeric(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('month', 'gender', 'classification')
+    )
+    # backfill from the existing results; from here on inserts keep the rollups up to date
+    op.execute("""
+    INSERT INTO questionnaire_result_rollups (month, gender, classification, count, score_sum, score_sumsq, vo2max_sum, vo2max_sumsq,
+                                              bmi_count, bmi_sum, bmi_sumsq, fmi_count, fmi_sum, fmi_sumsq, updated_at)
+    SELECT date_trunc('month', "timestamp")::date, gender, classification,
+           count(*), sum(score), sum(score::numeric * score), sum(vo2max), sum(vo2max * vo2max),
+           count(bmi), coalesce(sum(bmi), 0), coalesce(sum(bmi * bmi), 0),
+           count(fmi), coalesce(sum(fmi), 0), coalesce(sum(fmi * fmi), 0), now()
+    FROM questionnaire_results
+    WHERE "timestamp" IS NOT NULL
+    GROUP BY 1, 2, 3
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('questionnaire_result_rollups')
@@ -0,0 +1,27 @@
+"""questionnaire result config version
+
+Revision ID: c4f81a6e37d2
+Revises: 7d3e9b15a2c8
+Create Date: 2026-10-18 18:02:44.905173
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4f81a6e37d2'
+down_revision: Union[str, None] = '7d3e9b15a2c8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # unknown for existing results until they are re-scored with api.database.rescore
+    op.add_column('questionnaire_results', sa.Column('config_version', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('questionnaire_results', 'config_version')
@@ -0,0 +1,148 @@
+"""partition questionnaire_results by month
+
+Revision ID: e2a7c4d90f16
+Revises: b8f4d2a61c07
+Create Date: 2026-10-18 15:21:08.734562
+
+Rebuilds questionnaire_results as a table range-partitioned by month of "timestamp", with a
+default partition for rows outside every monthly one. The (questionnaire_id, user_id) unique
+constraint cannot exist on a partitioned table without the partition key, so it moves to
+questionnaire_result_keys. create_questionnaire_result_partitions() adds monthly partitions
+and is called by the app on startup and by api.database.partitions.
+
+The data is copied in one transaction that locks questionnaire_results, so run it in a
+maintenance window on large tables.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a7c4d90f16'
+down_revision: Union[str, None] = 'b8f4d2a61c07'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COLUMNS = 'id, user_id, questionnaire_id, gender, vo2max, bmi, fmi, tv_hours, score, classification, "timestamp"'
+
+# creates the monthly partitions from first_month through last_month that do not exist yet, moving
+# rows that already landed in the default partition into them; returns how many were created
+PARTITION_FUNCTION = """
+CREATE OR REPLACE FUNCTION create_questionnaire_result_partitions(first_month date, last_month date)
+RETURNS integer LANGUAGE plpgsql AS $$
+DECLARE
+    range_start date := date_trunc('month', first_month)::date;
+    range_end date;
+    partition_name text;
+    created integer := 0;
+BEGIN
+    -- workers and cron jobs may run this at the same time
+    PERFORM pg_advisory_xact_lock(hashtext('questionnaire_results_partitions'));
+    WHILE range_start <= last_month LOOP
+        range_end := (range_start + interval '1 month')::date;
+        partition_name := 'questionnaire_results_' || to_char(range_start, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I (LIKE questionnaire_results INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+            EXECUTE format('WITH moved AS (DELETE FROM questionnaire_results_default WHERE "timestamp" >= %L AND "timestamp" < %L RETURNING *) '
+                           'INSERT INTO %I SELECT * FROM moved', range_start, range_end, partition_name);
+            EXECUTE format('ALTER TABLE questionnaire_results ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', partition_name, range_start, range_end);
+            created := created + 1;
+        END IF;
+        range_start := range_end;
+    END LOOP;
+    RETURN created;
+END
+$$
+"""
+
+
+def upgrade() -> None:
+    # a partition key cannot be NULL; results without a timestamp are dated to the epoch and kept in the default partition
+    op.execute("""UPDATE questionnaire_results SET "timestamp" = '1970-01-01' WHERE "timestamp" IS NULL""")
+    op.rename_table('questionnaire_results', 'questionnaire_results_unpartitioned')
+    # free the index and constraint names for the new table
+    op.drop_index('ix_questionnaire_results_user_id_timestamp', table_name='questionnaire_results_unpartitioned')
+    op.drop_index('ix_questionnaire_results_questionnaire_id', table_name='questionnaire_results_unpartitioned')
+    op.drop_index('ix_questionnaire_results_id', table_name='questionnaire_results_unpartitioned')
+    op.execute('ALTER TABLE questionnaire_results_unpartitioned RENAME CONSTRAINT questionnaire_results_pkey TO questionnaire_results_unpartitioned_pkey')
+    op.execute('ALTER SEQUENCE questionnaire_results_id_seq OWNED BY NONE')
+
+    # the primary key has to include the partition key
+    op.execute("""
+    CREATE TABLE questionnaire_results (
+        id integer NOT NULL DEFAULT nextval('questionnaire_results_id_seq'),
+        user_id integer REFERENCES users (id),
+        questionnaire_id varchar NOT NULL,
+        gender varchar NOT NULL,
+        vo2max numeric NOT NULL,
+        bmi numeric,
+        fmi numeric,
+        tv_hours numeric,
+        score integer NOT NULL,
+        classification varchar NOT NULL,
+        "timestamp" timestamp NOT NULL DEFAULT now(),
+        CONSTRAINT questionnaire_results_pkey PRIMARY KEY (id, "timestamp")
+    ) PARTITION BY RANGE ("timestamp")
+    """)
+    op.execute('ALTER SEQUENCE questionnaire_results_id_seq OWNED BY questionnaire_results.id')
+    op.create_index('ix_questionnaire_results_user_id_timestamp', 'questionnaire_results', ['user_id', 'timestamp', 'id'], unique=False)
+    op.create_index(op.f('ix_questionnaire_results_questionnaire_id'), 'questionnaire_results', ['questionnaire_id'], unique=False)
+    op.execute('CREATE TABLE questionnaire_results_default PARTITION OF questionnaire_results DEFAULT')
+    op.execute(PARTITION_FUNCTION)
+    # one partition per month from the oldest result through three months ahead
+    op.execute("""
+    SELECT create_questionnaire_result_partitions(
+        COALESCE((SELECT min("timestamp") FROM questionnaire_results_unpartitioned WHERE "timestamp" > '1970-01-01'), now())::date,
+        (date_trunc('month', now()) + interval '3 months')::date)
+    """)
+    op.execute(f'INSERT INTO questionnaire_results ({COLUMNS}) SELECT {COLUMNS} FROM questionnaire_results_unpartitioned')
+
+    op.create_table('questionnaire_result_keys',
+    sa.Column('questionnaire_id', sa.String(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('questionnaire_id', 'user_id')
+    )
+    op.create_index(op.f('ix_questionnaire_result_keys_timestamp'), 'questionnaire_result_keys', ['timestamp'], unique=False)
+    # the old unique constraint did not apply to results without a user, and neither does the guard
+    op.execute("""
+    INSERT INTO questionnaire_result_keys (questionnaire_id, user_id, "timestamp")
+    SELECT questionnaire_id, user_id, "timestamp" FROM questionnaire_results_unpartitioned WHERE user_id IS NOT NULL
+    """)
+    op.drop_table('questionnaire_results_unpartitioned')
+
+
+def downgrade() -> None:
+    op.execute('ALTER TABLE questionnaire_results RENAME TO questionnaire_results_partitioned')
+    op.execute('ALTER TABLE questionnaire_results_partitioned RENAME CONSTRAINT questionnaire_results_pkey TO questionnaire_results_partitioned_pkey')
+    op.drop_index('ix_questionnaire_results_user_id_timestamp', table_name='questionnaire_results_partitioned')
+    op.drop_index('ix_questionnaire_results_questionnaire_id', table_name='questionnaire_results_partitioned')
+    op.execute('ALTER SEQUENCE questionnaire_results_id_seq OWNED BY NONE')
+    op.execute("""
+    CREATE TABLE questionnaire_results (
+        id integer NOT NULL DEFAULT nextval('questionnaire_results_id_seq') PRIMARY KEY,
+        user_id integer REFERENCES users (id),
+        questionnaire_id varchar NOT NULL,
+        vo2max numeric NOT NULL,
+        bmi numeric,
+        fmi numeric,
+        tv_hours numeric,
+        score integer NOT NULL,
+        classification varchar NOT NULL,
+        "timestamp" timestamp DEFAULT now(),
+        gender varchar NOT NULL
+    )
+    """)
+    op.execute('ALTER SEQUENCE questionnaire_results_id_seq OWNED BY questionnaire_results.id')
+    op.execute(f'INSERT INTO questionnaire_results ({COLUMNS}) SELECT {COLUMNS} FROM questionnaire_results_partitioned')
+    op.create_index(op.f('ix_questionnaire_results_id'), 'questionnaire_results', ['id'], unique=False)
+    op.create_index(op.f('ix_questionnaire_results_questionnaire_id'), 'questionnaire_results', ['questionnaire_id'], unique=False)
+    op.create_index('ix_questionnaire_results_user_id_timestamp', 'questionnaire_results', ['user_id', 'timestamp', 'id'], unique=False)
+    op.create_unique_constraint(None, 'questionnaire_results', ['questionnaire_id', 'user_id'])
+    op.execute('DROP TABLE questionnaire_results_partitioned')
+    op.execute('DROP FUNCTION create_questionnaire_result_partitions(date, date)')
+    op.drop_index(op.f('ix_questionnaire_result_keys_timestamp'), table_name='questionnaire_result_keys')
+    op.drop_table('questionnaire_result_keys')
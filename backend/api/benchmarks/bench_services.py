@@ -0,0 +1,138 @@
+""" Microbenchmarks for the scoring and calculation services.
+
+Measures per-call throughput of each service function, per-batch throughput of the batch
+engine, pydantic validation of RiskScoreInput, and the full request path through TestClient
+for the endpoints that do not touch the database. Results are compared against a JSON
+baseline and the run fails when any benchmark is slower than the baseline by more than the
+threshold.
+
+Usage:
+    python -m api.benchmarks.bench_services                    # compare against baseline.json
+    python -m api.benchmarks.bench_services --update-baseline  # record a new baseline
+    python -m api.benchmarks.bench_services --threshold 0.3 --only services
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_THRESHOLD = float(os.getenv("BENCH_REGRESSION_THRESHOLD", "0.25"))
+
+def measure(func: Callable[[], object], ops_per_call: int = 1, min_time: float = 0.2, repeats: int = 5) -> float:
+    """ Returns the best observed throughput of func in operations per second. The number of
+    calls per sample is calibrated so each sample runs for at least min_time seconds. """
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        calls *= 2 if elapsed < min_time / 4 else 1 + int(min_time / max(elapsed, 1e-9))
+    best = elapsed
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return calls * ops_per_call / best
+
+def service_benchmarks() -> Dict[str, Tuple[Callable[[], object], int]]:
+    from ..models import Gender, RiskScoreInput
+    from ..services import services as srv
+
+    batch_size = 1000
+    genders = [Gender.male, Gender.female] * (batch_size // 2)
+    vo2max = [30.0 + (i % 20) for i in range(batch_size)]
+    bmi = [15.0 + (i % 18) for i in range(batch_size)]
+    fmi = [4.0 + (i % 18) for i in range(batch_size)]
+    tv_hours = [(i % 4) / 2 for i in range(batch_size)]
+    payload = {"gender": "female", "vo2max": 40, "bmi": 17, "fmi": 10, "tv_hours": 2}
+
+    return {
+        "calculate_bmi": (lambda: srv.calculate_bmi(180, 75), 1),
+        "calculate_fmi_fat_mass": (lambda: srv.calculate_fmi(180, fat_mass_kg=15), 1),
+        "calculate_fmi_body_fat": (lambda: srv.calculate_fmi(180, weight_kg=75, body_fat_percentage=20), 1),
+        "calculate_vo2max": (lambda: srv.calculate_vo2max(9, 12), 1),
+        "calculate_risk_score_male": (lambda: srv.calculate_risk_score(Gender.male, 45, bmi=25), 1),
+        "calculate_risk_score_female": (lambda: srv.calculate_risk_score(Gender.female, 40, fmi=10, tv_hours=2), 1),
+        "classify_risk_score": (lambda: srv.classify_risk_score(14, Gender.male), 1),
+        "calculate_risk_score_batch_rows": (lambda: srv.calculate_risk_score_batch(genders, vo2max, bmi, fmi, tv_hours), batch_size),
+        "validate_risk_score_input": (lambda: RiskScoreInput.model_validate(payload), 1),
+    }
+
+def request_benchmarks() -> Dict[str, Tuple[Callable[[], object], int]]:
+    from fastapi.testclient import TestClient
+    from ..main import app
+
+    client = TestClient(app)
+    etag = client.get("/calculate/bmi", params={"height_cm": 180, "weight_kg": 75}).headers["etag"]
+    batch = {"rows": [{"gender": "male", "vo2max": 45, "bmi": 25}, {"gender": "female", "vo2max": 40, "fmi": 10, "tv_hours": 2}] * 50}
+    return {
+        "request_calculate_bmi": (lambda: client.post("/calculate/bmi", json={"height_cm": 180, "weight_kg": 75}), 1),
+        "request_calculate_risk_score": (lambda: client.post("/calculate/risk-score", json={"gender": "male", "vo2max": 45, "bmi": 25}), 1),
+        "request_classify_risk_score": (lambda: client.post("/classify/risk-score", json={"risk_score": 14, "gender": "male"}), 1),
+        "request_calculate_bmi_not_modified": (lambda: client.get("/calculate/bmi", params={"height_cm": 180, "weight_kg": 75}, headers={"If-None-Match": etag}), 1),
+        "request_risk_score_batch_rows": (lambda: client.post("/calculate/risk-score/batch", json=batch), len(batch["rows"])),
+    }
+
+def run(only: Optional[str] = None, min_time: float = 0.2) -> Dict[str, float]:
+    """ Runs the selected suite ('services', 'requests' or both) and returns ops/sec per benchmark. """
+    suites = []
+    if only in (None, "services"):
+        suites.append(service_benchmarks())
+    if only in (None, "requests"):
+        suites.append(request_benchmarks())
+    results = {}
+    for suite in suites:
+        for name, (func, ops_per_call) in suite.items():
+            results[name] = round(measure(func, ops_per_call, min_time=min_time), 1)
+    return results
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> List[str]:
+    """ Returns a description of every benchmark slower than its baseline by more than threshold. """
+    regressions = []
+    for name, ops in results.items():
+        expected = baseline.get(name)
+        if expected and ops < expected * (1 - threshold):
+            regressions.append(f"{name}: {ops:,.0f} ops/s is {1 - ops / expected:.0%} below the baseline of {expected:,.0f} ops/s")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the scoring and calculation services.")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline JSON file")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results as the new baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown as a fraction of the baseline (default 0.25, or BENCH_REGRESSION_THRESHOLD)")
+    parser.add_argument("--only", choices=["services", "requests"], help="run a single suite")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per sample")
+    args = parser.parse_args(argv)
+
+    results = run(only=args.only, min_time=args.min_time)
+    for name, ops in results.items():
+        print(f"{name:40s} {ops:>14,.1f} ops/s")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({"host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+                       "results": results}, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update-baseline first", file=sys.stderr)
+        return 2
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+from datetime import date, datetime
+from typing import AsyncIterator, List, Optional, Sequence, Tuple, Union
+from sqlalchemy import insert, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from .. import models
+from . import schemas
+from ..helpers.exceptions import InvalidInputError, SubmissionConflictError
+from .crud import build_rollup_upsert, current_month, filter_by_time
+from ..services.auth import get_password_hash_async
+
+# async counterparts of the functions in crud.py, for use with an AsyncSession
+
+async def create_user(db: AsyncSession, user: models.UserCreate) -> models.UserBase:
+    hashed_password = await get_password_hash_async(user.password)
+    db_user = schemas.User(email=user.email, hashed_password=hashed_password, full_name=user.full_name)
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    user_pydantic = models.UserBase(
+        email=db_user.email, 
+        full_name=db_user.full_name, 
+        disabled=db_user.disabled
+    )
+    return user_pydantic
+
+async def get_user(db: AsyncSession, email: str) -> Optional[schemas.User]:
+    """Finds a user in the database based on their email.
+
+    Args:
+        db (AsyncSession): The async database session.
+        email (str): The email of the user to find.
+
+    Returns:
+        Optional[schemas.User]: An instance of the User model or None if not found.
+    """
+    result = await db.execute(select(schemas.User).filter(schemas.User.email == email).limit(1))
+    return result.scalars().first()
+
+async def update_password_hash(db: AsyncSession, user: schemas.User, hashed_password: str):
+    """Replaces a user's password hash, e.g. with one at the current bcrypt cost.
+
+    Args:
+        db (AsyncSession): The async database session.
+        user (schemas.User): The user, as loaded in this session.
+        hashed_password (str): The new hash of the same password.
+    """
+    user.hashed_password = hashed_password
+    await db.commit()
+
+async def create_questionnaire_result(db: AsyncSession, user_email: str, result: models.QuestionnaireResultCreate,
+                                      config_version: Optional[str] = None) -> models.QuestionnaireResultResponse:
+    user = await get_user(db, user_email)
+    # raises IntegrityError when the user already submitted this questionnaire
+    await db.execute(insert(schemas.QuestionnaireResultKey).values(questionnaire_id=result.questionnaire_id, user_id=user.id))
+    db_result = schemas.QuestionnaireResult(user_id = user.id, gender= result.gender,questionnaire_id = result.questionnaire_id, vo2max = result.vo2max, bmi = result.bmi, fmi = result.fmi, tv_hours = result.tv_hours, score = result.score, classification = result.classification, config_version = config_version )
+    db.add(db_result)
+    # now() is fixed for the transaction, so the rollup lands in the month of the row's server-side timestamp
+    await db.execute(build_rollup_upsert([result.model_dump()], month=current_month()))
+    await db.commit()
+    await db.refresh(db_result)
+    questionnaire_result = models.QuestionnaireResultResponse(
+        user_id=user_email,
+        questionnaire_id=result.questionnaire_id,
+        gender = result.gender, 
+        vo2max = result.vo2max, 
+        bmi = result.bmi, 
+        fmi = result.fmi, 
+        tv_hours = result.tv_hours, 
+        score = result.score, 
+        classification = result.classification
+    )
+    return questionnaire_result
+
+async def create_questionnaire_results(db: AsyncSession, submissions: Sequence[Tuple[str, models.QuestionnaireResultCreate]]
+                                      ) -> List[Union[models.QuestionnaireResultResponse, Exception]]:
+    """Inserts many users' questionnaire results with one multi-row INSERT of their uniqueness keys,
+    one of the results and one commit.
+
+    Args:
+        db (AsyncSession): The async database session.
+        submissions (Sequence[Tuple[str, models.QuestionnaireResultCreate]]): (user email, result) pairs.
+
+    Returns:
+        List[Union[models.QuestionnaireResultResponse, Exception]]: One outcome per submission, in order:
+        the stored result, an InvalidInputError for an unknown user, or a SubmissionConflictError when
+        the user already has a result for the questionnaire, in the database or earlier in the batch.
+    """
+    result_table = schemas.QuestionnaireResult
+    emails = {email for email, _ in submissions}
+    users = dict((await db.execute(select(schemas.User.email, schemas.User.id).filter(schemas.User.email.in_(emails)))).all())
+
+    outcomes: List[Union[models.QuestionnaireResultResponse, Exception, None]] = [None] * len(submissions)
+    index_by_key = {}
+    rows = []
+    for index, (email, result) in enumerate(submissions):
+        user_id = users.get(email)
+        if user_id is None:
+            outcomes[index] = InvalidInputError(f"Unknown user {email}.")
+            continue
+        key = (result.questionnaire_id, user_id)
+        if key in index_by_key:
+            outcomes[index] = SubmissionConflictError(f"A result for questionnaire {result.questionnaire_id} was already submitted.")
+            continue
+        index_by_key[key] = index
+        rows.append({"user_id": user_id, **result.model_dump()})
+
+    if rows:
+        # claim the keys first; only the rows whose key was free are inserted
+        key_table = schemas.QuestionnaireResultKey
+        claimed = {tuple(key) for key in (await db.execute(
+            pg_insert(key_table).values([{"questionnaire_id": row["questionnaire_id"], "user_id": row["user_id"]} for row in rows])
+            .on_conflict_do_nothing(index_elements=["questionnaire_id", "user_id"])
+            .returning(key_table.questionnaire_id, key_table.user_id)
+        )).all()}
+        rows = [row for row in rows if (row["questionnaire_id"], row["user_id"]) in claimed]
+    if rows:
+        statement = (
+            insert(result_table).values(rows)
+            .returning(result_table.questionnaire_id, result_table.user_id, result_table.timestamp)
+        )
+        inserted = (await db.execute(statement)).all()
+        rollup_rows = []
+        for questionnaire_id, user_id, timestamp in inserted:
+            index = index_by_key[(questionnaire_id, user_id)]
+            email, result = submissions[index]
+            outcomes[index] = models.QuestionnaireResultResponse(user_id=email, **result.model_dump())
+            rollup_rows.append({**result.model_dump(), "timestamp": timestamp})
+        await db.execute(build_rollup_upsert(rollup_rows))
+    if index_by_key:
+        await db.commit()
+
+    for (questionnaire_id, _), index in index_by_key.items():
+        if outcomes[index] is None:
+            outcomes[index] = SubmissionConflictError(f"A result for questionnaire {questionnaire_id} already exists.")
+    return outcomes
+
+async def stream_questionnaire_results_by_user(db: AsyncSession, user_email: str, batch_size: int = 500,
+                                               date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> AsyncIterator[schemas.QuestionnaireResult]:
+    """Streams a user's questionnaire results from a server-side cursor.
+
+    Args:
+        db (AsyncSession): The async database session.
+        user_email (str): The email of the user whose results to stream.
+        batch_size (int): The number of rows fetched from the cursor at a time.
+        date_from (Optional[datetime]): Only stream results taken at or after this time.
+        date_to (Optional[datetime]): Only stream results taken before this time.
+
+    Returns:
+        AsyncIterator[schemas.QuestionnaireResult]: The results in the order they were taken, fetched
+        batch_size rows at a time so memory stays constant no matter how many results the user has.
+        Only the partitions of the requested months are read.
+    """
+    user = await get_user(db, user_email)
+    statement = filter_by_time(
+        select(schemas.QuestionnaireResult).filter(schemas.QuestionnaireResult.user_id == user.id), date_from, date_to
+    ).order_by(schemas.QuestionnaireResult.timestamp, schemas.QuestionnaireResult.id).execution_options(yield_per=batch_size)
+    return await db.stream_scalars(statement)
+
+
+async def list_questionnaire_results_by_user(db: AsyncSession, user_email: str, limit: int,
+                                            after: Optional[Tuple[datetime, int]] = None,
+                                            classification: Optional[str] = None, gender: Optional[str] = None,
+                                            date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> List[schemas.QuestionnaireResult]:
+    """Lists a user's questionnaire results newest first, using keyset pagination.
+
+    Args:
+        db (AsyncSession): The async database session.
+        user_email (str): The email of the user whose results to list.
+        limit (int): The maximum number of results to return.
+        after (Optional[Tuple[datetime, int]]): The (timestamp, id) of the last result of the previous page.
+        classification (Optional[str]): Only return results with this classification.
+        gender (Optional[str]): Only return results with this gender.
+        date_from (Optional[datetime]): Only return results taken at or after this time.
+        date_to (Optional[datetime]): Only return results taken before this time.
+
+    Returns:
+        List[schemas.QuestionnaireResult]: Up to limit results. Seeks past the previous page through the
+        (user_id, timestamp, id) index, so every page costs the same as the first, and only reads the
+        partitions of the months within the date range and before the cursor.
+    """
+    user = await get_user(db, user_email)
+    result = schemas.QuestionnaireResult
+    statement = select(result).filter(result.user_id == user.id)
+    if after is not None:
+        # the plain bound on timestamp lets the planner skip newer partitions, which the row comparison does not
+        statement = statement.filter(result.timestamp <= after[0], tuple_(result.timestamp, result.id) < tuple_(*after))
+    if classification is not None:
+        statement = statement.filter(result.classification == classification)
+    if gender is not None:
+        statement = statement.filter(result.gender == gender)
+    statement = filter_by_time(statement, date_from, date_to).order_by(result.timestamp.desc(), result.id.desc()).limit(limit)
+    results = await db.execute(statement)
+    return list(results.scalars().all())
+
+
+async def get_rollups(db: AsyncSession, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                      gender: Optional[str] = None) -> List[schemas.QuestionnaireResultRollup]:
+    """Reads the cohort rollup buckets, optionally limited to a range of months and a gender.
+
+    Args:
+        db (AsyncSession): The async database session.
+        date_from (Optional[date]): Only return months starting on or after this date's month.
+        date_to (Optional[date]): Only return months starting before this date.
+        gender (Optional[str]): Only return buckets of this gender.
+
+    Returns:
+        List[schemas.QuestionnaireResultRollup]: One row per (month, gender, classification).
+    """
+    rollup = schemas.QuestionnaireResultRollup
+    statement = select(rollup)
+    if date_from is not None:
+        statement = statement.filter(rollup.month >= date_from.replace(day=1))
+    if date_to is not None:
+        statement = statement.filter(rollup.month < date_to)
+    if gender is not None:
+        statement = statement.filter(rollup.gender == gender)
+    statement = statement.order_by(rollup.month, rollup.gender, rollup.classification)
+    results = await db.execute(statement)
+    return list(results.scalars().all())
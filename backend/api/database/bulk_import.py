@@ -0,0 +1,258 @@
+""" Bulk import of historical questionnaire results.
+
+Reads CSV or NDJSON, validates each row, and loads the valid rows chunk by chunk through
+PostgreSQL COPY into a temporary staging table. A single set-based statement per chunk
+then resolves user emails to ids, drops duplicates, and inserts into questionnaire_results,
+skipping rows whose (questionnaire_id, user_id) key is already taken in questionnaire_result_keys.
+The monthly partitions of each chunk's date range are created first, so historical rows land in
+partitions that can later be dropped rather than in the default one.
+Imported rows reach the percentile sketches once they are rebuilt with api.database.sketches.
+
+Usage:
+    python -m api.database.bulk_import results.csv [--format ndjson] [--chunk-size 5000] [--rejects rejects.csv]
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+from collections import Counter
+from datetime import date
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+from pydantic import ValidationError
+from .. import models
+from .database import engine
+
+CREATE_STAGING_TABLE = """
+CREATE TEMPORARY TABLE IF NOT EXISTS questionnaire_results_staging (
+    line_no bigint NOT NULL,
+    user_email varchar(255) NOT NULL,
+    questionnaire_id varchar NOT NULL,
+    gender varchar NOT NULL,
+    vo2max numeric NOT NULL,
+    bmi numeric,
+    fmi numeric,
+    tv_hours numeric,
+    score integer NOT NULL,
+    classification varchar NOT NULL,
+    "timestamp" timestamp
+) ON COMMIT DELETE ROWS
+"""
+
+COPY_INTO_STAGING = """
+COPY questionnaire_results_staging (line_no, user_email, questionnaire_id, gender, vo2max, bmi, fmi, tv_hours, score, classification, "timestamp")
+FROM STDIN WITH (FORMAT csv)
+"""
+
+# creates the missing monthly partitions from the first through the last month, see api.database.partitions
+CREATE_PARTITIONS_FOR_RANGE = "SELECT create_questionnaire_result_partitions(%s, %s)"
+
+# resolves users, keeps the first row per (user, questionnaire), claims the uniqueness keys, inserts the rows whose
+# key was free, adds the new rows to the cohort rollups, and returns every staging row that was not inserted
+MERGE_STAGING = """
+WITH resolved AS (
+    SELECT s.*, u.id AS user_id
+    FROM questionnaire_results_staging s
+    LEFT JOIN users u ON u.email = s.user_email
+), candidates AS (
+    SELECT DISTINCT ON (user_id, questionnaire_id) *
+    FROM resolved
+    WHERE user_id IS NOT NULL
+    ORDER BY user_id, questionnaire_id, line_no
+), claimed AS (
+    INSERT INTO questionnaire_result_keys (questionnaire_id, user_id, "timestamp")
+    SELECT questionnaire_id, user_id, COALESCE("timestamp", now())
+    FROM candidates
+    ON CONFLICT (questionnaire_id, user_id) DO NOTHING
+    RETURNING questionnaire_id, user_id, "timestamp"
+), inserted AS (
+    INSERT INTO questionnaire_results (user_id, questionnaire_id, gender, vo2max, bmi, fmi, tv_hours, score, classification, "timestamp")
+    SELECT c.user_id, c.questionnaire_id, c.gender, c.vo2max, c.bmi, c.fmi, c.tv_hours, c.score, c.classification, k."timestamp"
+    FROM candidates c
+    JOIN claimed k ON k.user_id = c.user_id AND k.questionnaire_id = c.questionnaire_id
+    RETURNING user_id, questionnaire_id, gender, classification, score, vo2max, bmi, fmi, "timestamp"
+), rolled_up AS (
+    INSERT INTO questionnaire_result_rollups AS r (month, gender, classification, count, score_sum, score_sumsq, vo2max_sum, vo2max_sumsq,
+                                                   bmi_count, bmi_sum, bmi_sumsq, fmi_count, fmi_sum, fmi_sumsq, updated_at)
+    SELECT date_trunc('month', "timestamp")::date, gender, classification,
+           count(*), sum(score), sum(score::numeric * score), sum(vo2max), sum(vo2max * vo2max),
+           count(bmi), coalesce(sum(bmi), 0), coalesce(sum(bmi * bmi), 0),
+           count(fmi), coalesce(sum(fmi), 0), coalesce(sum(fmi * fmi), 0), now()
+    FROM inserted
+    GROUP BY 1, 2, 3
+    ON CONFLICT (month, gender, classification) DO UPDATE SET
+        count = r.count + excluded.count,
+        score_sum = r.score_sum + excluded.score_sum,
+        score_sumsq = r.score_sumsq + excluded.score_sumsq,
+        vo2max_sum = r.vo2max_sum + excluded.vo2max_sum,
+        vo2max_sumsq = r.vo2max_sumsq + excluded.vo2max_sumsq,
+        bmi_count = r.bmi_count + excluded.bmi_count,
+        bmi_sum = r.bmi_sum + excluded.bmi_sum,
+        bmi_sumsq = r.bmi_sumsq + excluded.bmi_sumsq,
+        fmi_count = r.fmi_count + excluded.fmi_count,
+        fmi_sum = r.fmi_sum + excluded.fmi_sum,
+        fmi_sumsq = r.fmi_sumsq + excluded.fmi_sumsq,
+        updated_at = now()
+)
+SELECT r.line_no,
+       CASE WHEN r.user_id IS NULL THEN 'unknown user'
+            WHEN c.line_no IS NULL THEN 'duplicate in input'
+            ELSE 'already exists' END AS reason
+FROM resolved r
+LEFT JOIN candidates c ON c.line_no = r.line_no
+LEFT JOIN inserted i ON c.line_no IS NOT NULL AND i.user_id = r.user_id AND i.questionnaire_id = r.questionnaire_id
+WHERE i.user_id IS NULL
+ORDER BY r.line_no
+"""
+
+# rejections that mean the row is already stored, e.g. when a file is imported again
+SKIPPED_REASONS = ("already exists",)
+
+class InvalidLine(ValueError):
+    """ A line of the input that is not a row at all, yielded by the readers in its place. """
+
+class ImportReport:
+    """ Running totals of a bulk import. """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.rows_read = 0
+        self.rows_inserted = 0
+        self.rejected: List[Tuple[int, str]] = []
+
+    @property
+    def errors(self) -> int:
+        """ Rows rejected for a problem with the row itself, not because it is already stored. """
+        return sum(1 for _, reason in self.rejected if reason not in SKIPPED_REASONS)
+
+    @property
+    def elapsed_s(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_read / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    def summary(self) -> Dict:
+        return {
+            "rows_read": self.rows_read,
+            "rows_inserted": self.rows_inserted,
+            "rows_rejected": len(self.rejected),
+            "errors": self.errors,
+            "rejected_by_reason": dict(Counter(reason.split(":")[0] for _, reason in self.rejected)),
+            "elapsed_s": round(self.elapsed_s, 3),
+            "rows_per_second": round(self.rows_per_second, 1),
+        }
+
+def read_csv(source: TextIO) -> Iterator[Tuple[int, Dict]]:
+    """ Yields (line number, raw row) pairs from a CSV file with a header row. """
+    for line_no, row in enumerate(csv.DictReader(source), start=2):
+        yield line_no, row
+
+def read_ndjson(source: TextIO) -> Iterator[Tuple[int, Dict]]:
+    """ Yields (line number, raw row) pairs from a newline-delimited JSON file, with an
+    InvalidLine in place of a line that is not valid JSON or not an object. """
+    for line_no, line in enumerate(source, start=1):
+        if not line.strip():
+            continue
+        try:
+            raw = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_no, InvalidLine(f"json {e.msg} at column {e.colno}")
+            continue
+        if not isinstance(raw, dict):
+            yield line_no, InvalidLine(f"json expected an object, got {type(raw).__name__}")
+            continue
+        yield line_no, raw
+
+def validate_row(raw: Dict) -> models.QuestionnaireResultImport:
+    """ Validates a raw row. Empty CSV cells are treated as missing values. """
+    return models.QuestionnaireResultImport(**{key: value for key, value in raw.items() if value not in ("", None)})
+
+def _encode_chunk(rows: Iterable[Tuple[int, models.QuestionnaireResultImport]]) -> io.StringIO:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for line_no, row in rows:
+        writer.writerow([line_no, row.user_email, row.questionnaire_id, row.gender.value, row.vo2max, row.bmi, row.fmi,
+                         row.tv_hours, row.score, row.classification, row.timestamp.isoformat() if row.timestamp else None])
+    buffer.seek(0)
+    return buffer
+
+def chunk_months(rows: Iterable[Tuple[int, models.QuestionnaireResultImport]]) -> Optional[Tuple[date, date]]:
+    """ Returns the first and last month the rows of a chunk fall in; rows without a timestamp
+    are dated now, whose partition is always kept ready. None when no row has a timestamp. """
+    timestamps = [row.timestamp for _, row in rows if row.timestamp is not None]
+    if not timestamps:
+        return None
+    return min(timestamps).date().replace(day=1), max(timestamps).date().replace(day=1)
+
+def _load_chunk(connection, rows: List[Tuple[int, models.QuestionnaireResultImport]], report: ImportReport):
+    """ Creates the partitions the chunk needs, then COPYs it into the staging table and merges
+    it, in one transaction. """
+    months = chunk_months(rows)
+    with connection.cursor() as cursor:
+        if months is not None:
+            cursor.execute(CREATE_PARTITIONS_FOR_RANGE, months)
+        cursor.execute(CREATE_STAGING_TABLE)
+        cursor.copy_expert(COPY_INTO_STAGING, _encode_chunk(rows))
+        cursor.execute(MERGE_STAGING)
+        rejected = cursor.fetchall()
+    connection.commit()
+    report.rows_inserted += len(rows) - len(rejected)
+    report.rejected.extend((line_no, reason) for line_no, reason in rejected)
+
+def import_rows(connection, rows: Iterable[Tuple[int, Dict]], chunk_size: int = 5000, report: Optional[ImportReport] = None) -> ImportReport:
+    """ Imports (line number, raw row) pairs through a psycopg2 connection, chunk_size rows
+    per COPY. Memory stays bounded by the chunk size no matter how large the input is. """
+    report = report or ImportReport()
+    chunk = []
+    for line_no, raw in rows:
+        report.rows_read += 1
+        if isinstance(raw, InvalidLine):
+            report.rejected.append((line_no, f"invalid: {raw}"))
+            continue
+        try:
+            chunk.append((line_no, validate_row(raw)))
+        except ValidationError as e:
+            report.rejected.append((line_no, f"invalid: {e.errors()[0]['loc'][0]} {e.errors()[0]['msg']}"))
+            continue
+        if len(chunk) >= chunk_size:
+            _load_chunk(connection, chunk, report)
+            chunk = []
+    if chunk:
+        _load_chunk(connection, chunk, report)
+    return report
+
+def import_file(path: str, file_format: str = "csv", chunk_size: int = 5000) -> ImportReport:
+    """ Imports a CSV or NDJSON file into questionnaire_results using the application's engine. """
+    reader = read_ndjson if file_format == "ndjson" else read_csv
+    connection = engine.raw_connection()
+    try:
+        with open(path, newline="") as source:
+            return import_rows(connection, reader(source), chunk_size=chunk_size)
+    finally:
+        connection.close()
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk import historical questionnaire results.")
+    parser.add_argument("path", help="CSV or NDJSON file with user_email, questionnaire_id, gender, vo2max, bmi, fmi, tv_hours, score, classification and an optional timestamp")
+    parser.add_argument("--format", choices=["csv", "ndjson"], default=None, help="input format, guessed from the file extension by default")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="rows per COPY")
+    parser.add_argument("--rejects", help="write rejected line numbers and reasons to this CSV file")
+    args = parser.parse_args(argv)
+
+    file_format = args.format or ("ndjson" if args.path.endswith((".ndjson", ".jsonl")) else "csv")
+    report = import_file(args.path, file_format=file_format, chunk_size=args.chunk_size)
+
+    if args.rejects:
+        with open(args.rejects, "w", newline="") as rejects_file:
+            writer = csv.writer(rejects_file)
+            writer.writerow(["line_no", "reason"])
+            writer.writerows(sorted(report.rejected))
+    print(json.dumps(report.summary(), indent=2))
+    # rows that are already stored are not errors, so importing a file again succeeds
+    return 1 if report.errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,57 +1,83 @@
-from typing import Optional
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Dict, Iterable, Optional
+from sqlalchemy import Date, cast, func, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
-from .. import models
 from . import schemas
-from ..services.auth import get_password_hash
 
-def create_user(db: Session, user: models.UserCreate):
-    hashed_password = get_password_hash(user.password)
-    db_user = schemas.User(email=user.email, hashed_password=hashed_password, full_name=user.full_name)
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    user_pydantic = models.UserBase(
-        email=db_user.email, 
-        full_name=db_user.full_name, 
-        disabled=db_user.disabled
-    )
-    return user_pydantic
+def filter_by_time(statement, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None):
+    """ Limits a questionnaire_results query to [date_from, date_to). Plain comparisons on the
+    partition key, so the planner skips the partitions outside the range. """
+    if date_from is not None:
+        statement = statement.filter(schemas.QuestionnaireResult.timestamp >= date_from)
+    if date_to is not None:
+        statement = statement.filter(schemas.QuestionnaireResult.timestamp < date_to)
+    return statement
+
+
+# cohort rollups
+ROLLUP_SUM_COLUMNS = ["count", "score_sum", "score_sumsq", "vo2max_sum", "vo2max_sumsq",
+                      "bmi_count", "bmi_sum", "bmi_sumsq", "fmi_count", "fmi_sum", "fmi_sumsq"]
+
+def current_month():
+    """ SQL expression for the first day of the current month, by the database clock. """
+    return cast(func.date_trunc('month', func.now()), Date)
 
-def get_user(db: Session, email: str) -> Optional[schemas.User]:
-    """Finds a user in the database based on their email.
+def build_rollup_upsert(rows: Iterable[Dict], month=None):
+    """Builds one statement that adds a set of new questionnaire results to the rollups.
 
     Args:
-        db (Session): The database session.
-        email (str): The email of the user to find.
+        rows (Iterable[Dict]): The new results, with gender, classification, score, vo2max, bmi and fmi,
+            and a timestamp unless month is given.
+        month: A date or SQL expression for the month of every row. Defaults to each row's timestamp.
 
     Returns:
-        Optional[schemas.User]: An instance of the User model or None if not found.
+        An INSERT ... ON CONFLICT DO UPDATE that increments the running sums of each affected
+        (month, gender, classification) bucket, rows being pre-aggregated per bucket.
     """
-    db_user = db.query(schemas.User).filter(schemas.User.email == email).first()
-    if db_user:
-        return db_user
-    return None
-
-def create_questionnaire_result(db: Session, user_email: str, result:models.QuestionnaireResultCreate):
-    user = get_user(db, user_email)
-    db_result = schemas.QuestionnaireResult(user_id = user.id, gender= result.gender,questionnaire_id = result.questionnaire_id, vo2max = result.vo2max, bmi = result.bmi, fmi = result.fmi, tv_hours = result.tv_hours, score = result.score, classification = result.classification )
-    db.add(db_result)
+    buckets = defaultdict(lambda: dict.fromkeys(ROLLUP_SUM_COLUMNS, 0))
+    for row in rows:
+        row_month = month if month is not None else date(row["timestamp"].year, row["timestamp"].month, 1)
+        gender = row["gender"].value if hasattr(row["gender"], "value") else row["gender"]
+        bucket = buckets[(row_month, gender, row["classification"])]
+        bucket["count"] += 1
+        bucket["score_sum"] += row["score"]
+        bucket["score_sumsq"] += row["score"] ** 2
+        bucket["vo2max_sum"] += row["vo2max"]
+        bucket["vo2max_sumsq"] += row["vo2max"] ** 2
+        for metric in ("bmi", "fmi"):
+            if row.get(metric) is not None:
+                bucket[f"{metric}_count"] += 1
+                bucket[f"{metric}_sum"] += row[metric]
+                bucket[f"{metric}_sumsq"] += row[metric] ** 2
+    values = [{"month": key[0], "gender": key[1], "classification": key[2], **sums} for key, sums in buckets.items()]
+    statement = pg_insert(schemas.QuestionnaireResultRollup).values(values)
+    increments = {column: getattr(schemas.QuestionnaireResultRollup, column) + getattr(statement.excluded, column) for column in ROLLUP_SUM_COLUMNS}
+    increments["updated_at"] = func.now()
+    return statement.on_conflict_do_update(index_elements=["month", "gender", "classification"], set_=increments)
+
+# recomputes every bucket from questionnaire_results, for backfills and repairs
+REBUILD_ROLLUPS = """
+INSERT INTO questionnaire_result_rollups (month, gender, classification, count, score_sum, score_sumsq, vo2max_sum, vo2max_sumsq,
+                                          bmi_count, bmi_sum, bmi_sumsq, fmi_count, fmi_sum, fmi_sumsq, updated_at)
+SELECT date_trunc('month', "timestamp")::date, gender, classification,
+       count(*), sum(score), sum(score::numeric * score), sum(vo2max), sum(vo2max * vo2max),
+       count(bmi), coalesce(sum(bmi), 0), coalesce(sum(bmi * bmi), 0),
+       count(fmi), coalesce(sum(fmi), 0), coalesce(sum(fmi * fmi), 0), now()
+FROM questionnaire_results
+WHERE "timestamp" IS NOT NULL
+GROUP BY 1, 2, 3
+"""
+
+# blocks the incremental upserts, but not reads, until the rebuild commits. A write blocked here
+# is not in the rebuild's snapshot and adds itself afterwards, so it is counted exactly once
+LOCK_ROLLUPS = "LOCK TABLE questionnaire_result_rollups IN EXCLUSIVE MODE"
+
+def rebuild_rollups(db: Session):
+    """ Recomputes the rollups from scratch in one transaction, with the table locked against
+    concurrent upserts so none is lost, counted twice or conflicts with the new rows. """
+    db.execute(text(LOCK_ROLLUPS))
+    db.execute(text("DELETE FROM questionnaire_result_rollups"))
+    db.execute(text(REBUILD_ROLLUPS))
     db.commit()
-    db.refresh(db_result)
-    questionnaire_result = models.QuestionnaireResultResponse(
-        user_id=user_email,
-        questionnaire_id=result.questionnaire_id,
-        gender = result.gender, 
-        vo2max = result.vo2max, 
-        bmi = result.bmi, 
-        fmi = result.fmi, 
-        tv_hours = result.tv_hours, 
-        score = result.score, 
-        classification = result.classification
-    )
-    return questionnaire_result
-
-def get_questionnaire_result_by_user(db: Session, user_email: str):
-    user = get_user(db, user_email)
-    results = db.query(schemas.QuestionnaireResult).filter(schemas.QuestionnaireResult.user_id == user.id).all()
-    return results
\ No newline at end of file
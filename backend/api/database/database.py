@@ -1,5 +1,10 @@
-from sqlalchemy import create_engine
+import asyncio
+import itertools
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from .pool_stats import InstrumentedAsyncAdaptedQueuePool, InstrumentedQueuePool, register_engine
 import os
 
 POSTGRES_USER = os.getenv('POSTGRES_USER')
@@ -7,7 +12,184 @@ POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
 POSTGRES_DB = os.getenv('POSTGRES_DB')
 DB_HOST = os.getenv('DB_HOST', 'localhost')
 
-SQLALCHEMY_DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DB_HOST}/{POSTGRES_DB}"
+# DATABASE_URL and ASYNC_DATABASE_URL override the URLs built from the POSTGRES_* settings,
+# e.g. sqlite:///primary.db and sqlite+aiosqlite:///primary.db for a local stand-in
+SQLALCHEMY_DATABASE_URL = os.getenv('DATABASE_URL') or f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DB_HOST}/{POSTGRES_DB}"
+ASYNC_SQLALCHEMY_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL') or f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DB_HOST}/{POSTGRES_DB}"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
\ No newline at end of file
+# connection pool settings of the async engine and the replica engines, and by default of the sync engine
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+# connections opened at startup so the first requests do not pay for the TCP and auth handshakes
+DB_POOL_WARMUP = int(os.getenv('DB_POOL_WARMUP', '2'))
+# the sync engine serves the CLI tools; api.serve shrinks it in the workers, which do not use it
+DB_SYNC_POOL_SIZE = int(os.getenv('DB_SYNC_POOL_SIZE', str(DB_POOL_SIZE)))
+DB_SYNC_MAX_OVERFLOW = int(os.getenv('DB_SYNC_MAX_OVERFLOW', str(DB_MAX_OVERFLOW)))
+
+# read replicas: comma-separated async URLs. Without any, every read goes to the primary
+DB_REPLICA_URLS = [url.strip() for url in os.getenv('DB_REPLICA_URLS', '').split(',') if url.strip()]
+# how long a client carries the WAL position of its last write, see ReplicaRouter
+DB_REPLICA_PIN_SECONDS = float(os.getenv('DB_REPLICA_PIN_SECONDS', '5'))
+# replicas lagging further behind than this are skipped until they catch up
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv('DB_REPLICA_MAX_LAG_SECONDS', '2'))
+DB_REPLICA_CHECK_SECONDS = float(os.getenv('DB_REPLICA_CHECK_SECONDS', '1'))
+
+POOL_OPTIONS = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+}
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=InstrumentedQueuePool,
+                       **{**POOL_OPTIONS, "pool_size": DB_SYNC_POOL_SIZE, "max_overflow": DB_SYNC_MAX_OVERFLOW})
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# async engine used by the async def endpoints, so database I/O does not block the event loop
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=InstrumentedAsyncAdaptedQueuePool, **POOL_OPTIONS)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+register_engine("sync", engine)
+register_engine("async", async_engine.sync_engine)
+
+# each replica gets a pool of the same size as the primary's, since it has its own max_connections
+replica_engines: Dict[str, AsyncEngine] = {
+    f"replica{index}": create_async_engine(url, poolclass=InstrumentedAsyncAdaptedQueuePool, **POOL_OPTIONS)
+    for index, url in enumerate(DB_REPLICA_URLS, start=1)
+}
+for name, replica_engine in replica_engines.items():
+    register_engine(name, replica_engine.sync_engine)
+
+async def warm_async_pool(connections: int = DB_POOL_WARMUP) -> int:
+    """ Opens up to pool_size connections concurrently and returns them to the async pool.
+    Returns the number of connections opened, and raises the first connection error. """
+    connections = min(connections, DB_POOL_SIZE)
+    if connections <= 0:
+        return 0
+    opened = await asyncio.gather(*(async_engine.connect() for _ in range(connections)), return_exceptions=True)
+    for connection in opened:
+        if not isinstance(connection, BaseException):
+            await connection.close()
+    errors = [connection for connection in opened if isinstance(connection, BaseException)]
+    if errors:
+        raise errors[0]
+    return connections
+
+# seconds the replica's replayed WAL is behind the primary (0 when it has replayed everything it
+# received), and the WAL position it has replayed up to, in bytes
+REPLICA_STATE_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END, "
+    "CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END - '0/0'::pg_lsn"
+)
+
+# the WAL position, in bytes, that the primary has written up to
+WAL_POSITION_QUERY = text("SELECT pg_current_wal_lsn() - '0/0'::pg_lsn")
+
+# stands for a write whose WAL position is not known, e.g. one still queued; no replica has replayed it
+UNKNOWN_POSITION = 2 ** 64
+
+async def measure_replica(replica_engine: AsyncEngine) -> Tuple[float, Optional[int]]:
+    """ Returns the replication lag of a replica in seconds and the WAL position it has replayed.
+    Databases without streaming replication, like a SQLite stand-in, report no lag and no position. """
+    if replica_engine.dialect.name != "postgresql":
+        return 0.0, None
+    async with replica_engine.connect() as connection:
+        lag, position = (await connection.execute(REPLICA_STATE_QUERY)).one()
+        return float(lag), None if position is None else int(position)
+
+class ReplicaRouter:
+    """ Picks the database for read-only work. Reads go round-robin to the replicas whose last
+    measured lag is within max_lag, and to the primary when no replica is fresh enough or there
+    are no replicas at all. A replica is only used once its lag has been measured.
+
+    Read-your-writes works across workers because the client carries it: after a write, the
+    endpoint hands the client the primary's WAL position (see write_position), and reads that
+    send it back only go to replicas that have replayed at least that far. pin_seconds is how
+    long the client keeps the position. """
+
+    def __init__(self, primary: async_sessionmaker, replicas: Dict[str, AsyncEngine], pin_seconds: float = DB_REPLICA_PIN_SECONDS,
+                 max_lag: float = DB_REPLICA_MAX_LAG_SECONDS,
+                 probe: Callable[[AsyncEngine], Awaitable[Tuple[float, Optional[int]]]] = measure_replica):
+        self.primary = primary
+        self.engines = replicas
+        self.sessions = {
+            name: async_sessionmaker(bind=replica_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+            for name, replica_engine in replicas.items()
+        }
+        self.pin_seconds = pin_seconds
+        self.max_lag = max_lag
+        self.probe = probe
+        self.lag: Dict[str, Optional[float]] = {name: None for name in replicas}
+        self.replayed: Dict[str, Optional[int]] = {name: None for name in replicas}
+        self._turn = itertools.count()
+        self.replica_reads = 0
+        self.pinned_reads = 0
+        self.fallback_reads = 0
+        self.lag_check_errors = 0
+
+    async def write_position(self, db: AsyncSession) -> Optional[int]:
+        """ Returns the primary's WAL position after a write committed through db, which the
+        client sends back with its reads; UNKNOWN_POSITION when it cannot be read. None when
+        there are no replicas, since every read goes to the primary anyway. """
+        if not self.engines:
+            return None
+        if db.bind.dialect.name != "postgresql":
+            return UNKNOWN_POSITION
+        return int((await db.execute(WAL_POSITION_QUERY)).scalar())
+
+    def fresh_replicas(self, read_after: Optional[int] = None) -> List[str]:
+        """ Returns the replicas within max_lag that have replayed read_after, when given. """
+        return [name for name, lag in self.lag.items() if lag is not None and lag <= self.max_lag
+                and (read_after is None or (self.replayed[name] is not None and self.replayed[name] >= read_after))]
+
+    def session(self, read_after: Optional[int] = None) -> AsyncSession:
+        """ Returns a new session on a replica, or on the primary when the read must not be
+        stale. read_after is the WAL position of the reader's last write, if it sent one. """
+        if not self.engines:
+            return self.primary()
+        fresh = self.fresh_replicas(read_after)
+        if not fresh:
+            if read_after is not None and self.fresh_replicas():
+                self.pinned_reads += 1
+            else:
+                self.fallback_reads += 1
+            return self.primary()
+        self.replica_reads += 1
+        return self.sessions[fresh[next(self._turn) % len(fresh)]]()
+
+    async def check_lag(self):
+        """ Measures every replica's lag; an unreachable replica is skipped until the next check succeeds. """
+        for name, replica_engine in self.engines.items():
+            try:
+                self.lag[name], self.replayed[name] = await self.probe(replica_engine)
+            except Exception:
+                self.lag[name], self.replayed[name] = None, None
+                self.lag_check_errors += 1
+
+    async def run(self, interval: float = DB_REPLICA_CHECK_SECONDS):
+        """ Re-measures the lag every interval seconds until cancelled. """
+        while True:
+            await self.check_lag()
+            await asyncio.sleep(interval)
+
+    async def dispose(self):
+        for replica_engine in self.engines.values():
+            await replica_engine.dispose()
+
+    def stats(self) -> Dict:
+        return {
+            "replicas": {name: {"lag_s": lag, "replayed": self.replayed[name], "fresh": name in self.fresh_replicas()} for name, lag in self.lag.items()},
+            "max_lag_s": self.max_lag,
+            "pin_s": self.pin_seconds,
+            "replica_reads": self.replica_reads,
+            "pinned_reads": self.pinned_reads,
+            "fallback_reads": self.fallback_reads,
+            "lag_check_errors": self.lag_check_errors,
+        }
+
+replica_router = ReplicaRouter(AsyncSessionLocal, replica_engines)
@@ -0,0 +1,96 @@
+""" Maintenance of the monthly partitions of questionnaire_results.
+
+New partitions are created ahead of time, so inserts never pile up in the default partition;
+rows that did land there are moved into the partition of their month when it is created.
+Historical months are created on demand, e.g. by the bulk importer for the range of each chunk,
+or with --start-month. Old data is removed by detaching and dropping whole partitions instead of
+running DELETEs.
+
+Usage:
+    python -m api.database.partitions [--months-ahead 3] [--start-month 2019-01-01] [--drop-before 2021-09-01]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from datetime import date
+from typing import List, Optional
+from sqlalchemy import text
+
+# months of partitions kept ready beyond the current one
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+
+PARTITION_NAME = re.compile(r"^questionnaire_results_(\d{4})_(\d{2})$")
+
+# from first_month, or the current month when it is NULL, through months_ahead months ahead
+CREATE_PARTITIONS = text(
+    "SELECT create_questionnaire_result_partitions(COALESCE(CAST(:first_month AS date), now()::date), "
+    "(date_trunc('month', now()) + make_interval(months => :months_ahead))::date)"
+)
+
+LIST_PARTITIONS = text("""
+SELECT child.relname
+FROM pg_inherits
+JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE parent.relname = 'questionnaire_results'
+""")
+
+def partition_month(name: str) -> Optional[date]:
+    """ Returns the first day of the month a partition holds, or None for the default partition. """
+    match = PARTITION_NAME.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def ensure_partitions(connection, months_ahead: int = PARTITION_MONTHS_AHEAD, first_month: Optional[date] = None) -> int:
+    """ Creates the partitions of first_month (the current month by default) through months_ahead
+    months ahead that do not exist yet, and commits. Returns the number created. """
+    created = connection.execute(CREATE_PARTITIONS, {"months_ahead": months_ahead, "first_month": first_month}).scalar()
+    connection.commit()
+    return created
+
+async def ensure_partitions_async(connection, months_ahead: int = PARTITION_MONTHS_AHEAD) -> int:
+    """ Async counterpart of ensure_partitions, for an AsyncConnection. """
+    created = (await connection.execute(CREATE_PARTITIONS, {"months_ahead": months_ahead, "first_month": None})).scalar()
+    await connection.commit()
+    return created
+
+def drop_partitions_before(connection, cutoff: date) -> List[str]:
+    """ Drops the partitions of every month that ends on or before cutoff, together with the
+    uniqueness keys of their results, and commits. The cohort rollups keep their totals.
+    Returns the names of the dropped partitions. """
+    dropped = []
+    for (name,) in connection.execute(LIST_PARTITIONS).all():
+        month = partition_month(name)
+        if month is None or month >= cutoff.replace(day=1):
+            continue
+        connection.execute(text(f'ALTER TABLE questionnaire_results DETACH PARTITION "{name}"'))
+        connection.execute(text(f'DROP TABLE "{name}"'))
+        connection.execute(text('DELETE FROM questionnaire_result_keys WHERE "timestamp" >= :start AND "timestamp" < :end'),
+                           {"start": month, "end": next_month(month)})
+        dropped.append(name)
+    connection.commit()
+    return sorted(dropped)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Create upcoming and drop expired questionnaire_results partitions.")
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD, help="months of partitions to keep ready beyond the current one")
+    parser.add_argument("--start-month", type=date.fromisoformat, default=None,
+                        help="also create the partitions from this month on (YYYY-MM-DD), e.g. before importing history")
+    parser.add_argument("--drop-before", type=date.fromisoformat, default=None,
+                        help="drop the partitions of months that end on or before this date (YYYY-MM-DD)")
+    args = parser.parse_args(argv)
+
+    from .database import engine
+    with engine.connect() as connection:
+        summary = {"created": ensure_partitions(connection, args.months_ahead, args.start_month)}
+        if args.drop_before is not None:
+            summary["dropped"] = drop_partitions_before(connection, args.drop_before)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import threading
+import time
+from typing import Dict
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+
+# connection pool telemetry, recorded through SQLAlchemy pool events
+
+class PoolStats:
+    """ Counters for a single connection pool. Updated from pool events and from the
+    timed checkout in InstrumentedQueuePool, read through snapshot(). """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.checkout_timeouts = 0
+        self.overflow_checkouts = 0
+        self.max_checked_out = 0
+        self.max_overflow_in_use = 0
+        self.wait_total_s = 0.0
+        self.wait_max_s = 0.0
+        self.hold_total_s = 0.0
+        self.hold_max_s = 0.0
+        self.age_at_checkout_total_s = 0.0
+        self.age_at_checkout_max_s = 0.0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.wait_total_s += seconds
+            self.wait_max_s = max(self.wait_max_s, seconds)
+            if timed_out:
+                self.checkout_timeouts += 1
+
+    def record_checkout(self, pool: Pool, age_s: float):
+        checked_out = pool.checkedout()
+        overflow = pool.overflow() if isinstance(pool, QueuePool) else 0
+        with self._lock:
+            self.checkouts += 1
+            self.max_checked_out = max(self.max_checked_out, checked_out)
+            if overflow > 0:
+                self.overflow_checkouts += 1
+                self.max_overflow_in_use = max(self.max_overflow_in_use, overflow)
+            self.age_at_checkout_total_s += age_s
+            self.age_at_checkout_max_s = max(self.age_at_checkout_max_s, age_s)
+
+    def record_checkin(self, hold_s: float):
+        with self._lock:
+            self.checkins += 1
+            self.hold_total_s += hold_s
+            self.hold_max_s = max(self.hold_max_s, hold_s)
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def record_invalidate(self):
+        with self._lock:
+            self.invalidations += 1
+
+    def snapshot(self, pool: Pool) -> Dict:
+        """ Returns the counters together with the current state and settings of the pool. """
+        with self._lock:
+            checkouts = self.checkouts or 1
+            checkins = self.checkins or 1
+            stats = {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "checkout_timeouts": self.checkout_timeouts,
+                "overflow_checkouts": self.overflow_checkouts,
+                "max_checked_out": self.max_checked_out,
+                "max_overflow_in_use": self.max_overflow_in_use,
+                "wait_avg_ms": round(self.wait_total_s / checkouts * 1000, 3),
+                "wait_max_ms": round(self.wait_max_s * 1000, 3),
+                "hold_avg_ms": round(self.hold_total_s / checkins * 1000, 3),
+                "hold_max_ms": round(self.hold_max_s * 1000, 3),
+                "connection_age_avg_s": round(self.age_at_checkout_total_s / checkouts, 3),
+                "connection_age_max_s": round(self.age_at_checkout_max_s, 3),
+            }
+        if isinstance(pool, QueuePool):
+            stats.update({
+                "pool_size": pool.size(),
+                "max_overflow": pool._max_overflow,
+                "timeout_s": pool.timeout(),
+                "recycle_s": pool._recycle,
+                "pre_ping": pool._pre_ping,
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow_in_use": max(pool.overflow(), 0),
+            })
+        return stats
+
+
+class _TimedCheckoutMixin:
+    """ Times every checkout, including the time spent waiting for a free connection. """
+    stats: PoolStats = None
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            if self.stats is not None:
+                self.stats.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        if self.stats is not None:
+            self.stats.record_wait(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        # engine.dispose() replaces the pool; keep recording into the same stats
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+class InstrumentedQueuePool(_TimedCheckoutMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(_TimedCheckoutMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+# registry of instrumented engines by name, read by the internal pool stats endpoint
+_registry: Dict[str, tuple] = {}
+
+def register_engine(name: str, engine) -> PoolStats:
+    """ Instruments the pool of a sync engine (or the sync_engine of an async one) and
+    registers the listeners that feed its PoolStats. """
+    stats = PoolStats(name)
+    engine.pool.stats = stats
+
+    @event.listens_for(engine.pool, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info["connected_at"] = time.monotonic()
+        stats.record_connect()
+
+    @event.listens_for(engine.pool, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        now = time.monotonic()
+        connection_record.info["checked_out_at"] = now
+        stats.record_checkout(engine.pool, now - connection_record.info.get("connected_at", now))
+
+    @event.listens_for(engine.pool, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is not None:
+            stats.record_checkin(time.monotonic() - checked_out_at)
+
+    @event.listens_for(engine.pool, "invalidate")
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        stats.record_invalidate()
+
+    _registry[name] = (stats, engine)
+    return stats
+
+def pool_stats() -> Dict[str, Dict]:
+    """ Returns a snapshot of every registered pool, keyed by name. """
+    return {name: stats.snapshot(engine.pool) for name, (stats, engine) in _registry.items()}
@@ -0,0 +1,234 @@
+""" Re-scoring of stored questionnaire results after the scoring config changed.
+
+Reads questionnaire_results in primary-key order, chunk by chunk, and recomputes score and
+classification with calculate_risk_score_batch in a pool of worker processes. Each chunk
+is written back with one UPDATE ... FROM (VALUES ...), which also records the version of
+the config used, and the last id written is checkpointed so an interrupted run resumes where
+it stopped. Rows already scored with the config's version are skipped, and rows missing the
+data their gender needs are left as they are. Once every row is done, the cohort rollups and
+the percentile sketches are rebuilt from the new scores.
+
+Reload the API's config (SIGHUP) before running, so new results use the same version.
+
+Usage:
+    python -m api.database.rescore [--config api/config/config.json] [--workers 4] [--chunk-size 5000] [--dry-run]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+from psycopg2.extras import execute_values
+from ..services import services as srv
+
+# id, timestamp, gender, vo2max, bmi, fmi, tv_hours, score, classification
+Row = Tuple
+# id, timestamp, new score, new classification, error
+Scored = Tuple[int, datetime, Optional[int], Optional[str], Optional[str]]
+
+SELECT_CHUNK = """
+SELECT id, "timestamp", gender, vo2max, bmi, fmi, tv_hours, score, classification
+FROM questionnaire_results
+WHERE id > %s AND config_version IS DISTINCT FROM %s
+ORDER BY id
+LIMIT %s
+"""
+
+UPDATE_CHUNK = """
+UPDATE questionnaire_results AS r
+SET score = v.score, classification = v.classification, config_version = v.config_version
+FROM (VALUES %s) AS v (id, "timestamp", score, classification, config_version)
+WHERE r.id = v.id AND r."timestamp" = v."timestamp"
+"""
+
+def _init_worker(config_path: str):
+    srv.reload_scoring_config(config_path)
+
+def score_chunk(rows: Sequence[Row]) -> Tuple[str, List[Scored]]:
+    """ Recomputes a chunk of rows against the active config. Returns the config version
+    and, per row, the new score and classification or the reason it cannot be scored. """
+    version = srv.get_scoring_config().version
+    results = srv.calculate_risk_score_batch(
+        [row[2] for row in rows],
+        [float(row[3]) for row in rows],
+        [float(row[4]) if row[4] is not None else None for row in rows],
+        [float(row[5]) if row[5] is not None else None for row in rows],
+        [float(row[6]) if row[6] is not None else None for row in rows],
+    )
+    return version, [(row[0], row[1], result["risk_score"], result["classification"], result["error"]) for row, result in zip(rows, results)]
+
+class RescoreReport:
+    """ Running totals and the diff summary of a re-scoring run. """
+
+    def __init__(self, totals: Optional[Dict] = None):
+        self.started_at = time.perf_counter()
+        totals = totals or {}
+        self.rows_read = totals.get("rows_read", 0)
+        self.rows_changed = totals.get("rows_changed", 0)
+        self.score_changed = totals.get("score_changed", 0)
+        self.classification_changed = Counter(totals.get("classification_changed", {}))
+        self.unscorable = Counter(totals.get("unscorable", {}))
+        self.score_delta_min = totals.get("score_delta_min")
+        self.score_delta_max = totals.get("score_delta_max")
+        self.rows_this_run = 0
+
+    def add(self, rows: Sequence[Row], scored: Sequence[Scored]):
+        for row, (_, _, score, classification, error) in zip(rows, scored):
+            self.rows_read += 1
+            self.rows_this_run += 1
+            if error is not None:
+                self.unscorable[error] += 1
+                continue
+            if score == row[7] and classification == row[8]:
+                continue
+            self.rows_changed += 1
+            if score != row[7]:
+                self.score_changed += 1
+                delta = score - row[7]
+                self.score_delta_min = delta if self.score_delta_min is None else min(self.score_delta_min, delta)
+                self.score_delta_max = delta if self.score_delta_max is None else max(self.score_delta_max, delta)
+            if classification != row[8]:
+                self.classification_changed[f"{row[8]} -> {classification}"] += 1
+
+    @property
+    def elapsed_s(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_this_run / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    def totals(self) -> Dict:
+        return {
+            "rows_read": self.rows_read,
+            "rows_changed": self.rows_changed,
+            "score_changed": self.score_changed,
+            "classification_changed": dict(self.classification_changed),
+            "unscorable": dict(self.unscorable),
+            "score_delta_min": self.score_delta_min,
+            "score_delta_max": self.score_delta_max,
+        }
+
+    def summary(self) -> Dict:
+        return {**self.totals(), "rows_this_run": self.rows_this_run, "elapsed_s": round(self.elapsed_s, 3),
+                "rows_per_second": round(self.rows_per_second, 1)}
+
+def load_checkpoint(path: str, version: str) -> Tuple[int, Optional[Dict]]:
+    """ Returns the last id written and the totals so far of an interrupted run with the same
+    config version, or (0, None) to start over. """
+    if not os.path.exists(path):
+        return 0, None
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint.get("config_version") != version:
+        return 0, None
+    return checkpoint["last_id"], checkpoint["totals"]
+
+def save_checkpoint(path: str, version: str, last_id: int, report: RescoreReport, done: bool = False):
+    """ Writes the checkpoint atomically, so an interruption never leaves a torn file. """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as checkpoint_file:
+        json.dump({"config_version": version, "last_id": last_id, "done": done, "totals": report.totals(),
+                   "updated_at": datetime.utcnow().isoformat()}, checkpoint_file)
+    os.replace(temporary_path, path)
+
+def fetch_chunk(connection, after_id: int, version: str, chunk_size: int) -> List[Row]:
+    with connection.cursor() as cursor:
+        cursor.execute(SELECT_CHUNK, (after_id, version, chunk_size))
+        rows = cursor.fetchall()
+    connection.commit()
+    return rows
+
+def write_chunk(connection, scored: Sequence[Scored], version: str) -> int:
+    """ Writes the new scores of a chunk in one statement and commits. Returns the rows updated. """
+    values = [(row_id, timestamp, score, classification, version)
+              for row_id, timestamp, score, classification, error in scored if error is None]
+    if values:
+        with connection.cursor() as cursor:
+            execute_values(cursor, UPDATE_CHUNK, values, template="(%s, %s::timestamp, %s, %s, %s)", page_size=len(values))
+    connection.commit()
+    return len(values)
+
+def rescore(connection, config_path: str, workers: int, chunk_size: int = 5000, dry_run: bool = False,
+            checkpoint_path: Optional[str] = None, progress=None) -> RescoreReport:
+    """ Re-scores every row not yet scored with the config at config_path through a psycopg2
+    connection. Keeps up to two chunks per worker in flight while writing back in id order,
+    so the checkpoint always marks a prefix of the table as done. """
+    version = srv.load_scoring_config(config_path).version
+    last_id, totals = (0, None)
+    if checkpoint_path and not dry_run:
+        last_id, totals = load_checkpoint(checkpoint_path, version)
+    report = RescoreReport(totals)
+
+    in_flight = deque()
+    read_up_to = last_id
+    exhausted = False
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(config_path, )) as pool:
+        while True:
+            while not exhausted and len(in_flight) < workers * 2:
+                rows = fetch_chunk(connection, read_up_to, version, chunk_size)
+                if not rows:
+                    exhausted = True
+                    break
+                read_up_to = rows[-1][0]
+                in_flight.append((rows, pool.submit(score_chunk, rows)))
+            if not in_flight:
+                break
+            rows, future = in_flight.popleft()
+            used_version, scored = future.result()
+            if used_version != version:
+                raise RuntimeError(f"A worker scored with config version {used_version} instead of {version}.")
+            report.add(rows, scored)
+            if not dry_run:
+                write_chunk(connection, scored, version)
+                if checkpoint_path:
+                    save_checkpoint(checkpoint_path, version, rows[-1][0], report)
+            if progress is not None:
+                progress(report)
+    if checkpoint_path and not dry_run:
+        save_checkpoint(checkpoint_path, version, read_up_to, report, done=True)
+    return report
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Re-score stored questionnaire results with the current scoring config.")
+    parser.add_argument("--config", default=srv.SCORING_CONFIG_PATH, help="scoring config to score with")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="scoring processes")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="rows per read, scoring task and UPDATE")
+    parser.add_argument("--checkpoint", default="rescore.checkpoint.json", help="progress file an interrupted run resumes from")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would change, without writing")
+    args = parser.parse_args(argv)
+
+    from .crud import rebuild_rollups
+    from .database import SessionLocal, engine
+    from .sketches import rebuild as rebuild_sketches
+
+    def progress(report: RescoreReport):
+        print(f"{report.rows_read} rows, {report.rows_changed} changed, {report.rows_per_second:.0f} rows/s", file=sys.stderr)
+
+    connection = engine.raw_connection()
+    try:
+        report = rescore(connection, args.config, max(1, args.workers), chunk_size=args.chunk_size,
+                         dry_run=args.dry_run, checkpoint_path=args.checkpoint, progress=progress)
+    finally:
+        connection.close()
+
+    summary = report.summary()
+    if not args.dry_run and report.rows_changed:
+        # the rollups and sketches summarise scores and classifications, so they are rebuilt from the new ones
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            rebuild_rollups(db)
+            rebuild_sketches(db)
+        finally:
+            db.close()
+        summary["rebuild_s"] = round(time.perf_counter() - started, 3)
+    print(json.dumps({"dry_run": args.dry_run, "config_version": srv.load_scoring_config(args.config).version, **summary}, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
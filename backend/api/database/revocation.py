@@ -0,0 +1,159 @@
+""" Revocation of access tokens before their expiry, e.g. on logout.
+
+Revoked token ids (the jti claim) are stored in revoked_tokens until the token expires.
+Each worker keeps a Bloom filter of them plus an exact set of the ones it learnt since the
+filter was built, so checking a token that was not revoked, the common case, needs no query:
+only the rare false positive of the filter is confirmed against the database. Every
+REVOCATION_REFRESH_SECONDS the worker reads the rows added since its last read; every
+REVOCATION_PRUNE_SECONDS it deletes the expired rows and rebuilds the filter from the rest.
+
+A token revoked in another worker is rejected here within REVOCATION_REFRESH_SECONDS.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..helpers.bloom import BloomFilter
+from ..helpers.cache import TTLCache
+from . import schemas
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+REVOCATION_REFRESH_SECONDS = float(os.getenv("REVOCATION_REFRESH_SECONDS", "5"))
+REVOCATION_PRUNE_SECONDS = float(os.getenv("REVOCATION_PRUNE_SECONDS", "300"))
+REVOCATION_BLOOM_CAPACITY = int(os.getenv("REVOCATION_BLOOM_CAPACITY", "100000"))
+REVOCATION_BLOOM_ERROR_RATE = float(os.getenv("REVOCATION_BLOOM_ERROR_RATE", "0.001"))
+
+# revoked_at is set when a row is inserted, but transactions commit in any order, so each
+# refresh reads this far behind the newest row it has seen
+REFRESH_OVERLAP = timedelta(seconds=10)
+
+class RevocationList:
+    """ The revoked token ids known to one worker: filter holds those loaded when it was
+    built, recent (jti to expiry) those revoked or read since. """
+
+    def __init__(self, capacity: int = REVOCATION_BLOOM_CAPACITY, error_rate: float = REVOCATION_BLOOM_ERROR_RATE,
+                 refresh_seconds: float = REVOCATION_REFRESH_SECONDS):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filter = BloomFilter(capacity, error_rate)
+        self.recent: Dict[str, datetime] = {}
+        # answers of the database for filter hits, kept no longer than a refresh interval
+        self.confirmed = TTLCache(maxsize=10000, ttl=refresh_seconds)
+        self.watermark: Optional[datetime] = None
+        self.checks = 0
+        self.filter_hits = 0
+        self.db_checks = 0
+        self.revoked_hits = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.pruned = 0
+
+    @property
+    def active(self) -> bool:
+        """ Whether any token is known to be revoked, so callers can skip reading the jti otherwise. """
+        return bool(self.recent) or len(self.filter) > 0
+
+    async def is_revoked(self, db: AsyncSession, jti: str) -> bool:
+        """ Returns whether the token with this jti was revoked. Queries the database only when
+        the filter matches a jti it has not seen in recent. """
+        self.checks += 1
+        if jti in self.recent:
+            self.revoked_hits += 1
+            return True
+        if jti not in self.filter:
+            return False
+        self.filter_hits += 1
+        revoked = self.confirmed.get(jti)
+        if revoked is None:
+            self.db_checks += 1
+            revoked = (await db.execute(select(schemas.RevokedToken.jti).filter(schemas.RevokedToken.jti == jti))).first() is not None
+            self.confirmed.set(jti, revoked)
+        if revoked:
+            self.revoked_hits += 1
+        return revoked
+
+    async def revoke(self, db: AsyncSession, jti: str, expires_at: datetime):
+        """ Stores the jti until expires_at and rejects it in this worker at once. """
+        await db.execute(pg_insert(schemas.RevokedToken).values(jti=jti, expires_at=expires_at)
+                         .on_conflict_do_nothing(index_elements=["jti"]))
+        await db.commit()
+        self.recent[jti] = expires_at
+
+    async def refresh(self, db: AsyncSession):
+        """ Adds the rows stored since the last refresh, by any worker, to recent. """
+        token = schemas.RevokedToken
+        statement = select(token.jti, token.expires_at, token.revoked_at)
+        if self.watermark is not None:
+            statement = statement.filter(token.revoked_at > self.watermark - REFRESH_OVERLAP)
+        now = datetime.utcnow()
+        for jti, expires_at, revoked_at in (await db.execute(statement)).all():
+            # a filter match is confirmed against the database on check, so it needs no entry here
+            if expires_at > now and jti not in self.filter:
+                self.recent[jti] = expires_at
+            if self.watermark is None or revoked_at > self.watermark:
+                self.watermark = revoked_at
+        self.refreshes += 1
+
+    async def load(self, db: AsyncSession):
+        """ Rebuilds the filter from every unexpired row and keeps in recent only what the rows
+        did not include yet. The filter grows beyond capacity when there are more rows. """
+        token = schemas.RevokedToken
+        now = datetime.utcnow()
+        rows = (await db.execute(select(token.jti, token.revoked_at).filter(token.expires_at > now))).all()
+        bloom = BloomFilter(max(self.capacity, 2 * len(rows)), self.error_rate)
+        loaded = set()
+        for jti, revoked_at in rows:
+            bloom.add(jti)
+            loaded.add(jti)
+            if self.watermark is None or revoked_at > self.watermark:
+                self.watermark = revoked_at
+        self.filter = bloom
+        # revocations made while the rows were read are not in them
+        self.recent = {jti: expires_at for jti, expires_at in self.recent.items() if jti not in loaded and expires_at > now}
+        self.refreshes += 1
+
+    async def prune(self, db: AsyncSession):
+        """ Deletes the rows of tokens that have expired anyway. """
+        result = await db.execute(delete(schemas.RevokedToken).filter(schemas.RevokedToken.expires_at <= datetime.utcnow()))
+        await db.commit()
+        self.pruned += result.rowcount or 0
+
+    async def run(self, refresh_seconds: float = REVOCATION_REFRESH_SECONDS, prune_seconds: float = REVOCATION_PRUNE_SECONDS):
+        """ Refreshes every refresh_seconds, and prunes and rebuilds every prune_seconds, until cancelled. """
+        pruned_at = time.monotonic()
+        while True:
+            await asyncio.sleep(refresh_seconds)
+            try:
+                async with AsyncSessionLocal() as db:
+                    if time.monotonic() - pruned_at >= prune_seconds:
+                        await self.prune(db)
+                        await self.load(db)
+                        pruned_at = time.monotonic()
+                    else:
+                        await self.refresh(db)
+            except Exception as e:
+                self.refresh_errors += 1
+                logger.warning("revocation_refresh_failed", extra={"fields": {"error": type(e).__name__, "detail": str(e)}})
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "filter_keys": len(self.filter),
+            "filter_bytes": len(self.filter.bits),
+            "recent": len(self.recent),
+            "checks": self.checks,
+            "filter_hits": self.filter_hits,
+            "db_checks": self.db_checks,
+            "revoked_hits": self.revoked_hits,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "pruned": self.pruned,
+        }
+
+revocation_list = RevocationList()
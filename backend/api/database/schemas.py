@@ -1,4 +1,4 @@
-from sqlalchemy import JSON, Column, ForeignKey, Integer, Numeric, String, Boolean, UniqueConstraint, func, DateTime
+from sqlalchemy import JSON, Column, Date, ForeignKey, Index, Integer, Numeric, String, Boolean, func, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -17,9 +17,13 @@ class User(Base):
 
 
 class QuestionnaireResult(Base):
+    """ Range-partitioned by month of timestamp, see migration e2a7c4d90f16. Queries that
+    filter on timestamp only touch the partitions of the months they ask for. A partitioned
+    table cannot enforce uniqueness without the partition key, so (questionnaire_id, user_id)
+    is guarded by questionnaire_result_keys, which every insert goes through. """
     __tablename__ = 'questionnaire_results'
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     questionnaire_id = Column(String, index=True, nullable=False)
     gender = Column(String, nullable=False)
@@ -29,10 +33,69 @@ class QuestionnaireResult(Base):
     tv_hours = Column(Numeric)
     score = Column(Integer, nullable=False)
     classification = Column(String, nullable=False)
-    timestamp = Column(DateTime, server_default=func.now())
+    timestamp = Column(DateTime, primary_key=True, nullable=False, server_default=func.now())
+    # version of the scoring config that produced score and classification, when known
+    config_version = Column(String)
 
     user = relationship('User', back_populates='questionnaire_results')
 
     __table_args__ = (
-        UniqueConstraint('questionnaire_id', 'user_id'),
-    )
\ No newline at end of file
+        # keyset pagination of a user's results, newest first
+        Index('ix_questionnaire_results_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
+
+class QuestionnaireResultKey(Base):
+    """ One row per stored questionnaire result, enforcing that a user submits each
+    questionnaire only once across all partitions. timestamp is the result's partition key,
+    so a result can be looked up from its key, and keys can be dropped with old partitions. """
+    __tablename__ = 'questionnaire_result_keys'
+
+    questionnaire_id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    timestamp = Column(DateTime, nullable=False, index=True, server_default=func.now())
+
+
+class QuestionnaireResultRollup(Base):
+    """ Running sums per (month, gender, classification), kept up to date on every insert
+    into questionnaire_results so cohort summaries never scan the raw table. """
+    __tablename__ = 'questionnaire_result_rollups'
+
+    month = Column(Date, primary_key=True)
+    gender = Column(String, primary_key=True)
+    classification = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    score_sum = Column(Numeric, nullable=False, default=0)
+    score_sumsq = Column(Numeric, nullable=False, default=0)
+    vo2max_sum = Column(Numeric, nullable=False, default=0)
+    vo2max_sumsq = Column(Numeric, nullable=False, default=0)
+    bmi_count = Column(Integer, nullable=False, default=0)
+    bmi_sum = Column(Numeric, nullable=False, default=0)
+    bmi_sumsq = Column(Numeric, nullable=False, default=0)
+    fmi_count = Column(Integer, nullable=False, default=0)
+    fmi_sum = Column(Numeric, nullable=False, default=0)
+    fmi_sumsq = Column(Numeric, nullable=False, default=0)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class QuestionnaireResultSketch(Base):
+    """ t-digest of one measurement over every stored questionnaire result of one gender,
+    for percentile ranks. Each worker merges the values it wrote into it periodically. """
+    __tablename__ = 'questionnaire_result_sketches'
+
+    metric = Column(String, primary_key=True)
+    gender = Column(String, primary_key=True)
+    digest = Column(JSON, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class RevokedToken(Base):
+    """ The jti of every access token revoked before its expiry. Workers keep these in memory,
+    see api.database.revocation; rows are pruned once the token has expired anyway. """
+    __tablename__ = 'revoked_tokens'
+
+    jti = Column(String, primary_key=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    revoked_at = Column(DateTime, nullable=False, index=True, server_default=func.now())
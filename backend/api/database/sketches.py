@@ -0,0 +1,173 @@
+""" Percentile sketches of bmi, fmi, vo2max and score per gender.
+
+Every worker adds the results it stores to in-memory t-digests, so percentile ranks are
+answered from memory in O(log compression) and include the worker's own writes at once.
+Every SKETCH_PERSIST_SECONDS the worker merges what it added into the shared sketch rows,
+under a row lock, and reloads the merged sketches, which then include every worker's writes.
+A worker that crashes loses what it added since its last persist; rebuilding repairs that.
+
+Results loaded by api.database.bulk_import reach the sketches on the next rebuild. A rebuild
+locks the sketch rows' table, so persists wait for it instead of being lost or conflicting with
+the new rows; values written by the API within the last persist interval may still be counted
+twice, since the workers persist them after the rebuild has read them.
+
+Usage:
+    python -m api.database.sketches --rebuild
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import delete, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from ..helpers.sketch import TDigest
+from . import schemas
+from .database import AsyncSessionLocal, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+SKETCH_METRICS = ("bmi", "fmi", "vo2max", "score")
+SKETCH_COMPRESSION = float(os.getenv("SKETCH_COMPRESSION", "100"))
+SKETCH_PERSIST_SECONDS = float(os.getenv("SKETCH_PERSIST_SECONDS", "30"))
+
+Key = Tuple[str, str]
+
+# blocks the workers' persists, but not their loads, until a rebuild commits
+LOCK_SKETCHES = "LOCK TABLE questionnaire_result_sketches IN EXCLUSIVE MODE"
+
+def sketch_values(result) -> Iterator[Tuple[Key, float]]:
+    """ Yields ((metric, gender), value) for every measurement a result has. """
+    gender = result.gender.value if hasattr(result.gender, "value") else result.gender
+    for metric in SKETCH_METRICS:
+        value = getattr(result, metric)
+        if value is not None:
+            yield (metric, gender), float(value)
+
+class SketchStore:
+    """ The sketches of one worker: view holds the merged sketches as last loaded plus what
+    this worker added since, pending only what it added since its last persist. """
+
+    def __init__(self, compression: float = SKETCH_COMPRESSION):
+        self.compression = compression
+        self.view: Dict[Key, TDigest] = {}
+        self.pending: Dict[Key, TDigest] = {}
+        self.values_recorded = 0
+        self.persists = 0
+        self.persist_errors = 0
+
+    def record(self, result):
+        """ Adds a stored result's measurements. Runs on the event loop, so it needs no lock. """
+        for key, value in sketch_values(result):
+            self.pending.setdefault(key, TDigest(self.compression)).add(value)
+            self.view.setdefault(key, TDigest(self.compression)).add(value)
+            self.values_recorded += 1
+
+    def percentile_rank(self, metric: str, gender: str, value: float) -> Tuple[Optional[float], int]:
+        """ Returns the percentage of results of gender whose metric is at or below value, and
+        how many results that is out of; (None, 0) when there are none. """
+        digest = self.view.get((metric, gender))
+        if digest is None or not digest.count:
+            return None, 0
+        return round(digest.cdf(value) * 100, 2), int(digest.count)
+
+    async def persist(self, db: AsyncSession):
+        """ Merges the pending values into the shared sketch rows in one transaction. Rows are
+        locked in key order, so workers persisting at the same time cannot deadlock. """
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        sketch = schemas.QuestionnaireResultSketch
+        try:
+            for metric, gender in sorted(pending):
+                await db.execute(pg_insert(sketch).values(metric=metric, gender=gender, digest=TDigest(self.compression).to_dict(), count=0)
+                                 .on_conflict_do_nothing(index_elements=["metric", "gender"]))
+                row = (await db.execute(select(sketch).filter(sketch.metric == metric, sketch.gender == gender).with_for_update())).scalar_one()
+                digest = TDigest.from_dict(row.digest)
+                digest.merge(pending[(metric, gender)])
+                row.digest = digest.to_dict()
+                row.count = int(digest.count)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            # keep the values for the next attempt
+            for key, digest in pending.items():
+                self.pending.setdefault(key, TDigest(self.compression)).merge(digest)
+            self.persist_errors += 1
+            raise
+        self.persists += 1
+
+    async def load(self, db: AsyncSession):
+        """ Replaces the view with the shared sketches plus what is still pending here. """
+        rows = (await db.execute(select(schemas.QuestionnaireResultSketch))).scalars().all()
+        view = {(row.metric, row.gender): TDigest.from_dict(row.digest) for row in rows}
+        for key, digest in self.pending.items():
+            view.setdefault(key, TDigest(self.compression)).merge(digest)
+        self.view = view
+
+    async def sync(self, reload: bool = True):
+        """ Persists the pending values, then reloads the merged sketches unless reload is false. """
+        async with AsyncSessionLocal() as db:
+            await self.persist(db)
+            if reload:
+                await self.load(db)
+
+    async def run(self, interval: float = SKETCH_PERSIST_SECONDS):
+        """ Syncs every interval seconds until cancelled. """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.warning("sketch_sync_failed", extra={"fields": {"error": type(e).__name__, "detail": str(e)}})
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "sketches": len(self.view),
+            "centroids": sum(len(digest) for digest in self.view.values()),
+            "pending_values": int(sum(digest.count for digest in self.pending.values())),
+            "values_recorded": self.values_recorded,
+            "persists": self.persists,
+            "persist_errors": self.persist_errors,
+        }
+
+sketch_store = SketchStore()
+
+def rebuild(db: Session, compression: float = SKETCH_COMPRESSION, batch_size: int = 5000) -> Dict[Key, TDigest]:
+    """ Rebuilds every sketch from questionnaire_results in one pass and replaces the stored
+    ones in one transaction, locked against concurrent persists. Returns the new sketches. """
+    db.execute(text(LOCK_SKETCHES))
+    result = schemas.QuestionnaireResult
+    digests: Dict[Key, TDigest] = {}
+    statement = select(result.gender, *(getattr(result, metric) for metric in SKETCH_METRICS)).execution_options(yield_per=batch_size)
+    for row in db.execute(statement):
+        for key, value in sketch_values(row):
+            digests.setdefault(key, TDigest(compression)).add(value)
+    db.execute(delete(schemas.QuestionnaireResultSketch))
+    db.add_all(schemas.QuestionnaireResultSketch(metric=metric, gender=gender, digest=digest.to_dict(), count=int(digest.count))
+               for (metric, gender), digest in digests.items())
+    db.commit()
+    return digests
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Maintain the percentile sketches of questionnaire results.")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild every sketch from questionnaire_results")
+    args = parser.parse_args(argv)
+    if not args.rebuild:
+        parser.print_help()
+        return 2
+
+    db = SessionLocal()
+    try:
+        digests = rebuild(db)
+    finally:
+        db.close()
+    print(json.dumps({f"{metric}/{gender}": int(digest.count) for (metric, gender), digest in sorted(digests.items())}, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from .. import models
+from ..helpers.exceptions import SubmissionQueueFullError
+from . import async_crud
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# write-behind for questionnaire submissions:
+#   off    every submission is inserted and committed on its own (default)
+#   sync   submissions are batched, and each request is answered once its batch is committed
+#   async  requests are answered with 202 as soon as the submission is queued; a crash loses the queue
+WRITE_BEHIND_MODE = os.getenv("WRITE_BEHIND_MODE", "off").lower()
+WRITE_BEHIND_MODES = ("off", "sync", "async")
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "200"))
+WRITE_BEHIND_MAX_DELAY_MS = float(os.getenv("WRITE_BEHIND_MAX_DELAY_MS", "20"))
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "5000"))
+
+Submission = Tuple[str, models.QuestionnaireResultCreate]
+Outcome = Union[models.QuestionnaireResultResponse, Exception]
+
+async def flush_to_database(submissions: Sequence[Submission]) -> List[Outcome]:
+    """ Writes a batch of submissions in one transaction. """
+    async with AsyncSessionLocal() as db:
+        return await async_crud.create_questionnaire_results(db, submissions)
+
+_STOP = object()
+
+class SubmissionBatcher:
+    """ Queues submissions in-process and writes them in batches of up to max_batch, at most
+    max_delay seconds after the first submission of a batch arrived. Each submission gets a
+    future that resolves to its stored result or to its own error, e.g. a unique-constraint
+    conflict, so one bad row never fails the rest of its batch. """
+
+    def __init__(self, flush: Callable[[Sequence[Submission]], Awaitable[List[Outcome]]] = flush_to_database,
+                 max_batch: int = WRITE_BEHIND_MAX_BATCH, max_delay: float = WRITE_BEHIND_MAX_DELAY_MS / 1000,
+                 max_queue: int = WRITE_BEHIND_MAX_QUEUE):
+        self.flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._accepting = False
+        self.batches = 0
+        self.rows_written = 0
+        self.rows_rejected = 0
+        self.rows_failed = 0
+        self.flush_total_s = 0.0
+        self.flush_max_s = 0.0
+
+    def start(self):
+        """ Starts the flusher on the running event loop. """
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="write-behind")
+        self._accepting = True
+
+    async def stop(self):
+        """ Stops accepting submissions and waits until everything queued has been written. """
+        if self._task is None:
+            return
+        self._accepting = False
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    def submit(self, user_email: str, result: models.QuestionnaireResultCreate) -> asyncio.Future:
+        """ Queues a submission and returns the future of its outcome. Raises SubmissionQueueFullError
+        when the queue is full or the batcher is not running. """
+        if not self._accepting:
+            raise SubmissionQueueFullError("Submissions are not being accepted right now. Please try again shortly.")
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((user_email, result, future))
+        except asyncio.QueueFull:
+            raise SubmissionQueueFullError("Too many submissions are waiting to be stored. Please try again shortly.")
+        return future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+        # graceful shutdown: write whatever is still queued
+        remaining = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                remaining.append(item)
+        for start in range(0, len(remaining), self.max_batch):
+            await self._flush(remaining[start:start + self.max_batch])
+
+    async def _flush(self, batch: List[Tuple[str, models.QuestionnaireResultCreate, asyncio.Future]]):
+        started = time.perf_counter()
+        try:
+            outcomes = await self.flush([(email, result) for email, result, _ in batch])
+        except Exception as e:
+            # the whole transaction failed, e.g. the database is unreachable: every row gets the error
+            logger.exception("write_behind_flush_failed", extra={"fields": {"rows": len(batch), "error": type(e).__name__}})
+            self.rows_failed += len(batch)
+            outcomes = [e] * len(batch)
+        else:
+            self.rows_rejected += sum(isinstance(outcome, Exception) for outcome in outcomes)
+            self.rows_written += sum(not isinstance(outcome, Exception) for outcome in outcomes)
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.flush_total_s += elapsed
+        self.flush_max_s = max(self.flush_max_s, elapsed)
+        for (_, _, future), outcome in zip(batch, outcomes):
+            if future.done():
+                continue
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+    def stats(self) -> Dict[str, float]:
+        """ Returns the queue depth and the batch, row and flush time counters. """
+        batches = self.batches or 1
+        return {
+            "running": self._accepting,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "max_batch": self.max_batch,
+            "max_delay_ms": self.max_delay * 1000,
+            "batches": self.batches,
+            "rows_written": self.rows_written,
+            "rows_rejected": self.rows_rejected,
+            "rows_failed": self.rows_failed,
+            "batch_size_avg": round((self.rows_written + self.rows_rejected + self.rows_failed) / batches, 2),
+            "flush_avg_ms": round(self.flush_total_s / batches * 1000, 3),
+            "flush_max_ms": round(self.flush_max_s * 1000, 3),
+        }
+
+submission_batcher = SubmissionBatcher()
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+class RouteLimit:
+    """ Admission limits of one route: at most max_concurrent requests in flight (None for no
+    limit), and a token bucket of burst requests refilled at rate per second for each key
+    (None for no rate limit). key is 'client' (the client address) or 'user' (the bearer
+    token, falling back to the client address for anonymous requests). """
+
+    def __init__(self, path: str, max_concurrent: Optional[int] = None, rate: Optional[float] = None,
+                 burst: Optional[float] = None, key: str = "client", max_keys: int = 10000):
+        if key not in ("client", "user"):
+            raise ValueError(f"Admission key for {path} must be 'client' or 'user', got {key!r}.")
+        self.path = path
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.key = key
+        self.max_keys = max_keys
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected_concurrency = 0
+        self.rejected_rate = 0
+        # key -> [tokens, last refill], least recently seen first
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    def take_token(self, key: str, now: float) -> float:
+        """ Takes a token from key's bucket. Returns 0 when admitted, otherwise the number of
+        seconds until a token is available. """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            if len(self._buckets) > self.max_keys:
+                # a forgotten key starts over with a full bucket
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+    def stats(self) -> Dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "rate_per_s": self.rate,
+            "burst": self.burst,
+            "key": self.key,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "rejected_concurrency": self.rejected_concurrency,
+            "rejected_rate": self.rejected_rate,
+            "tracked_keys": len(self._buckets),
+        }
+
+def parse_limits(spec: str) -> Dict[str, Dict]:
+    """ Parses ADMISSION_LIMITS, a JSON object mapping a path to its limits, e.g.
+    {"/token": {"max_concurrent": 16, "rate": 5, "burst": 10, "key": "client"}}. """
+    if not spec:
+        return {}
+    limits = json.loads(spec)
+    if not isinstance(limits, dict) or not all(isinstance(value, dict) for value in limits.values()):
+        raise ValueError("ADMISSION_LIMITS must be a JSON object mapping paths to objects.")
+    return limits
+
+class AdmissionControlMiddleware:
+    """ Pure ASGI middleware that sheds load on the expensive routes before any work is done.
+    Requests over a route's concurrency limit get 503, requests over their key's rate get 429,
+    both with Retry-After, instead of queueing without bound behind the bcrypt pool or the
+    database. Runs on the event loop only, so the counters need no lock. """
+
+    def __init__(self, app, limits: Dict[str, RouteLimit]):
+        self.app = app
+        self.limits = limits
+
+    @staticmethod
+    def _key(limit: RouteLimit, scope) -> str:
+        client = scope.get("client")
+        client_key = f"client:{client[0]}" if client else "client:unknown"
+        if limit.key == "user":
+            authorization = next((value for name, value in scope["headers"] if name == b"authorization"), None)
+            if authorization and authorization[:7].lower() == b"bearer ":
+                # keyed on the token itself, since unverified claims could name another user
+                return "user:" + hashlib.blake2b(authorization[7:].strip(), digest_size=12).hexdigest()
+        return client_key
+
+    async def _reject(self, send, status: int, retry_after: float, message: str):
+        body = json.dumps({"detail": {"error": message}}).encode("utf-8")
+        await send({"type": "http.response.start", "status": status, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("latin-1")),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode("latin-1")),
+        ]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" and scope["method"] != "OPTIONS" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        if limit.max_concurrent is not None and limit.in_flight >= limit.max_concurrent:
+            limit.rejected_concurrency += 1
+            await self._reject(send, 503, 1, "Too many concurrent requests to this endpoint. Please try again shortly.")
+            return
+        if limit.rate:
+            wait = limit.take_token(self._key(limit, scope), time.monotonic())
+            if wait > 0:
+                limit.rejected_rate += 1
+                await self._reject(send, 429, wait, "Rate limit exceeded. Please slow down.")
+                return
+
+        limit.admitted += 1
+        limit.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limit.in_flight -= 1
+
+def admission_stats(limits: Dict[str, RouteLimit]) -> Dict[str, Dict]:
+    """ Returns the limits and the admission counters of every limited route. """
+    return {path: limit.stats() for path, limit in list(limits.items())}
@@ -1,5 +1,14 @@
+import hashlib
 import json
-from typing import Dict
+import logging
+import os
+import threading
+import time
+from bisect import bisect_right
+from typing import Callable, Dict, Iterable, Mapping, Optional, Tuple
+from .exceptions import InvalidConfigError
+
+logger = logging.getLogger(__name__)
 
 def load_config(file_path: str) -> Dict:
     try:
@@ -8,4 +17,113 @@ def load_config(file_path: str) -> Dict:
     except FileNotFoundError:
         raise Exception(f"Configuration file {file_path} not found.")
     except json.JSONDecodeError:
-        raise Exception(f"Configuration file {file_path} contains invalid JSON.")
\ No newline at end of file
+        raise Exception(f"Configuration file {file_path} contains invalid JSON.")
+
+class CutoffTable:
+    """ Immutable, sorted cutoff table. A value falls in the first class whose cutoff it is
+    below, found with a single bisect instead of scanning the cutoff dict. """
+    __slots__ = ("bounds", "labels")
+
+    def __init__(self, name: str, cutoffs: Mapping[str, float], known_labels: Optional[Iterable[str]] = None):
+        if not isinstance(cutoffs, Mapping) or not cutoffs:
+            raise InvalidConfigError(f"'{name}' must be a non-empty mapping of classification to cutoff.")
+        bounds = []
+        for label, cutoff in cutoffs.items():
+            if isinstance(cutoff, bool) or not isinstance(cutoff, (int, float)):
+                raise InvalidConfigError(f"Cutoff '{label}' in '{name}' must be a number, got {cutoff!r}.")
+            if bounds and cutoff <= bounds[-1]:
+                raise InvalidConfigError(f"Cutoffs in '{name}' must be strictly increasing, but '{label}' ({cutoff}) does not exceed the previous cutoff ({bounds[-1]}).")
+            bounds.append(float(cutoff))
+        if known_labels is not None:
+            unknown = [label for label in cutoffs if label not in known_labels]
+            if unknown:
+                raise InvalidConfigError(f"Unknown classification(s) {unknown} in '{name}'. Expected one of {sorted(known_labels)}.")
+        object.__setattr__(self, "bounds", tuple(bounds))
+        object.__setattr__(self, "labels", tuple(cutoffs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CutoffTable is immutable")
+
+    def index(self, value: float) -> int:
+        """ Returns the index of the class the value falls in, or len(self) if it is above every cutoff. """
+        return bisect_right(self.bounds, value)
+
+    def classify(self, value: float) -> Optional[str]:
+        """ Returns the classification of the value, or None if it is above every cutoff. """
+        index = bisect_right(self.bounds, value)
+        return self.labels[index] if index < len(self.labels) else None
+
+    def __len__(self) -> int:
+        return len(self.bounds)
+
+class ScoringConfig:
+    """ Compiled, validated and versioned scoring config. Instances are never mutated;
+    a reload builds a new one and swaps the reference. """
+    __slots__ = ("version", "path", "loaded_at", "bmi_cutoffs", "fmi_cutoffs", "risk_cutoffs")
+
+    def __init__(self, version: str, path: Optional[str], bmi_cutoffs: CutoffTable, fmi_cutoffs: CutoffTable, risk_cutoffs: Dict[str, CutoffTable]):
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "path", path)
+        object.__setattr__(self, "loaded_at", time.time())
+        object.__setattr__(self, "bmi_cutoffs", bmi_cutoffs)
+        object.__setattr__(self, "fmi_cutoffs", fmi_cutoffs)
+        object.__setattr__(self, "risk_cutoffs", risk_cutoffs)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ScoringConfig is immutable")
+
+def compile_config(raw: Dict, known_labels: Mapping[str, Iterable[str]], genders: Iterable[str], path: Optional[str] = None) -> ScoringConfig:
+    """ Validates a raw config dict and compiles it into a ScoringConfig. known_labels maps
+    'bmi_cutoffs' and 'fmi_cutoffs' to the classifications that carry risk points.
+    Raises InvalidConfigError describing the first problem found. """
+    for section in ("bmi_cutoffs", "fmi_cutoffs", "risk_cutoffs"):
+        if section not in raw:
+            raise InvalidConfigError(f"Missing section '{section}'.")
+    risk_cutoffs = {}
+    for gender in genders:
+        if gender not in raw["risk_cutoffs"]:
+            raise InvalidConfigError(f"Missing 'risk_cutoffs' for gender '{gender}'.")
+        risk_cutoffs[gender] = CutoffTable(f"risk_cutoffs.{gender}", raw["risk_cutoffs"][gender])
+    version = hashlib.sha256(json.dumps(raw, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    return ScoringConfig(
+        version=version,
+        path=path,
+        bmi_cutoffs=CutoffTable("bmi_cutoffs", raw["bmi_cutoffs"], known_labels["bmi_cutoffs"]),
+        fmi_cutoffs=CutoffTable("fmi_cutoffs", raw["fmi_cutoffs"], known_labels["fmi_cutoffs"]),
+        risk_cutoffs=risk_cutoffs,
+    )
+
+class ConfigFileWatcher:
+    """ Polls a file's modification time on a daemon thread and calls on_change when it moves. """
+
+    def __init__(self, path: str, on_change: Callable[[], object], interval: float):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+        self._mtime = self._current_mtime()
+
+    def _current_mtime(self) -> Tuple[float, int]:
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime, stat.st_size
+        except FileNotFoundError:
+            return 0.0, 0
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            mtime = self._current_mtime()
+            if mtime != self._mtime:
+                self._mtime = mtime
+                try:
+                    self.on_change()
+                except Exception:
+                    # the previous config stays active
+                    logger.exception("scoring_config_reload_failed", extra={"fields": {"path": self.path}})
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
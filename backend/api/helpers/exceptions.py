@@ -5,3 +5,27 @@ class InsufficientDataError(Exception):
 class InvalidInputError(Exception):
     def __init__(self, detail: str):
         self.detail = {"error": detail}
+
+class PasswordHashingBusyError(Exception):
+    def __init__(self, detail: str):
+        self.detail = {"error": detail}
+
+class InvalidConfigError(Exception):
+    def __init__(self, detail: str):
+        self.detail = {"error": detail}
+        super().__init__(detail)
+
+class InvalidSettingsError(Exception):
+    def __init__(self, detail: str):
+        self.detail = {"error": detail}
+        super().__init__(detail)
+
+class SubmissionConflictError(Exception):
+    def __init__(self, detail: str):
+        self.detail = {"error": detail}
+        super().__init__(detail)
+
+class SubmissionQueueFullError(Exception):
+    def __init__(self, detail: str):
+        self.detail = {"error": detail}
+        super().__init__(detail)
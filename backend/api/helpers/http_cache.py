@@ -0,0 +1,70 @@
+import hashlib
+import threading
+from typing import Callable, Dict, Sequence
+
+class ETagStats:
+    """ Counters shared by every ETagMiddleware instance. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tagged = 0
+        self.not_modified = 0
+
+    def record(self, not_modified: bool):
+        with self._lock:
+            if not_modified:
+                self.not_modified += 1
+            else:
+                self.tagged += 1
+
+    def stats(self) -> Dict[str, float]:
+        """ Returns how many responses were tagged and how many requests were answered with 304. """
+        with self._lock:
+            requests = self.tagged + self.not_modified
+            return {
+                "tagged": self.tagged,
+                "not_modified": self.not_modified,
+                "not_modified_rate": round(self.not_modified / requests, 4) if requests else 0.0,
+            }
+
+etag_stats = ETagStats()
+
+class ETagMiddleware:
+    """ Pure ASGI middleware adding ETag and Cache-Control to the GET responses of pure endpoints,
+    whose inputs are all in the query string. The ETag is a hash of the path, query string and
+    version(), so it changes whenever the scoring config does. A GET or HEAD whose If-None-Match
+    carries the current ETag is answered with 304 without reaching routing, validation or the
+    handler. Other methods pass through untouched: their responses are never cached by clients. """
+
+    def __init__(self, app, paths: Sequence[str], version: Callable[[], str], max_age: int = 300):
+        self.app = app
+        self.paths = tuple(paths)
+        self.version = version
+        self.cache_control = f"private, max-age={max_age}".encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD") or not scope["path"].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (scope["path"].encode(), scope["query_string"], self.version().encode()):
+            digest.update(part)
+            digest.update(b"\0")
+        etag = f'"{digest.hexdigest()}"'.encode("latin-1")
+
+        if_none_match = next((value for name, value in scope["headers"] if name == b"if-none-match"), None)
+        if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(b",")]:
+            etag_stats.record(not_modified=True)
+            await send({"type": "http.response.start", "status": 304, "headers": [(b"etag", etag), (b"cache-control", self.cache_control)]})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_etag(message):
+            # only successful results are worth caching; errors stay uncached
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"etag", etag), (b"cache-control", self.cache_control)]}
+                etag_stats.record(not_modified=False)
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
@@ -0,0 +1,149 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from typing import Dict, Iterable, Optional
+
+# structured logging: handlers only enqueue records, a listener thread formats them as JSON and writes them
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# default sampling rate for info and debug events, and per-route overrides, e.g. "/calculate/*=0.01,/token=1"
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+LOG_REDACT_FIELDS = os.getenv("LOG_REDACT_FIELDS", "password,hashed_password,token,access_token,authorization,email,user_email,body,payload")
+MAX_FIELD_LENGTH = 256
+REDACTED = "[redacted]"
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    """ Parses "route=rate,prefix*=rate" into a dict. Raises ValueError on malformed entries. """
+    rates = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        route, _, rate = entry.partition("=")
+        rate = float(rate)
+        if not route or not 0 <= rate <= 1:
+            raise ValueError(f"Invalid log sample rate entry '{entry}'.")
+        rates[route.strip()] = rate
+    return rates
+
+class Sampler:
+    """ Decides per route whether an info or debug event is kept. Exact routes win over
+    prefixes ending in '*'; the longest matching prefix wins. Lookups are memoized per route. """
+
+    def __init__(self, rates: Dict[str, float], default: float = 1.0):
+        self.default = default
+        self._exact = {route: rate for route, rate in rates.items() if not route.endswith("*")}
+        self._prefixes = sorted(((route[:-1], rate) for route, rate in rates.items() if route.endswith("*")), key=lambda item: -len(item[0]))
+        self._resolved: Dict[Optional[str], float] = {}
+
+    def rate(self, route: Optional[str]) -> float:
+        rate = self._resolved.get(route)
+        if rate is None:
+            rate = self._exact.get(route)
+            if rate is None:
+                rate = next((rate for prefix, rate in self._prefixes if route and route.startswith(prefix)), self.default)
+            self._resolved[route] = rate
+        return rate
+
+    def keep(self, route: Optional[str]) -> bool:
+        rate = self.rate(route)
+        return rate >= 1 or random.random() < rate
+
+sampler = Sampler(parse_sample_rates(LOG_SAMPLE_RATES), LOG_SAMPLE_RATE)
+
+def log_event(logger: logging.Logger, level: int, event: str, route: Optional[str] = None, **fields):
+    """ Logs a structured event. Nothing is formatted on the calling thread: disabled levels and
+    sampled-out events return immediately, and JSON encoding happens on the listener thread.
+    Warnings and errors are never sampled out. """
+    if not logger.isEnabledFor(level):
+        return
+    if level < logging.WARNING and not sampler.keep(route):
+        return
+    if route is not None:
+        fields["route"] = route
+    logger.log(level, event, extra={"fields": fields})
+
+class JsonFormatter(logging.Formatter):
+    """ Formats records as one JSON object per line, redacting sensitive fields and truncating long values. """
+
+    def __init__(self, redact_fields: Iterable[str] = ()):
+        super().__init__()
+        self.redact_fields = frozenset(field.strip().lower() for field in redact_fields if field.strip())
+
+    def _clean(self, key: str, value):
+        if key.lower() in self.redact_fields:
+            return REDACTED
+        if isinstance(value, (int, float, bool)) or value is None:
+            return value
+        value = str(value)
+        return value if len(value) <= MAX_FIELD_LENGTH else value[:MAX_FIELD_LENGTH] + "..."
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        for key, value in getattr(record, "fields", {}).items():
+            entry[key] = self._clean(key, value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """ Enqueues records as they are, leaving all formatting to the listener thread, and drops
+    records instead of blocking when the queue is full. """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_lock = threading.Lock()
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def start_logging(level: str = LOG_LEVEL, stream=None):
+    """ Routes the root logger through a bounded queue to a JSON writer on a background thread.
+    Calling it again while the listener is running does nothing. """
+    global _queue_handler, _listener
+    with _lock:
+        if _listener is not None:
+            return
+        writer = logging.StreamHandler(stream or sys.stdout)
+        writer.setFormatter(JsonFormatter(LOG_REDACT_FIELDS.split(",")))
+        _queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, writer, respect_handler_level=False)
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_queue_handler)
+        root.setLevel(level)
+        _listener.start()
+
+def stop_logging():
+    """ Flushes the queued records and stops the listener thread. """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+def logging_stats() -> Dict[str, float]:
+    """ Returns the queue depth and the number of records dropped because the queue was full. """
+    if _queue_handler is None:
+        return {"queue_depth": 0, "queue_size": LOG_QUEUE_SIZE, "dropped": 0}
+    return {"queue_depth": _queue_handler.queue.qsize(), "queue_size": LOG_QUEUE_SIZE, "dropped": _queue_handler.dropped}
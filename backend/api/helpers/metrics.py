@@ -0,0 +1,216 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# in-process metrics, rendered in the Prometheus text exposition format
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(labelnames: Sequence[str], labels: Tuple) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labels):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """ Monotonic counter per label set. """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        lines.extend(f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in values)
+        return lines
+
+class Gauge(Counter):
+    """ Value per label set that can go up and down. """
+
+    def dec(self, labels: Tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    """ Fixed-bucket histogram per label set. Observing is a bisect plus three increments. """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """ Holds the metrics and the collectors that produce lines on demand at scrape time. """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors: List[Callable[[], Iterable[str]]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[str]]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+def gauge_lines(name: str, documentation: str, values: Dict[Tuple, float], labelnames: Sequence[str] = ()) -> List[str]:
+    """ Renders a set of gauge values computed at scrape time, e.g. from an existing stats() dict. """
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+    lines.extend(f"{name}{_format_labels(labelnames, labels)} {float(value)}" for labels, value in values.items())
+    return lines
+
+# HTTP metrics
+
+REQUEST_LATENCY = REGISTRY.register(Histogram("http_request_duration_seconds", "Request latency by route.", ("method", "route", "status")))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge("http_requests_in_flight", "Requests currently being handled, by route.", ("method", "route")))
+
+class MetricsMiddleware:
+    """ Pure ASGI middleware recording per-route latency and in-flight counts. Routes are labelled
+    by their path template so the number of series stays bounded. """
+
+    def __init__(self, app):
+        self.app = app
+        self._static_paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if self._static_paths is None:
+            self._static_paths = {route.path for route in scope["app"].routes if "{" not in getattr(route, "path", "{")}
+
+        method = scope["method"]
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        # the route template is only known after routing, so in-flight requests are labelled by static path
+        in_flight_labels = (method, scope["path"] if scope["path"] in self._static_paths else "other")
+        REQUESTS_IN_FLIGHT.inc(in_flight_labels)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec(in_flight_labels)
+            route = scope.get("route")
+            REQUEST_LATENCY.observe((method, route.path if route is not None else "unmatched", str(status[0])), elapsed)
+
+# database metrics
+
+QUERY_LATENCY = REGISTRY.register(Histogram("db_query_duration_seconds", "SQL statement latency by normalized statement.", ("statement",)))
+
+# distinct statement labels, which bounds the series of the query histogram; later shapes become "other"
+MAX_STATEMENT_LABELS = 500
+# raw statements whose label is remembered. Multi-row INSERTs differ in length but share a label,
+# so this is larger, and the least recently added statement is forgotten once it is full
+MAX_STATEMENT_MEMO = 5000
+_normalized_statements: "OrderedDict[str, str]" = OrderedDict()
+_statement_labels = set()
+_statements_lock = threading.Lock()
+_whitespace = re.compile(r"\s+")
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|\$\d+|\?")
+_repeated_values = re.compile(r"(\(\?(?:, \?)*\))(?:, \(\?(?:, \?)*\))+")
+
+def normalize_statement(statement: str) -> str:
+    """ Replaces literals and bind parameters with '?', collapses multi-row VALUES lists and
+    whitespace, and truncates, so each query shape maps to one label. Results are memoized. """
+    normalized = _normalized_statements.get(statement)
+    if normalized is not None:
+        return normalized
+    normalized = _whitespace.sub(" ", statement).strip()
+    normalized = _literals.sub("?", normalized)
+    normalized = _repeated_values.sub(r"\1, ...", normalized)[:200]
+    with _statements_lock:
+        if normalized not in _statement_labels:
+            if len(_statement_labels) >= MAX_STATEMENT_LABELS:
+                normalized = "other"
+            else:
+                _statement_labels.add(normalized)
+        _normalized_statements[statement] = normalized
+        if len(_normalized_statements) > MAX_STATEMENT_MEMO:
+            _normalized_statements.popitem(last=False)
+    return normalized
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("query_start")
+    if starts:
+        QUERY_LATENCY.observe((normalize_statement(statement),), time.perf_counter() - starts.pop())
+
+def handle_error(exception_context):
+    # failed statements never reach after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_start"):
+        connection.info["query_start"].pop()
+
+def instrument_sqlalchemy():
+    """ Times every statement of every engine, including the sync engines behind async ones. """
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(Engine, "handle_error", handle_error)
@@ -0,0 +1,23 @@
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Tuple
+from .exceptions import InvalidInputError
+
+# opaque keyset cursors: the (timestamp, id) of the last row of a page
+
+def encode_cursor(timestamp: datetime, row_id: int) -> str:
+    """ Encodes the sort key of the last row of a page as an opaque, URL-safe cursor. """
+    raw = json.dumps([timestamp.isoformat(), row_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, int]]:
+    """ Decodes a cursor produced by encode_cursor. Raises InvalidInputError for malformed cursors. """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, row_id = json.loads(raw)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, TypeError):
+        raise InvalidInputError("The pagination cursor is not valid.")
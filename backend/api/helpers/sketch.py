@@ -0,0 +1,147 @@
+import math
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Tuple
+
+class TDigest:
+    """ Merging t-digest (Dunning & Ertl): a mergeable summary of a distribution in a bounded
+    number of centroids, most precise near the tails. Values are buffered and folded into the
+    centroids in sorted passes, so adding is amortised O(log n) and memory stays around
+    compression centroids however many values were added. Digests built on different
+    workers merge into one with the accuracy of a digest built from all their values. """
+
+    def __init__(self, compression: float = 100.0):
+        self.compression = compression
+        self.means: List[float] = []
+        self.weights: List[float] = []
+        self.count = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer: List[Tuple[float, float]] = []
+        self._buffer_limit = int(compression * 5)
+        # cumulative weight at each centroid's mean, rebuilt lazily for cdf() and quantile()
+        self._cumulative: Optional[List[float]] = None
+
+    def add(self, value: float, weight: float = 1.0):
+        value = float(value)
+        if math.isnan(value):
+            raise ValueError("Cannot add NaN to a t-digest.")
+        self._buffer.append((value, weight))
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self._cumulative = None
+        if len(self._buffer) >= self._buffer_limit:
+            self._compress()
+
+    def merge(self, other: "TDigest"):
+        """ Adds every value summarised by other to this digest. """
+        if not other.count:
+            return
+        self._buffer.extend(zip(other.means, other.weights))
+        self._buffer.extend(other._buffer)
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._cumulative = None
+        self._compress()
+
+    def _k_limit(self, q: float) -> float:
+        """ Upper quantile of a centroid starting at q under the k1 scale function, which keeps
+        centroids small near q = 0 and q = 1. """
+        k = self.compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(2 * math.pi * k / self.compression) + 1) / 2
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        points = sorted(list(zip(self.means, self.weights)) + self._buffer)
+        self._buffer = []
+        total = self.count
+        means, weights = [], []
+        mean, weight = points[0]
+        merged = 0.0
+        limit = total * self._k_limit(0.0)
+        for next_mean, next_weight in points[1:]:
+            if merged + weight + next_weight <= limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                merged += weight
+                limit = total * self._k_limit(merged / total)
+                mean, weight = next_mean, next_weight
+        means.append(mean)
+        weights.append(weight)
+        self.means, self.weights = means, weights
+        self._cumulative = None
+
+    def _prepare(self) -> List[float]:
+        self._compress()
+        if self._cumulative is None:
+            cumulative, running = [], 0.0
+            for weight in self.weights:
+                cumulative.append(running + weight / 2)
+                running += weight
+            self._cumulative = cumulative
+        return self._cumulative
+
+    def cdf(self, value: float) -> Optional[float]:
+        """ Returns the estimated fraction of values at or below value, interpolating linearly
+        between centroids; None when the digest is empty. O(log compression). """
+        if not self.count:
+            return None
+        if value < self.min:
+            return 0.0
+        if value >= self.max:
+            return 1.0
+        cumulative = self._prepare()
+        # interpolation knots: (min, 0), each centroid at its mean, (max, count)
+        index = bisect_right(self.means, value)
+        if index == 0:
+            left_x, left_y, right_x, right_y = self.min, 0.0, self.means[0], cumulative[0]
+        elif index == len(self.means):
+            left_x, left_y, right_x, right_y = self.means[-1], cumulative[-1], self.max, self.count
+        else:
+            left_x, left_y, right_x, right_y = self.means[index - 1], cumulative[index - 1], self.means[index], cumulative[index]
+        if right_x <= left_x:
+            return right_y / self.count
+        return (left_y + (right_y - left_y) * (value - left_x) / (right_x - left_x)) / self.count
+
+    def quantile(self, q: float) -> Optional[float]:
+        """ Returns the estimated value at quantile q (0 to 1); None when the digest is empty. """
+        if not self.count:
+            return None
+        if not 0 <= q <= 1:
+            raise ValueError("Quantile must be between 0 and 1.")
+        cumulative = self._prepare()
+        target = q * self.count
+        knots_x = [self.min] + self.means + [self.max]
+        knots_y = [0.0] + cumulative + [self.count]
+        index = max(1, bisect_left(knots_y, target))
+        if index >= len(knots_y):
+            return self.max
+        left_y, right_y = knots_y[index - 1], knots_y[index]
+        if right_y <= left_y:
+            return knots_x[index]
+        return knots_x[index - 1] + (knots_x[index] - knots_x[index - 1]) * (target - left_y) / (right_y - left_y)
+
+    def to_dict(self) -> Dict:
+        self._compress()
+        return {"compression": self.compression, "means": self.means, "weights": self.weights,
+                "min": self.min if self.count else None, "max": self.max if self.count else None}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "TDigest":
+        digest = cls(compression=data["compression"])
+        digest.means = [float(mean) for mean in data["means"]]
+        digest.weights = [float(weight) for weight in data["weights"]]
+        digest.count = sum(digest.weights)
+        if digest.count:
+            digest.min, digest.max = float(data["min"]), float(data["max"])
+        return digest
+
+    def __len__(self) -> int:
+        return len(self.means) + len(self._buffer)
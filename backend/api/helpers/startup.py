@@ -0,0 +1,39 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+class StartupReport:
+    """ Wall-clock breakdown of application startup, one entry per phase. A failing phase is
+    recorded with its error and the exception is re-raised unless the phase is optional. """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.finished_s: Optional[float] = None
+        self.phases: Dict[str, Dict] = {}
+
+    def record(self, name: str, duration_s: float, error: Optional[str] = None, **details):
+        self.phases[name] = {"duration_ms": round(duration_s * 1000, 3), "ok": error is None, "error": error, **details}
+
+    @contextmanager
+    def phase(self, name: str, optional: bool = False, **details):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.record(name, time.perf_counter() - started, error=f"{type(e).__name__}: {e}", **details)
+            if not optional:
+                raise
+        else:
+            self.record(name, time.perf_counter() - started, **details)
+
+    def finish(self):
+        self.finished_s = time.perf_counter() - self._started
+
+    def as_dict(self) -> Dict:
+        return {
+            "started_at": self.started_at,
+            "total_ms": round(self.finished_s * 1000, 3) if self.finished_s is not None else None,
+            "ready": self.finished_s is not None,
+            "phases": self.phases,
+        }
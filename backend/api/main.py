@@ -1,21 +1,49 @@
+import time
+# taken before the heavy imports below, so the startup report includes them
+IMPORT_STARTED_AT = time.perf_counter()
+
+import asyncio
 import csv
-from datetime import timedelta, datetime
+import hmac
+import inspect
+import math
+import uuid
+from contextlib import asynccontextmanager
+from datetime import date, timedelta, datetime
 from io import StringIO
-from fastapi import FastAPI, HTTPException, Depends, Response, status
-from typing import Dict, Annotated, Optional
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from typing import AsyncIterator, Dict, Annotated, Optional
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
-from pydantic import model_serializer
-from sqlalchemy.orm import Session
+from jose.constants import ALGORITHMS
+from pydantic import ValidationError, model_serializer
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import logging
-from .helpers.exceptions import InsufficientDataError, InvalidInputError
+from .helpers.admission import AdmissionControlMiddleware, RouteLimit, admission_stats, parse_limits
+from .helpers.cache import TTLCache
+from .helpers.http_cache import ETagMiddleware, etag_stats
+from .helpers.log import log_event, logging_stats, start_logging, stop_logging
+from .helpers.metrics import REGISTRY, MetricsMiddleware, gauge_lines, instrument_sqlalchemy
+from .helpers.pagination import decode_cursor, encode_cursor
+from .helpers.exceptions import (InsufficientDataError, InvalidInputError, InvalidSettingsError, PasswordHashingBusyError,
+                                 SubmissionConflictError, SubmissionQueueFullError)
+from .helpers.startup import StartupReport
 from . import models as md
 from .services import auth
 from .services import services as srv
-from .database.database import SessionLocal
-from .database.crud import create_user, get_user, create_questionnaire_result, get_questionnaire_result_by_user
+from .database import database
+from .database.database import AsyncSessionLocal, replica_router, warm_async_pool
+from .database.partitions import ensure_partitions_async
+from .database.revocation import revocation_list
+from .database.sketches import SKETCH_METRICS, sketch_store
+from .database.pool_stats import pool_stats
+from .database import async_crud
+from .database.write_behind import WRITE_BEHIND_MODE, WRITE_BEHIND_MODES, submission_batcher
 
 import os
 from dotenv import load_dotenv
@@ -33,12 +61,123 @@ tags_metadata = [
         "name": "authentication",
         "description": "Authentication for users"
     },
+    {
+        "name": "internal",
+        "description": "Operational telemetry, not meant for the frontends"
+    },
 ]
 
+startup_report = StartupReport()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ Validates the settings and warms up everything the first requests would otherwise pay for:
+    the scoring config, JWT, the OpenAPI schema, database connections and the bcrypt workers.
+    Fails fast on bad settings or config; warm-ups of external resources only log a warning.
+    The timings are served at /internal/startup. On shutdown, stops the background threads
+    and closes the pools. """
+    global config_watcher, replica_lag_task, sketch_task, revocation_task
+    startup_report.record("import", time.perf_counter() - IMPORT_STARTED_AT)
+    start_logging()
+    with startup_report.phase("settings"):
+        validate_settings()
+    with startup_report.phase("scoring_config"):
+        srv.reload_scoring_config()
+    # hot reload of the scoring config on SIGHUP, and on file change when SCORING_CONFIG_WATCH_SECONDS is set
+    srv.install_config_reload_signal()
+    config_watcher = srv.start_config_watcher()
+    with startup_report.phase("jwt"):
+        jwt.decode(create_access_token({"sub": "warm-up"}), SECRET_KEY, algorithms=[ALGORITHM])
+    with startup_report.phase("openapi"):
+        app.openapi()
+
+    # these wait on the network and on worker threads, so they overlap
+    async def warm_pool():
+        with startup_report.phase("db_pool", optional=True, connections=min(database.DB_POOL_WARMUP, database.DB_POOL_SIZE)):
+            await warm_async_pool()
+
+    async def warm_bcrypt():
+        with startup_report.phase("bcrypt", optional=True):
+            await auth.hashing_pool.run(auth.get_password_hash, "warm-up")
+
+    async def check_replicas():
+        with startup_report.phase("replicas", optional=True, replicas=len(replica_router.engines)):
+            await replica_router.check_lag()
+
+    async def create_partitions():
+        # keeps the upcoming months' questionnaire_results partitions ready, so inserts do not land in the default one
+        with startup_report.phase("partitions", optional=True):
+            async with database.async_engine.connect() as connection:
+                await ensure_partitions_async(connection)
+
+    async def load_sketches():
+        with startup_report.phase("sketches", optional=True):
+            await sketch_store.sync()
+
+    async def load_revocations():
+        with startup_report.phase("revocations", optional=True):
+            async with AsyncSessionLocal() as db:
+                await revocation_list.load(db)
+
+    await asyncio.gather(warm_pool(), warm_bcrypt(), check_replicas(), create_partitions(), load_sketches(), load_revocations())
+    sketch_task = asyncio.create_task(sketch_store.run(), name="sketch-sync")
+    revocation_task = asyncio.create_task(revocation_list.run(), name="revocation-refresh")
+    if replica_router.engines:
+        replica_lag_task = asyncio.create_task(replica_router.run(), name="replica-lag")
+    if WRITE_BEHIND_MODE != "off":
+        submission_batcher.start()
+    startup_report.finish()
+    for name, phase in startup_report.phases.items():
+        if not phase["ok"]:
+            log_event(logger, logging.WARNING, "startup_warmup_failed", phase=name, error=phase["error"])
+    log_event(logger, logging.INFO, "startup_complete", total_ms=startup_report.as_dict()["total_ms"],
+              **{f"{name}_ms": phase["duration_ms"] for name, phase in startup_report.phases.items()})
+    yield
+
+    if config_watcher is not None:
+        config_watcher.stop()
+        config_watcher = None
+    if replica_lag_task is not None:
+        replica_lag_task.cancel()
+        replica_lag_task = None
+    revocation_task.cancel()
+    revocation_task = None
+    # write the queued submissions, and then their sketch values, before the pools close
+    await submission_batcher.stop()
+    sketch_task.cancel()
+    sketch_task = None
+    try:
+        await sketch_store.sync(reload=False)
+    except Exception as e:
+        log_event(logger, logging.WARNING, "sketch_sync_failed", error=type(e).__name__, detail=str(e))
+    await replica_router.dispose()
+    await database.async_engine.dispose()
+    database.engine.dispose()
+    auth.hashing_pool.shutdown()
+    log_event(logger, logging.INFO, "shutdown_complete")
+    stop_logging()
+
 # initialize FastAPI app with custom OpenAPI tags and configure CORS middleware
 # to allow requests from the frontend running on localhost:3000.
-app = FastAPI(openapi_tags=tags_metadata)
+app = FastAPI(openapi_tags=tags_metadata, lifespan=lifespan)
 
+# repeated GET calls to the pure endpoints can be revalidated with If-None-Match without reaching the handlers;
+# added first so CORS headers also reach the 304 responses
+app.add_middleware(ETagMiddleware, paths=["/calculate/", "/classify/"], version=lambda: srv.get_scoring_config().version,
+                   max_age=int(os.getenv("HTTP_CACHE_MAX_AGE", "300")))
+# load shedding for the bcrypt and export endpoints, so they cannot starve the cheap ones.
+# ADMISSION_LIMITS (JSON) overrides the defaults per path
+ADMISSION_DEFAULTS = {
+    "/token": {"max_concurrent": auth.AUTH_HASH_WORKERS + auth.AUTH_HASH_MAX_QUEUE, "rate": 5, "burst": 30, "key": "client"},
+    "/users/create/": {"max_concurrent": auth.AUTH_HASH_WORKERS + auth.AUTH_HASH_MAX_QUEUE, "rate": 1, "burst": 20, "key": "client"},
+    "/download_questionnaire": {"max_concurrent": 4, "rate": 0.1, "burst": 3, "key": "user"},
+}
+admission_overrides = parse_limits(os.getenv("ADMISSION_LIMITS", ""))
+admission_limits = {
+    path: RouteLimit(path, **{**ADMISSION_DEFAULTS.get(path, {}), **admission_overrides.get(path, {})})
+    for path in {**ADMISSION_DEFAULTS, **admission_overrides}
+}
+app.add_middleware(AdmissionControlMiddleware, limits=admission_limits)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -46,32 +185,128 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+instrument_sqlalchemy()
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 load_dotenv()
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+# shared secret for /metrics and the /internal/* endpoints, sent in the X-Internal-Token header.
+# Without it, they only answer clients on the loopback interface, e.g. a sidecar or an SSH tunnel
+INTERNAL_TOKEN = os.getenv("INTERNAL_TOKEN")
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+# comma-separated addresses of the metrics scrapers, which may read /metrics without the token
+METRICS_SCRAPER_HOSTS = [host.strip() for host in os.getenv("METRICS_SCRAPER_HOSTS", "").split(",") if host.strip()]
+
+config_watcher = None
+replica_lag_task = None
+sketch_task = None
+revocation_task = None
+
+def validate_settings():
+    """ Checks the settings read from the environment. Raises InvalidSettingsError listing every problem. """
+    problems = []
+    if not SECRET_KEY:
+        problems.append("SECRET_KEY is not set.")
+    if ALGORITHM not in ALGORITHMS.SUPPORTED:
+        problems.append(f"ALGORITHM must be one of {sorted(ALGORITHMS.SUPPORTED)}, got {ALGORITHM!r}.")
+    if ACCESS_TOKEN_EXPIRE_MINUTES <= 0:
+        problems.append("ACCESS_TOKEN_EXPIRE_MINUTES must be positive.")
+    if WRITE_BEHIND_MODE not in WRITE_BEHIND_MODES:
+        problems.append(f"WRITE_BEHIND_MODE must be one of {list(WRITE_BEHIND_MODES)}, got {WRITE_BEHIND_MODE!r}.")
+    for name in ("POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_DB"):
+        if not getattr(database, name) and not os.getenv("ASYNC_DATABASE_URL"):
+            problems.append(f"{name} is not set.")
+    if problems:
+        raise InvalidSettingsError(" ".join(problems))
 
 # DB dependency
-def get_db():
-    db = SessionLocal()
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# the WAL position of the client's last write, see ReplicaRouter. Clients that keep cookies send
+# it back on their own; others copy the header into their next reads
+READ_AFTER_COOKIE = "db_read_after"
+READ_AFTER_HEADER = "X-DB-Read-After"
+
+def read_after_headers(position: Optional[int]) -> Dict[str, str]:
+    """ Returns the headers handing the client the position of its write, so any worker can
+    serve its next reads from a replica that has replayed it. """
+    if position is None:
+        return {}
+    return {
+        READ_AFTER_HEADER: str(position),
+        "Set-Cookie": f"{READ_AFTER_COOKIE}={position}; Max-Age={int(replica_router.pin_seconds)}; Path=/; HttpOnly; SameSite=lax",
+    }
+
+async def mark_write(response: Response, db: AsyncSession):
+    """ Adds the read-after headers for a write just committed through db to response. """
+    for name, value in read_after_headers(await replica_router.write_position(db)).items():
+        response.headers.append(name, value)
+
+def read_after(request: Request) -> Optional[int]:
+    """ Returns the write position the client sent, from the header or else the cookie. """
+    value = request.headers.get(READ_AFTER_HEADER) or request.cookies.get(READ_AFTER_COOKIE)
     try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+async def get_async_read_db(request: Request):
+    """ Session for read-only endpoints: a replica that has replayed the caller's last write,
+    or the primary when no replica is fresh enough. """
+    async with replica_router.session(read_after(request)) as db:
         yield db
-    finally:
-        db.close()
+
+def require_internal_access(request: Request, x_internal_token: Annotated[Optional[str], Header()] = None):
+    """ Rejects callers of the internal endpoints that do not send INTERNAL_TOKEN, or, when it
+    is not set, that do not connect over loopback. """
+    if INTERNAL_TOKEN:
+        if x_internal_token is None or not hmac.compare_digest(x_internal_token.encode(), INTERNAL_TOKEN.encode()):
+            raise HTTPException(status_code=403, detail="Internal endpoints need a valid X-Internal-Token header.")
+    elif request.client is None or request.client.host not in LOOPBACK_HOSTS:
+        raise HTTPException(status_code=403, detail="Internal endpoints only answer loopback clients unless INTERNAL_TOKEN is set.")
+
+def require_metrics_access(request: Request, x_internal_token: Annotated[Optional[str], Header()] = None):
+    """ Lets the configured scrapers read /metrics; everyone else needs internal access. """
+    if request.client is not None and request.client.host in METRICS_SCRAPER_HOSTS:
+        return
+    require_internal_access(request, x_internal_token)
+
+def query_input(model):
+    """ Dependency reading the fields of model from the query string, for the GET variants of
+    the pure endpoints. Each field is documented as a query parameter; the model then validates
+    them with its own constraints, and errors are answered with 422 like body validation. """
+    def dependency(**fields):
+        try:
+            return model.model_validate({name: value for name, value in fields.items() if value is not None})
+        except ValidationError as e:
+            raise RequestValidationError([{"type": error["type"], "loc": ("query", *error["loc"]), "msg": error["msg"], "input": error["input"]}
+                                          for error in e.errors()])
+
+    dependency.__signature__ = inspect.Signature([
+        inspect.Parameter(name, inspect.Parameter.KEYWORD_ONLY, annotation=Optional[field.annotation],
+                          default=Query(... if field.is_required() else None, description=field.description))
+        for name, field in model.model_fields.items()
+    ])
+    return dependency
 
 # JWT authentication
         
-def get_user_base(db: Session, email: str) -> Optional[md.UserBase]:
+async def get_user_base(db: AsyncSession, email: str) -> Optional[md.UserBase]:
     """ Finds a user in the database based on their email. Takes the database and email
      as input, and returns the user information as an instance of the UserInDB class."""
-    db_user = get_user(db=db, email=email)
+    db_user = await async_crud.get_user(db=db, email=email)
     if db_user:
         return md.UserBase(
             email=db_user.email, 
@@ -80,12 +315,37 @@ def get_user_base(db: Session, email: str) -> Optional[md.UserBase]:
         )
     return None
     
-async def get_current_user(db: Session, token: Annotated[str, Depends(oauth2_scheme)]) -> md.UserBase:
+# resolved users by token, so authenticated requests skip the JWT decode and the user query.
+# Each worker has its own cache and nothing in the API changes a user, so a user disabled or
+# changed in the database is seen by every worker within USER_CACHE_TTL_SECONDS
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+def invalidate_cached_token(token: str):
+    """ Drops a single cached token, e.g. on logout. """
+    user_cache.invalidate(token)
+
+def token_jti(token: str) -> Optional[str]:
+    """ Returns the id of a token without verifying it, or None for tokens issued without one. """
+    try:
+        return jwt.get_unverified_claims(token).get("jti")
+    except JWTError:
+        return None
+
+async def get_current_user(db: AsyncSession, token: Annotated[str, Depends(oauth2_scheme)]) -> md.UserBase:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    # checked before the cache, which may still hold a token revoked by another worker
+    if revocation_list.active:
+        jti = token_jti(token)
+        if jti is not None and await revocation_list.is_revoked(db, jti):
+            invalidate_cached_token(token)
+            raise credentials_exception
+    cached_user = user_cache.get(token)
+    if cached_user is not None:
+        return cached_user
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
@@ -94,17 +354,29 @@ async def get_current_user(db: Session, token: Annotated[str, Depends(oauth2_sch
         token_data = md.TokenData(email=email)
     except JWTError:
         raise credentials_exception
-    user = get_user_base(db, email=token_data.email)
+    user = await get_user_base(db, email=token_data.email)
     if user is None:
         raise credentials_exception
+    # never keep a token cached past its own expiry
+    user_cache.set(token, user, ttl=payload["exp"] - time.time() if "exp" in payload else None)
     return user
 
-def authenticate_user(db: Session, email: str, password: str) -> Optional[md.UserBase]:
+async def authenticate_user(db: AsyncSession, email: str, password: str) -> Optional[md.UserBase]:
     """ Authenticates a user from their email and password combination. Returns True if the 
     credentials are valid and False if they are invalid, or if the user doesn't exist. """
-    user = get_user(db, email)
-    if not user or not auth.verify_password(password, user.hashed_password):
+    user = await async_crud.get_user(db, email)
+    if not user:
         return None
+    verified, new_hash = await auth.verify_and_update_password_async(password, user.hashed_password)
+    if not verified:
+        return None
+    if new_hash is not None:
+        # the stored hash has another cost than BCRYPT_ROUNDS; the login succeeds even if the rehash cannot be saved
+        try:
+            await async_crud.update_password_hash(db, user, new_hash)
+            log_event(logger, logging.INFO, "password_rehashed", route="/token", rounds=auth.BCRYPT_ROUNDS)
+        except Exception as e:
+            log_event(logger, logging.WARNING, "password_rehash_failed", route="/token", error=type(e).__name__, detail=str(e))
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -114,7 +386,8 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    # the jti lets a single token be revoked, see api.database.revocation
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -124,16 +397,118 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 def read_root():
     return {"message": "Hello, World!"}
 
+def collect_component_metrics():
+    """ Exposes the pool, bcrypt and user cache counters as gauges at scrape time. """
+    pools = pool_stats()
+    for stat in ("checked_out", "overflow_in_use", "checkouts", "checkout_timeouts", "wait_max_ms", "connection_age_max_s"):
+        yield from gauge_lines(f"db_pool_{stat}", f"Database pool {stat.replace('_', ' ')}.",
+                               {(name,): stats[stat] for name, stats in pools.items() if stat in stats}, ("pool",))
+    for stat, value in auth.hashing_pool.stats().items():
+        yield from gauge_lines(f"auth_hashing_{stat}", f"bcrypt worker pool {stat.replace('_', ' ')}.", {(): value})
+    for stat, value in user_cache.stats().items():
+        yield from gauge_lines(f"user_cache_{stat}", f"Authenticated user cache {stat.replace('_', ' ')}.", {(): value})
+    for stat, value in logging_stats().items():
+        yield from gauge_lines(f"log_{stat}", f"Log queue {stat.replace('_', ' ')}.", {(): value})
+    for stat in ("in_flight", "admitted", "rejected_concurrency", "rejected_rate"):
+        yield from gauge_lines(f"admission_{stat}", f"Admission control {stat.replace('_', ' ')}, by route.",
+                               {(path,): stats[stat] for path, stats in admission_stats(admission_limits).items()}, ("route",))
+    for stat, value in submission_batcher.stats().items():
+        yield from gauge_lines(f"write_behind_{stat}", f"Submission write-behind {stat.replace('_', ' ')}.", {(): value})
+    for stat, value in etag_stats.stats().items():
+        yield from gauge_lines(f"http_cache_{stat}", f"HTTP revalidation {stat.replace('_', ' ')}.", {(): value})
+    for stat, value in sketch_store.stats().items():
+        yield from gauge_lines(f"sketch_{stat}", f"Percentile sketch {stat.replace('_', ' ')}.", {(): value})
+    for stat, value in revocation_list.stats().items():
+        yield from gauge_lines(f"revocation_{stat}", f"Token revocation {stat.replace('_', ' ')}.", {(): value})
+    replicas = replica_router.stats()
+    for stat in ("replica_reads", "pinned_reads", "fallback_reads", "lag_check_errors"):
+        yield from gauge_lines(f"db_{stat}", f"Read routing {stat.replace('_', ' ')}.", {(): replicas[stat]})
+    yield from gauge_lines("db_replica_lag_seconds", "Replication lag of each read replica, -1 when unknown.",
+                           {(name,): -1 if replica["lag_s"] is None else replica["lag_s"] for name, replica in replicas["replicas"].items()}, ("replica",))
+
+REGISTRY.add_collector(collect_component_metrics)
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["internal"], dependencies=[Depends(require_metrics_access)])
+def metrics_endpoint():
+    """ Returns request latency, database statement timing and component counters in the Prometheus text format. """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/internal/startup", tags=["internal"], dependencies=[Depends(require_internal_access)])
+def startup_endpoint() -> Dict:
+    """ Returns how long each startup phase took, and whether the warm-ups succeeded. """
+    return startup_report.as_dict()
+
+@app.get("/internal/admission-stats", tags=["internal"], dependencies=[Depends(require_internal_access)])
+def admission_stats_endpoint() -> Dict[str, Dict]:
+    """ Returns the concurrency and rate limits of each limited route, with its in-flight and rejection counters. """
+    return admission_stats(admission_limits)
+
+@app.get("/internal/write-behind-stats", tags=["internal"], dependencies=[Depends(require_internal_access)])
+def write_behind_stats_endpoint() -> Dict:
+    """ Returns the mode, queue depth and batch counters of the submission write-behind. """
+    return {"mode": WRITE_BEHIND_MODE, **submission_batcher.stats()}
+
+@app.get("/internal/replica-stats", tags=["internal"], dependencies=[Depends(require_internal_access)])
+def replica_stats_endpoint() -> Dict:
+    """ Returns the lag of each read replica and how reads were routed. """
+    return replica_router.stats()
+
+@app.get("/internal/pool-stats", tags=["internal"], dependencies=[Depends(require_internal_access)])
+def pool_stats_endpoint() -> Dict[str, Dict]:
+    """ Returns checkout, wait time, overflow and connection age counters for each database pool. """
+    return pool_stats()
+
+@app.get("/internal/scoring-config", tags=["internal"], dependencies=[Depends(require_internal_access)])
+def scoring_config_endpoint() -> Dict:
+    """ Returns the version and cutoff tables of the active scoring config. """
+    config = srv.get_scoring_config()
+    return {
+        "version": config.version,
+        "path": config.path,
+        "loaded_at": config.loaded_at,
+        "bmi_cutoffs": dict(zip(config.bmi_cutoffs.labels, config.bmi_cutoffs.bounds)),
+        "fmi_cutoffs": dict(zip(config.fmi_cutoffs.labels, config.fmi_cutoffs.bounds)),
+        "risk_cutoffs": {gender: dict(zip(table.labels, table.bounds)) for gender, table in config.risk_cutoffs.items()},
+    }
+
+@app.get("/internal/auth-pool-stats", tags=["internal"], dependencies=[Depends(require_internal_access)])
+def auth_pool_stats_endpoint() -> Dict[str, float]:
+    """ Returns the queue depth and counters of the bcrypt worker pool. """
+    return auth.hashing_pool.stats()
+
+@app.get("/internal/revocation-stats", tags=["internal"], dependencies=[Depends(require_internal_access)])
+def revocation_stats_endpoint() -> Dict[str, float]:
+    """ Returns the size of the revocation filter and how token checks were answered. """
+    return revocation_list.stats()
+
+@app.get("/internal/user-cache-stats", tags=["internal"], dependencies=[Depends(require_internal_access)])
+def user_cache_stats_endpoint() -> Dict[str, float]:
+    """ Returns the size and hit/miss counters of the authenticated user cache. """
+    return user_cache.stats()
+
+@app.get("/internal/http-cache-stats", tags=["internal"], dependencies=[Depends(require_internal_access)])
+def http_cache_stats_endpoint() -> Dict[str, float]:
+    """ Returns how many responses of the GET calculation endpoints were tagged and revalidated. """
+    return etag_stats.stats()
+
 @app.post("/users/create/", response_model=md.UserBase, tags=["authentication"])
-def create_user_endpoint(user: md.UserCreate, db: Session = Depends(get_db)):
-    return create_user(db=db, user=user)
+async def create_user_endpoint(user: md.UserCreate, response: Response, db: AsyncSession = Depends(get_async_db)):
+    try:
+        created = await async_crud.create_user(db=db, user=user)
+        await mark_write(response, db)
+        return created
+    except PasswordHashingBusyError as e:
+        raise HTTPException(status_code=503, detail=e.detail, headers={"Retry-After": "1"})
 
 @app.post("/token", response_model=md.Token, tags=["authentication"])
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = authenticate_user(db, form_data.username, form_data.password)  # Authenticate against DB
+    try:
+        user = await authenticate_user(db, form_data.username, form_data.password)  # Authenticate against DB
+    except PasswordHashingBusyError as e:
+        raise HTTPException(status_code=503, detail=e.detail, headers={"Retry-After": "1"})
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -147,62 +522,209 @@ async def login_for_access_token(
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/logout", tags=["authentication"])
-async def logout():
+async def logout(token: Annotated[Optional[str], Depends(oauth2_scheme_optional)] = None, db: AsyncSession = Depends(get_async_db)):
+    """ Revokes the token until it expires. Tokens that are invalid or already expired need no revoking. """
+    if token is not None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            payload = {}
+        if "jti" in payload and "exp" in payload:
+            await revocation_list.revoke(db, payload["jti"], datetime.utcfromtimestamp(payload["exp"]))
+        invalidate_cached_token(token)
     return {"message": "User logged out successfully"}
 
 @app.post("/questonnaire_result/create")
-async def submit_questionnaire(result: md.QuestionnaireResultCreate, token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
+async def submit_questionnaire(result: md.QuestionnaireResultCreate, token: Annotated[str, Depends(oauth2_scheme)], response: Response,
+                               db: AsyncSession = Depends(get_async_db)):
     current_user = await get_current_user(db, token)
-    logger.info(f"Current user: {current_user}")
-    return create_questionnaire_result(db=db, user_email=current_user.email, result=result)
+    log_event(logger, logging.INFO, "questionnaire_result_create", route="/questonnaire_result/create", questionnaire_id=result.questionnaire_id)
+    if WRITE_BEHIND_MODE == "off":
+        created = await async_crud.create_questionnaire_result(db=db, user_email=current_user.email, result=result)
+        await mark_write(response, db)
+        sketch_store.record(created)
+        return created
 
-@app.get("/download_questionnaire")
-async def download_questionnaire(response: Response, token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
     try:
-        current_user = await get_current_user(db, token)
-        logger.info(f"Current user: {current_user}")
-        results = get_questionnaire_result_by_user(db=db, user_email=current_user.email)
-
-        stream = StringIO()
-
-        writer = csv.DictWriter(stream, fieldnames=["questionnaire_id", "gender", "vo2max", "bmi", "fmi", "tv_hours", "score", "classification", "timestamp"])
-        writer.writeheader()
-        for result in results:
-            writer.writerow({"questionnaire_id": result.questionnaire_id,
-                            "gender": result.gender,
-                            "vo2max": result.vo2max,
-                            "bmi": result.bmi if result.bmi is not None else "",
-                            "fmi": result.fmi if result.fmi is not None else "",
-                            "tv_hours": result.tv_hours if result.tv_hours is not None else "",
-                            "score": result.score,
-                            "classification": result.classification,
-                            "timestamp": result.timestamp})
-        
-        response.headers["Content-Disposition"] = "attachment; filename=questionnaire_results.csv"
-        response.headers["Content-Type"] = "text/csv"
-        response.body = stream.getvalue().encode("utf-8")
-        logger.info(f"Body: {response.body}")
+        outcome = submission_batcher.submit(current_user.email, result)
+    except SubmissionQueueFullError as e:
+        raise HTTPException(status_code=503, detail=e.detail, headers={"Retry-After": "1"})
+    outcome.add_done_callback(record_stored_submission)
+    # the batcher writes on its own connection, so the position of the write is not known here
+    # and the client reads from the primary until its marker expires
+    written = None if not replica_router.engines else database.UNKNOWN_POSITION
+    if WRITE_BEHIND_MODE == "async":
+        outcome.add_done_callback(log_failed_submission)
+        return JSONResponse(status_code=202, content={"status": "queued", "questionnaire_id": result.questionnaire_id},
+                            headers=read_after_headers(written))
+    for name, value in read_after_headers(written).items():
+        response.headers.append(name, value)
+    try:
+        # shielded, so a client disconnecting does not cancel the outcome the batcher will set
+        return await asyncio.shield(outcome)
+    except SubmissionConflictError as e:
+        raise HTTPException(status_code=409, detail=e.detail)
+    except InvalidInputError as e:
+        raise HTTPException(status_code=422, detail=e.detail)
+
+def record_stored_submission(outcome: asyncio.Future):
+    """ Adds a batched submission to the percentile sketches once it is stored, even if its request is gone. """
+    if not outcome.cancelled() and outcome.exception() is None:
+        sketch_store.record(outcome.result())
 
-        return response
+def log_failed_submission(outcome: asyncio.Future):
+    """ Reports submissions that failed after they were acknowledged with 202. """
+    if not outcome.cancelled() and outcome.exception() is not None:
+        log_event(logger, logging.WARNING, "questionnaire_result_rejected", route="/questonnaire_result/create",
+                  error=type(outcome.exception()).__name__, detail=str(outcome.exception()))
+
+QUESTIONNAIRE_CSV_FIELDS = ["questionnaire_id", "gender", "vo2max", "bmi", "fmi", "tv_hours", "score", "classification", "timestamp"]
+
+async def questionnaire_csv_rows(results: AsyncIterator) -> AsyncIterator[str]:
+    """ Encodes questionnaire results as CSV lines one row at a time, reusing a single
+    small buffer so the export never holds more than one row in memory. """
+    stream = StringIO()
+    writer = csv.DictWriter(stream, fieldnames=QUESTIONNAIRE_CSV_FIELDS)
+    writer.writeheader()
+    yield stream.getvalue()
+    async for result in results:
+        stream.seek(0)
+        stream.truncate()
+        writer.writerow({"questionnaire_id": result.questionnaire_id,
+                        "gender": result.gender,
+                        "vo2max": result.vo2max,
+                        "bmi": result.bmi if result.bmi is not None else "",
+                        "fmi": result.fmi if result.fmi is not None else "",
+                        "tv_hours": result.tv_hours if result.tv_hours is not None else "",
+                        "score": result.score,
+                        "classification": result.classification,
+                        "timestamp": result.timestamp})
+        yield stream.getvalue()
+
+@app.get("/download_questionnaire")
+async def download_questionnaire(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """ Exports the current user's questionnaire results as CSV, optionally limited to a time range,
+    e.g. one screening season, which only reads that season's partitions. """
+    current_user = await get_current_user(db, token)
+    log_event(logger, logging.INFO, "questionnaire_download", route="/download_questionnaire")
+    try:
+        results = await async_crud.stream_questionnaire_results_by_user(db=db, user_email=current_user.email, date_from=date_from, date_to=date_to)
+        return StreamingResponse(
+            questionnaire_csv_rows(results),
+            media_type="text/csv",
+            headers={"Content-Disposition": "attachment; filename=questionnaire_results.csv"},
+        )
     except Exception as e:
-        logger.exception(f"An error occurred while processing the download_questionnaire request: {e} ")
+        logger.exception("questionnaire_download_failed", extra={"fields": {"route": "/download_questionnaire", "error": type(e).__name__}})
         raise HTTPException(status_code=500, detail="Internal server error occurred while processing the request")
     
+@app.get("/questionnaire_results", response_model=md.QuestionnaireResultPage)
+async def list_questionnaire_results(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    classification: Optional[str] = None,
+    gender: Optional[md.Gender] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """ Lists the current user's questionnaire results, newest first, one page at a time. """
+    current_user = await get_current_user(db, token)
+    try:
+        after = decode_cursor(cursor)
+    except InvalidInputError as e:
+        raise HTTPException(status_code=422, detail=e.detail)
+    # fetch one extra row to know whether there is a next page
+    results = await async_crud.list_questionnaire_results_by_user(
+        db=db, user_email=current_user.email, limit=limit + 1, after=after,
+        classification=classification, gender=gender.value if gender else None,
+        date_from=date_from, date_to=date_to,
+    )
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = encode_cursor(results[-1].timestamp, results[-1].id)
+    return {"items": results, "next_cursor": next_cursor}
+
+def metric_summary(count: int, total, sum_of_squares) -> md.MetricSummary:
+    """ Derives mean and sample standard deviation from the running sums of a rollup bucket. """
+    if not count:
+        return md.MetricSummary(count=0)
+    mean = float(total) / count
+    if count < 2:
+        return md.MetricSummary(count=count, mean=mean)
+    variance = max((float(sum_of_squares) - float(total) * mean) / (count - 1), 0.0)
+    return md.MetricSummary(count=count, mean=mean, stddev=math.sqrt(variance))
+
+@app.get("/aggregates/questionnaire_results", response_model=md.CohortAggregateResponse)
+async def questionnaire_result_aggregates(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    gender: Optional[md.Gender] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """ Returns counts, means and standard deviations per month, gender and classification,
+    read from the incrementally maintained rollups instead of the raw results. """
+    await get_current_user(db, token)
+    rollups = await async_crud.get_rollups(db=db, date_from=date_from, date_to=date_to, gender=gender.value if gender else None)
+    buckets = [
+        md.CohortBucket(
+            month=rollup.month,
+            gender=rollup.gender,
+            classification=rollup.classification,
+            count=rollup.count,
+            score=metric_summary(rollup.count, rollup.score_sum, rollup.score_sumsq),
+            vo2max=metric_summary(rollup.count, rollup.vo2max_sum, rollup.vo2max_sumsq),
+            bmi=metric_summary(rollup.bmi_count, rollup.bmi_sum, rollup.bmi_sumsq),
+            fmi=metric_summary(rollup.fmi_count, rollup.fmi_sum, rollup.fmi_sumsq),
+        )
+        for rollup in rollups
+    ]
+    return {"buckets": buckets}
+
+@app.get("/percentiles", response_model=md.PercentileRankResponse)
+async def percentile_ranks(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    gender: md.Gender,
+    bmi: Optional[float] = None,
+    fmi: Optional[float] = None,
+    vo2max: Optional[float] = None,
+    score: Optional[float] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """ Returns where each given measurement falls among all stored results of the same gender,
+    as an estimated percentile rank. Answered from the in-memory sketches, without a query. """
+    await get_current_user(db, token)
+    values = {"bmi": bmi, "fmi": fmi, "vo2max": vo2max, "score": score}
+    if all(value is None for value in values.values()):
+        raise HTTPException(status_code=422, detail={"error": f"Give at least one of {', '.join(SKETCH_METRICS)}."})
+    ranks = {}
+    for metric, value in values.items():
+        if value is not None:
+            percentile, count = sketch_store.percentile_rank(metric, gender.value, value)
+            ranks[metric] = md.PercentileRank(value=value, percentile=percentile, count=count)
+    return {"gender": gender.value, "ranks": ranks}
+
 # calculation endpoints
 @app.post("/calculate/bmi", tags=["calculation"])
 async def calculate_bmi_endpoint(input_data: md.BmiInput) -> Dict[str, float]:
     bmi = srv.calculate_bmi(input_data.height_cm, input_data.weight_kg)
-    logger.info(f"Calculating BMI for height: {input_data.height_cm} and weight: {input_data.weight_kg}")
+    log_event(logger, logging.INFO, "bmi_calculated", route="/calculate/bmi", height_cm=input_data.height_cm, weight_kg=input_data.weight_kg)
     return {"bmi": bmi}
 
 @app.post("/calculate/fmi",tags=["calculation"])
 async def calculate_fmi_endpoint(input_data: md.FmiInput) -> Dict[str,float]:
     try:
         fmi = srv.calculate_fmi(input_data.height_cm, input_data.weight_kg, input_data.fat_mass_kg, input_data.body_fat_percentage)
-        if input_data.fat_mass_kg is not None:
-            logger.info(f"Calculating FMI for height: {input_data.height_cm} and fat mass: {input_data.fat_mass_kg}")
-        else:
-            logger.info(f"Calculating FMI for height: {input_data.height_cm}, weight: {input_data.weight_kg}, and body fat % {input_data.body_fat_percentage}")
+        log_event(logger, logging.INFO, "fmi_calculated", route="/calculate/fmi", height_cm=input_data.height_cm, weight_kg=input_data.weight_kg,
+                  fat_mass_kg=input_data.fat_mass_kg, body_fat_percentage=input_data.body_fat_percentage)
         return {"fmi": fmi}
     except InsufficientDataError as e:
         raise HTTPException(status_code=400, detail=e.detail)
@@ -212,7 +734,7 @@ async def calculate_fmi_endpoint(input_data: md.FmiInput) -> Dict[str,float]:
 async def calculate_vo2max_endpoint(input_data:md.Vo2maxInput) -> Dict[str,float]:
     """ Function to calculate the VO2 max based on age (years) and speed (km/h). """
     vo2max = srv.calculate_vo2max(input_data.speed_km_per_h, input_data.age_yr)
-    logger.info(f"Calculating VO2 max for speed: {input_data.speed_km_per_h} and age: {input_data.age_yr}")
+    log_event(logger, logging.INFO, "vo2max_calculated", route="/calculate/vo2max", speed_km_per_h=input_data.speed_km_per_h, age_yr=input_data.age_yr)
     return {"vo2max" : vo2max}
 
 
@@ -220,22 +742,114 @@ async def calculate_vo2max_endpoint(input_data:md.Vo2maxInput) -> Dict[str,float
 async def calculate_risk_score_endpoint(input_data: md.RiskScoreInput) -> Dict[str,int]:
     try:
         risk_score = srv.calculate_risk_score(input_data.gender, input_data.vo2max, input_data.bmi, input_data.fmi, input_data.tv_hours)
-        if input_data.gender == "male":
-            logger.info(f"Calculating risk score for gender: {input_data.gender}, vo2max: {input_data.vo2max}, and bmi: {input_data.bmi}")
-        if input_data.gender == "female":
-            logger.info(f"Calculating risk score for gender: {input_data.gender}, vo2max: {input_data.vo2max}, fmi: {input_data.fmi}, and tv hours: {input_data.tv_hours}")
+        log_event(logger, logging.INFO, "risk_score_calculated", route="/calculate/risk-score", gender=input_data.gender.value, vo2max=input_data.vo2max,
+                  bmi=input_data.bmi, fmi=input_data.fmi, tv_hours=input_data.tv_hours)
         return {"risk_score": risk_score}
     except InsufficientDataError as e:
         raise HTTPException(status_code=400, detail=e.detail)
 
-    
+
+@app.post("/calculate/risk-score/batch", response_model=md.RiskScoreBatchResponse, tags=["calculation", "classification"])
+def calculate_risk_score_batch_endpoint(input_data: md.RiskScoreBatchInput) -> md.RiskScoreBatchResponse:
+    """ Calculates and classifies the risk score for a whole cohort in one request.
+        Rows with missing data get a per-row error instead of failing the request. """
+    rows = input_data.rows
+    results = srv.calculate_risk_score_batch(
+        [row.gender for row in rows],
+        [row.vo2max for row in rows],
+        [row.bmi for row in rows],
+        [row.fmi for row in rows],
+        [row.tv_hours for row in rows],
+    )
+    log_event(logger, logging.INFO, "risk_score_batch_calculated", route="/calculate/risk-score/batch", rows=len(rows))
+    return {"results": results}
+
+@app.post("/assess", response_model=md.AssessmentResult, tags=["calculation", "classification"])
+async def assess_endpoint(
+    input_data: md.AssessmentInput,
+    response: Response,
+    token: Annotated[Optional[str], Depends(oauth2_scheme_optional)] = None,
+    db: AsyncSession = Depends(get_async_db)
+) -> md.AssessmentResult:
+    """ Runs the whole assessment in one request: BMI, FMI and VO2 max from the raw measurements,
+        then the risk score and its classification. With persist set, the result is stored for
+        the authenticated user in the same transaction as the cohort rollup update. """
+    if input_data.persist:
+        if token is None:
+            raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+        if not input_data.questionnaire_id:
+            raise HTTPException(status_code=422, detail={"error": "questionnaire_id is required to persist the assessment."})
+
+    # only the index the gender is scored on is derived, so an unused one out of range cannot fail the request
+    bmi = fmi = None
+    if input_data.gender == md.Gender.male and input_data.weight_kg is not None:
+        bmi = srv.calculate_bmi(input_data.height_cm, input_data.weight_kg)
+    if input_data.gender == md.Gender.female and (input_data.fat_mass_kg is not None or (input_data.body_fat_percentage is not None and input_data.weight_kg is not None)):
+        fmi = srv.calculate_fmi(input_data.height_cm, input_data.weight_kg, input_data.fat_mass_kg, input_data.body_fat_percentage)
+    vo2max = srv.calculate_vo2max(input_data.speed_km_per_h, input_data.age_yr)
+
+    # the derived values must pass the same range checks as the individual endpoints
+    try:
+        risk_input = md.RiskScoreInput(gender=input_data.gender, vo2max=vo2max, bmi=bmi, fmi=fmi, tv_hours=input_data.tv_hours)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=[{"loc": ["derived", *error["loc"]], "msg": error["msg"], "input": error["input"]} for error in e.errors()])
+
+    # score and classify against one config snapshot, so a concurrent reload cannot mix versions
+    config = srv.get_scoring_config()
+    try:
+        risk_score = srv.calculate_risk_score(risk_input.gender, risk_input.vo2max, risk_input.bmi, risk_input.fmi, risk_input.tv_hours, config=config)
+        classification = srv.classify_risk_score(risk_score, risk_input.gender, config=config)
+    except InsufficientDataError as e:
+        raise HTTPException(status_code=400, detail=e.detail)
+    except InvalidInputError as e:
+        raise HTTPException(status_code=422, detail=e.detail)
+    log_event(logger, logging.INFO, "assessment", route="/assess", gender=input_data.gender.value, persist=input_data.persist)
+
+    assessment = md.AssessmentResult(bmi=bmi, fmi=fmi, vo2max=vo2max, risk_score=risk_score, classification=classification, config_version=config.version)
+    if input_data.persist:
+        current_user = await get_current_user(db, token)
+        result = md.QuestionnaireResultCreate(
+            questionnaire_id=input_data.questionnaire_id, gender=input_data.gender.value, vo2max=vo2max,
+            score=risk_score, classification=classification, bmi=bmi, fmi=fmi, tv_hours=input_data.tv_hours,
+        )
+        try:
+            assessment.result = await async_crud.create_questionnaire_result(db=db, user_email=current_user.email, result=result, config_version=config.version)
+            await mark_write(response, db)
+            sketch_store.record(assessment.result)
+        except IntegrityError:
+            await db.rollback()
+            raise HTTPException(status_code=409, detail={"error": f"A result for questionnaire {input_data.questionnaire_id} already exists."})
+    return assessment
+
 @app.post("/classify/risk-score",tags=["classification"])
 async def classify_risk_score_endpoint(input_data: md.RiskClassificationInput) -> Dict[str,str]:
     try: 
         classification = srv.classify_risk_score(input_data.risk_score, input_data.gender)
-        logger.info(f"Classifying risk score for gender: {input_data.gender} and risk score: {input_data.risk_score}")
+        log_event(logger, logging.INFO, "risk_score_classified", route="/classify/risk-score", gender=input_data.gender.value, risk_score=input_data.risk_score)
         
         return {"classification": classification}
     except InvalidInputError as e:
         raise HTTPException(status_code=422, detail=e.detail)
+
+# GET variants of the pure endpoints, taking the same fields as query parameters. Only these
+# carry an ETag and Cache-Control, since clients never cache or revalidate POST responses
+@app.get("/calculate/bmi", tags=["calculation"])
+async def calculate_bmi_query_endpoint(input_data: Annotated[md.BmiInput, Depends(query_input(md.BmiInput))]) -> Dict[str, float]:
+    return await calculate_bmi_endpoint(input_data)
+
+@app.get("/calculate/fmi", tags=["calculation"])
+async def calculate_fmi_query_endpoint(input_data: Annotated[md.FmiInput, Depends(query_input(md.FmiInput))]) -> Dict[str, float]:
+    return await calculate_fmi_endpoint(input_data)
+
+@app.get("/calculate/vo2max", tags=["calculation"])
+async def calculate_vo2max_query_endpoint(input_data: Annotated[md.Vo2maxInput, Depends(query_input(md.Vo2maxInput))]) -> Dict[str, float]:
+    return await calculate_vo2max_endpoint(input_data)
+
+@app.get("/calculate/risk-score", tags=["calculation"])
+async def calculate_risk_score_query_endpoint(input_data: Annotated[md.RiskScoreInput, Depends(query_input(md.RiskScoreInput))]) -> Dict[str, int]:
+    return await calculate_risk_score_endpoint(input_data)
+
+@app.get("/classify/risk-score", tags=["classification"])
+async def classify_risk_score_query_endpoint(input_data: Annotated[md.RiskClassificationInput, Depends(query_input(md.RiskClassificationInput))]) -> Dict[str, str]:
+    return await classify_risk_score_endpoint(input_data)
     
@@ -1,5 +1,6 @@
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field
+from datetime import date, datetime
+from typing import Dict, List, Optional
 from enum import Enum
 
 # user authentication
@@ -30,6 +31,57 @@ class QuestionnaireResultCreate(BaseModel):
     fmi: Optional[float] = None
     tv_hours: Optional[float] = None
 
+class QuestionnaireResultItem(BaseModel):
+    """ One questionnaire result in a paginated listing. """
+    model_config = ConfigDict(from_attributes=True)
+
+    questionnaire_id: str
+    gender: str
+    vo2max: float
+    score: int
+    classification: str
+    bmi: Optional[float] = None
+    fmi: Optional[float] = None
+    tv_hours: Optional[float] = None
+    timestamp: Optional[datetime] = None
+    config_version: Optional[str] = None
+
+class QuestionnaireResultPage(BaseModel):
+    """ A page of questionnaire results. Pass next_cursor back to get the following page. """
+    items: List[QuestionnaireResultItem]
+    next_cursor: Optional[str] = None
+
+class MetricSummary(BaseModel):
+    """ Count, mean and sample standard deviation of one measurement within a bucket. """
+    count: int
+    mean: Optional[float] = None
+    stddev: Optional[float] = None
+
+class CohortBucket(BaseModel):
+    """ Distribution summary of all results of one month, gender and classification. """
+    month: date
+    gender: str
+    classification: str
+    count: int
+    score: MetricSummary
+    vo2max: MetricSummary
+    bmi: MetricSummary
+    fmi: MetricSummary
+
+class CohortAggregateResponse(BaseModel):
+    buckets: List[CohortBucket]
+
+class PercentileRank(BaseModel):
+    """ Where a value falls among all stored results of the same gender: the estimated
+    percentage of results at or below it, out of count results. """
+    value: float
+    percentile: Optional[float] = None
+    count: int
+
+class PercentileRankResponse(BaseModel):
+    gender: str
+    ranks: Dict[str, PercentileRank]
+
 class QuestionnaireResultResponse(BaseModel):
     user_id: str
     questionnaire_id: str
@@ -46,6 +98,12 @@ class Gender(str, Enum):
     male = "male"
     female = "female"
 
+class QuestionnaireResultImport(QuestionnaireResultCreate):
+    """ One row of a bulk import of historical questionnaire results. """
+    user_email: str
+    gender: Gender
+    timestamp: Optional[datetime] = None
+
 # pydantic input classes
 class BmiInput(BaseModel):
     """ Input format for the bmi calculation. """
@@ -75,4 +133,42 @@ class RiskScoreInput(BaseModel):
 class RiskClassificationInput(BaseModel):
     """ Input format for the risk classification. """
     risk_score: int = Field( ..., ge=0, lt=44, description="Risk score total")
-    gender: Gender
\ No newline at end of file
+    gender: Gender
+
+class RiskScoreBatchInput(BaseModel):
+    """ Input format for the batch risk score calculation and classification. """
+    rows: List[RiskScoreInput] = Field( ..., min_length=1, max_length=10000, description="One entry per test-taker")
+
+class RiskScoreBatchResult(BaseModel):
+    """ Output format for a single row of the batch risk score calculation. """
+    risk_score: Optional[int] = None
+    classification: Optional[str] = None
+    error: Optional[str] = None
+
+class RiskScoreBatchResponse(BaseModel):
+    """ Output format for the batch risk score calculation, in the same order as the input rows. """
+    results: List[RiskScoreBatchResult]
+
+class AssessmentInput(BaseModel):
+    """ Input format for the one-shot assessment. Takes the raw measurements; BMI (boys) or
+    FMI (girls) is derived from them, so weight, or fat mass or body fat %, must be given. """
+    gender: Gender
+    height_cm:float = Field( ..., gt=70, lt=200, description="Height in centimeters")
+    weight_kg:Optional[float] = Field( None, gt=25, lt=300, description="Weight in kilograms")
+    fat_mass_kg: Optional[float] = Field( None, ge=0, lt=0.8*300, description="Fat mass in kilograms")
+    body_fat_percentage: Optional[float] = Field( None, ge=0, lt=80, description="Body fat percentage")
+    speed_km_per_h:float = Field( ..., ge= 8.5, lt=20, description="Speed in km/h")
+    age_yr:int = Field( ..., gt= 7, lt=20, description="Age in years")
+    tv_hours: Optional[float] = Field( None, ge=0, lt=20, description="TV viewing hours per day")
+    persist: bool = Field( False, description="Store the result for the authenticated user")
+    questionnaire_id: Optional[str] = Field( None, description="Required when persist is set")
+
+class AssessmentResult(BaseModel):
+    """ Output format for the one-shot assessment: every derived value, plus the stored result when persisted. """
+    bmi: Optional[float] = None
+    fmi: Optional[float] = None
+    vo2max: float
+    risk_score: int
+    classification: str
+    config_version: str
+    result: Optional[QuestionnaireResultResponse] = None
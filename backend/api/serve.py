@@ -0,0 +1,246 @@
+""" Multi-process server for the API.
+
+The master imports the app once, binds the listening socket and forks the workers, so every
+worker shares the imported modules and the compiled scoring config through copy-on-write and
+accepts connections from the same socket. Each worker runs uvicorn with the app's lifespan,
+so pool connections, bcrypt threads and the log writer are created per worker after the fork.
+
+Signals to the master:
+    SIGTERM, SIGINT  graceful shutdown: workers finish in-flight requests, then exit
+    SIGHUP           forwarded to the workers, which reload the scoring config
+    SIGUSR2          rolling restart: workers are replaced one at a time
+    SIGTTIN, SIGTTOU add or remove a worker
+Workers that exit unexpectedly are restarted.
+
+Usage:
+    python -m api.serve [--host 0.0.0.0] [--port 8000] [--workers 4]
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict, Optional, Tuple
+from .helpers.log import LOG_REDACT_FIELDS, JsonFormatter, log_event
+
+logger = logging.getLogger("api.serve")
+
+# total connections the server may hold, and how many of Postgres' max_connections to leave
+# for migrations, bulk imports and admin sessions
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "100"))
+DB_RESERVED_CONNECTIONS = int(os.getenv("DB_RESERVED_CONNECTIONS", "10"))
+# max_connections of each read replica, which every worker also holds a pool on
+DB_REPLICA_MAX_CONNECTIONS = int(os.getenv("DB_REPLICA_MAX_CONNECTIONS", str(DB_MAX_CONNECTIONS)))
+# connections of the sync engine in each worker; the workers never use it, so it is kept to one
+WORKER_SYNC_CONNECTIONS = 1
+GRACEFUL_TIMEOUT = float(os.getenv("GRACEFUL_TIMEOUT", "30"))
+
+def default_workers() -> int:
+    """ Returns WEB_CONCURRENCY, or the number of CPUs this process may run on. """
+    if os.getenv("WEB_CONCURRENCY"):
+        return max(1, int(os.environ["WEB_CONCURRENCY"]))
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+def worker_pool_settings(workers: int, max_connections: int, reserved: int, pool_size: int, max_overflow: int,
+                         sync_connections: int = 0, replica_max_connections: Optional[int] = None) -> Tuple[int, int]:
+    """ Splits the connection budget (max_connections - reserved) between the workers and caps
+    each worker's pool_size and max_overflow so that, with the sync_connections each worker's
+    sync engine may hold, workers * (pool_size + max_overflow + sync_connections) stays within
+    it. The replica engines use the same pool sizes, so when replicas are configured their
+    budget (replica_max_connections - reserved) caps the pools too. """
+    per_worker = (max_connections - reserved) // workers - sync_connections
+    if replica_max_connections is not None:
+        per_worker = min(per_worker, (replica_max_connections - reserved) // workers)
+    if per_worker < 1:
+        raise ValueError(f"{workers} workers need at least {workers * (1 + sync_connections) + reserved} connections, "
+                         f"but DB_MAX_CONNECTIONS is {max_connections} and DB_REPLICA_MAX_CONNECTIONS is {replica_max_connections}.")
+    capped_pool_size = max(1, min(pool_size, per_worker))
+    return capped_pool_size, max(0, min(max_overflow, per_worker - capped_pool_size))
+
+def configure_worker_pools(workers: int):
+    """ Writes the per-worker pool settings to the environment, where database.py reads them on import. """
+    has_replicas = any(url.strip() for url in os.getenv("DB_REPLICA_URLS", "").split(","))
+    pool_size, max_overflow = worker_pool_settings(
+        workers, DB_MAX_CONNECTIONS, DB_RESERVED_CONNECTIONS,
+        int(os.getenv("DB_POOL_SIZE", "5")), int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        sync_connections=WORKER_SYNC_CONNECTIONS, replica_max_connections=DB_REPLICA_MAX_CONNECTIONS if has_replicas else None,
+    )
+    os.environ["DB_POOL_SIZE"] = str(pool_size)
+    os.environ["DB_MAX_OVERFLOW"] = str(max_overflow)
+    os.environ["DB_SYNC_POOL_SIZE"] = str(WORKER_SYNC_CONNECTIONS)
+    os.environ["DB_SYNC_MAX_OVERFLOW"] = "0"
+    log_event(logger, logging.INFO, "worker_pools_configured", workers=workers, pool_size=pool_size, max_overflow=max_overflow)
+
+def bind_socket(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker(app, sock: socket.socket, host: str, port: int):
+    """ Runs in a forked child: detaches the inherited pools and serves until SIGTERM. """
+    import uvicorn
+    from .database import database
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR2, signal.SIGTTIN, signal.SIGTTOU):
+        signal.signal(signum, signal.SIG_DFL)
+    # a reload forwarded before the lifespan installs its handler must not kill the worker
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # connections opened by the master must not be shared; leave them to the master and start empty pools
+    database.engine.dispose(close=False)
+    database.async_engine.sync_engine.dispose(close=False)
+    for replica_engine in database.replica_engines.values():
+        replica_engine.sync_engine.dispose(close=False)
+
+    config = uvicorn.Config(app, host=host, port=port, lifespan="on", log_config=None, timeout_graceful_shutdown=int(GRACEFUL_TIMEOUT))
+    uvicorn.Server(config).run(sockets=[sock])
+
+class Master:
+    """ Forks and supervises the workers. """
+
+    def __init__(self, app, sock: socket.socket, host: str, port: int, workers: int):
+        self.app = app
+        self.sock = sock
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.children: Dict[int, float] = {}
+        # workers that were told to stop and must not be replaced when they exit
+        self.retiring = set()
+        self.restart_queue = []
+        self.stopping = False
+        self._signals = []
+
+    def spawn(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(self.app, self.sock, self.host, self.port)
+            except BaseException:
+                logger.exception("worker_crashed", extra={"fields": {"pid": os.getpid()}})
+                status = 1
+            finally:
+                os._exit(status)
+        self.children[pid] = time.monotonic()
+        log_event(logger, logging.INFO, "worker_started", pid=pid)
+        return pid
+
+    def retire(self, pid: int):
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _handle_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started_at = self.children.pop(pid, None)
+            if started_at is None:
+                continue
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                log_event(logger, logging.INFO, "worker_stopped", pid=pid)
+            elif not self.stopping:
+                log_event(logger, logging.WARNING, "worker_exited", pid=pid, status=os.waitstatus_to_exitcode(status), restarting=True)
+                # back off when workers die right after starting, e.g. on a bad config
+                if time.monotonic() - started_at < 1:
+                    time.sleep(1)
+
+    def _process_signals(self):
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT):
+                self.stopping = True
+            elif signum == signal.SIGHUP:
+                for pid in self.children:
+                    os.kill(pid, signal.SIGHUP)
+            elif signum == signal.SIGUSR2:
+                self.restart_queue = [pid for pid in self.children if pid not in self.retiring]
+            elif signum == signal.SIGTTIN:
+                self.workers += 1
+            elif signum == signal.SIGTTOU and self.workers > 1:
+                self.workers -= 1
+
+    def _rolling_restart_step(self):
+        """ Replaces one worker at a time: the replacement is started first, and the next worker
+        is only replaced once the previous one has exited. """
+        if self.retiring:
+            return
+        while self.restart_queue:
+            old = self.restart_queue.pop(0)
+            if old in self.children:
+                self.spawn()
+                self.retire(old)
+                return
+
+    def run(self) -> int:
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR2, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, self._handle_signal)
+        log_event(logger, logging.INFO, "listening", host=self.host, port=self.port, workers=self.workers, master_pid=os.getpid())
+
+        while True:
+            self._process_signals()
+            self._reap()
+            if self.stopping:
+                break
+            self._rolling_restart_step()
+            live = [pid for pid in self.children if pid not in self.retiring]
+            for _ in range(self.workers - len(live)):
+                self.spawn()
+            for pid in live[self.workers:]:
+                self.retire(pid)
+            time.sleep(0.2)
+
+        log_event(logger, logging.INFO, "shutting_down")
+        for pid in list(self.children):
+            self.retire(pid)
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+        while self.children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            log_event(logger, logging.WARNING, "worker_killed", pid=pid, reason="did not stop in time")
+            os.kill(pid, signal.SIGKILL)
+        return 0
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Serve the API with a preloaded app and forked workers.")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: WEB_CONCURRENCY or the number of CPUs)")
+    args = parser.parse_args(argv)
+
+    # the master writes synchronously; each worker's lifespan replaces this with the queued writer
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter(LOG_REDACT_FIELDS.split(",")))
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+    workers = args.workers or default_workers()
+    configure_worker_pools(workers)
+
+    # preload: import once in the master so the workers inherit the modules and the compiled config
+    started = time.perf_counter()
+    from .main import app
+    log_event(logger, logging.INFO, "app_loaded", elapsed_s=round(time.perf_counter() - started, 3))
+
+    sock = bind_socket(args.host, args.port)
+    return Master(app, sock, args.host, args.port, workers).run()
+
+if __name__ == "__main__":
+    sys.exit(main())
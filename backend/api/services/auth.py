@@ -1,7 +1,18 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
 from passlib.context import CryptContext
+from ..helpers.exceptions import PasswordHashingBusyError
+
+# bcrypt cost factor: each step doubles the time of a hash, and so halves the logins per core.
+# Pick it with python -m api.services.bcrypt_cost; hashes of another cost are redone on login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
 
 # use authentication
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 
 
@@ -10,8 +21,121 @@ def verify_password(plain_password, hashed_password) -> bool:
     version to compare them. Returns True for a match and False otherwise."""
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_and_update_password(plain_password, hashed_password) -> Tuple[bool, Optional[str]]:
+    """ Verifies a user's password like verify_password. Also returns a new hash at the current
+    cost when the password matches and the stored hash has a different cost, or None. """
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
 def get_password_hash(password):
     """ Hashes a user's password. Takes the password in plain text as input and returns 
     the hashed password."""
     return pwd_context.hash(password)
 
+# bounded worker pool for bcrypt, so password work never runs on the event loop
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", str(os.cpu_count() or 1)))
+AUTH_HASH_MAX_QUEUE = int(os.getenv("AUTH_HASH_MAX_QUEUE", "64"))
+AUTH_HASH_TIMEOUT = float(os.getenv("AUTH_HASH_TIMEOUT", "5"))
+
+def _consume_exception(future: asyncio.Future):
+    if not future.cancelled():
+        future.exception()
+
+class PasswordHashingPool:
+    """ Runs bcrypt on a fixed number of threads (bcrypt releases the GIL while hashing, so
+    the threads use separate cores). At most max_queue jobs may wait for a thread; further
+    jobs are rejected right away, and jobs that wait or run longer than timeout fail with
+    PasswordHashingBusyError so callers can answer with a 503 instead of piling up. """
+
+    def __init__(self, workers: int, max_queue: int, timeout: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._expired = 0
+        self._wait_total_s = 0.0
+        self._run_total_s = 0.0
+
+    def _call(self, func: Callable, deadline: float, submitted_at: float, *args):
+        started_at = time.monotonic()
+        with self._lock:
+            if started_at > deadline:
+                # the caller already gave up while this job was queued, skip the work
+                self._pending -= 1
+                self._expired += 1
+                return None
+            self._running += 1
+            self._wait_total_s += started_at - submitted_at
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._pending -= 1
+                self._completed += 1
+                self._run_total_s += time.monotonic() - started_at
+
+    async def run(self, func: Callable, *args):
+        """ Runs func(*args) on the pool and waits for the result without blocking the event loop. """
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                self._rejected += 1
+                raise PasswordHashingBusyError("Too many concurrent password operations. Please try again shortly.")
+            self._pending += 1
+        submitted_at = time.monotonic()
+        deadline = submitted_at + self.timeout
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._call, func, deadline, submitted_at, *args)
+        try:
+            # shield so a timeout does not cancel the queued job; it is skipped once past its deadline
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._timeouts += 1
+            # nobody awaits the job any more, so its exception is read here instead of being
+            # logged as never retrieved
+            future.add_done_callback(_consume_exception)
+            raise PasswordHashingBusyError("Password operation timed out. Please try again shortly.")
+
+    def shutdown(self):
+        """ Stops the worker threads once the running jobs finish, dropping queued ones. """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict:
+        """ Returns the current queue depth and the lifetime counters of the pool. """
+        with self._lock:
+            completed = self._completed or 1
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "timeout_s": self.timeout,
+                "in_flight": self._running,
+                "queue_depth": self._pending - self._running,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "timeouts": self._timeouts,
+                "expired": self._expired,
+                "wait_avg_ms": round(self._wait_total_s / completed * 1000, 3),
+                "run_avg_ms": round(self._run_total_s / completed * 1000, 3),
+            }
+
+hashing_pool = PasswordHashingPool(AUTH_HASH_WORKERS, AUTH_HASH_MAX_QUEUE, AUTH_HASH_TIMEOUT)
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    """ Verifies a user's password on the bounded hashing pool. Raises PasswordHashingBusyError
+    when the pool is saturated or the check times out."""
+    return await hashing_pool.run(verify_password, plain_password, hashed_password)
+
+async def verify_and_update_password_async(plain_password, hashed_password) -> Tuple[bool, Optional[str]]:
+    """ Runs verify_and_update_password on the bounded hashing pool. Raises PasswordHashingBusyError
+    when the pool is saturated or the check times out."""
+    return await hashing_pool.run(verify_and_update_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    """ Hashes a user's password on the bounded hashing pool. Raises PasswordHashingBusyError
+    when the pool is saturated or hashing times out."""
+    return await hashing_pool.run(get_password_hash, password)
@@ -0,0 +1,71 @@
+""" Calibration of the bcrypt cost factor to the current host.
+
+Times bcrypt at increasing costs on this machine and picks the highest cost whose median hash
+time stays within the target latency. Every login costs one hash, so the target also sets how
+many logins per second each core serves. Set BCRYPT_ROUNDS to the result on every API host;
+existing password hashes move to the new cost as their users log in.
+
+Run it on the production hardware, ideally while it is otherwise idle.
+
+Usage:
+    python -m api.services.bcrypt_cost [--target-ms 250] [--min-rounds 10] [--max-rounds 16] [--samples 5]
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from typing import Dict, List, Optional
+from passlib.hash import bcrypt
+from .auth import AUTH_HASH_WORKERS, BCRYPT_ROUNDS
+
+def measure(rounds: int, samples: int = 5) -> float:
+    """ Returns the median time, in milliseconds, of hashing a password at this cost. """
+    hasher = bcrypt.using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        hasher.hash("calibration password")
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+def calibrate(target_ms: float, min_rounds: int = 10, max_rounds: int = 16, samples: int = 5) -> Dict:
+    """ Times each cost from min_rounds up, stopping at the first one over target_ms, since each
+    further step doubles the time. Returns the timings and the highest cost within the target,
+    or min_rounds when even that one is too slow. """
+    # the first hash also loads the bcrypt backend, so it is not timed
+    bcrypt.using(rounds=4).hash("warm-up")
+    timings = {}
+    for rounds in range(min_rounds, max_rounds + 1):
+        timings[rounds] = measure(rounds, samples)
+        if timings[rounds] > target_ms:
+            break
+    within = [rounds for rounds, hash_ms in timings.items() if hash_ms <= target_ms]
+    chosen = max(within) if within else min_rounds
+    return {
+        "target_ms": target_ms,
+        "timings_ms": {rounds: round(hash_ms, 2) for rounds, hash_ms in timings.items()},
+        "rounds": chosen,
+        "hash_ms": round(timings[chosen], 2),
+        "logins_per_second_per_core": round(1000 / timings[chosen], 1),
+        "logins_per_second": round(1000 / timings[chosen] * AUTH_HASH_WORKERS, 1),
+    }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Pick the bcrypt cost that fits a login latency budget on this host.")
+    parser.add_argument("--target-ms", type=float, default=250, help="longest acceptable time of one hash")
+    parser.add_argument("--min-rounds", type=int, default=10, help="lowest cost to consider, whatever the hardware")
+    parser.add_argument("--max-rounds", type=int, default=16, help="highest cost to consider")
+    parser.add_argument("--samples", type=int, default=5, help="hashes timed per cost")
+    args = parser.parse_args(argv)
+    if not 4 <= args.min_rounds <= args.max_rounds <= 31:
+        parser.error("bcrypt costs must satisfy 4 <= --min-rounds <= --max-rounds <= 31")
+
+    result = calibrate(args.target_ms, args.min_rounds, args.max_rounds, max(1, args.samples))
+    # logins_per_second assumes AUTH_HASH_WORKERS hashing threads, each on its own core
+    print(json.dumps({**result, "hash_workers": AUTH_HASH_WORKERS, "current_rounds": BCRYPT_ROUNDS,
+                      "setting": f"BCRYPT_ROUNDS={result['rounds']}"}, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,15 @@
-from ..helpers.config import load_config
+import logging
+import os
+import signal
+import threading
+from typing import Dict, List, Optional, Sequence
+from ..helpers.config import ConfigFileWatcher, ScoringConfig, compile_config, load_config
 from ..models import Gender
 from ..helpers.exceptions import InsufficientDataError, InvalidInputError
+from ..helpers.log import log_event
+
+logger = logging.getLogger(__name__)
+
 
 # main functionality (risk assessment)
 def calculate_bmi(height_cm: float, weight_kg: float) -> float:
@@ -33,49 +42,64 @@ def calculate_vo2max(speed_km_per_h:float, age_yr:int) -> float:
     return round(vo2max, 2)
 
 # load config for cutoff points
-config = load_config('./api/config/config.json')
+SCORING_CONFIG_PATH = os.getenv("SCORING_CONFIG_PATH", os.path.join(os.path.dirname(os.path.dirname(__file__)), "config", "config.json"))
+SCORING_CONFIG_WATCH_SECONDS = float(os.getenv("SCORING_CONFIG_WATCH_SECONDS", "0"))
 
-def calculate_risk_score(gender: Gender, vo2max: float, bmi: float = None, fmi: float = None, tv_hours: float = None) -> int:
-    """ Function to calculate the overall risk score of the test-taker. """
-    
-    risk_score = 0
-
-    # classify and calculate risk score
-    if gender == Gender.male:
-        if bmi is None:
-            raise InsufficientDataError("For male children, BMI is required to calculate risk score.")
-        bmi_cutoffs = config['bmi_cutoffs']
-        for classification, cutoff in bmi_cutoffs.items():
-            if bmi < cutoff:
-                risk_score += calculate_bmi_risk_score(classification)
-                break
-        
-        if vo2max < 37:
-            risk_score += calculate_vo2max_risk_score("healthy",gender)
-        else:
-            risk_score += calculate_vo2max_risk_score("low fitness",gender)
+# classifications that carry risk points, every cutoff label in the config must be one of these
+BMI_CLASSIFICATIONS = ("healthy", "overweight", "obese")
+FMI_CLASSIFICATIONS = ("underfat", "normal", "overweight", "obese")
 
-        return risk_score
-    
-    elif gender == Gender.female:
-        if fmi is None:
-            raise InsufficientDataError("For female children, FMI is required to calculate risk score.")   
-        fmi_cutoffs = config['fmi_cutoffs']
-        for classification, cutoff in fmi_cutoffs.items():
-            if fmi < cutoff:
-                risk_score += calculate_fmi_risk_score(classification)
-                break
-        
-        if vo2max < 37:
-            risk_score += calculate_vo2max_risk_score("healthy", gender)
-        else:
-            risk_score += calculate_vo2max_risk_score("low fitness", gender)
-        
-        if tv_hours is None:
-            raise InsufficientDataError("For female children, hours of TV viewed per day is required to calculate risk score.")   
-        risk_score += calculate_tv_hours_risk_score(tv_hours)
+def load_scoring_config(path: str = SCORING_CONFIG_PATH) -> ScoringConfig:
+    """ Loads, validates and compiles the scoring config at path. """
+    return compile_config(
+        load_config(path),
+        known_labels={"bmi_cutoffs": BMI_CLASSIFICATIONS, "fmi_cutoffs": FMI_CLASSIFICATIONS},
+        genders=[gender.value for gender in Gender],
+        path=path,
+    )
 
-        return risk_score
+# the active config is swapped atomically on reload; readers take one reference per call and never lock
+_scoring_config: ScoringConfig = load_scoring_config()
+
+def get_scoring_config() -> ScoringConfig:
+    """ Returns the active compiled scoring config. """
+    return _scoring_config
+
+def reload_scoring_config(path: Optional[str] = None) -> ScoringConfig:
+    """ Recompiles the scoring config and swaps it in. If the new file is invalid the
+    previous config stays active and the error is raised. """
+    global _scoring_config
+    new_config = load_scoring_config(path or _scoring_config.path)
+    _scoring_config = new_config
+    log_event(logger, logging.INFO, "scoring_config_loaded", version=new_config.version, path=new_config.path)
+    return new_config
+
+def install_config_reload_signal():
+    """ Reloads the scoring config on SIGHUP. Only possible from the main thread. """
+    if not hasattr(signal, "SIGHUP") or threading.current_thread() is not threading.main_thread():
+        return
+
+    def handle_sighup(signum, frame):
+        try:
+            reload_scoring_config()
+        except Exception:
+            # the previous config stays active
+            logger.exception("scoring_config_reload_failed", extra={"fields": {"path": _scoring_config.path, "trigger": "SIGHUP"}})
+
+    signal.signal(signal.SIGHUP, handle_sighup)
+
+def start_config_watcher(interval: float = SCORING_CONFIG_WATCH_SECONDS) -> Optional[ConfigFileWatcher]:
+    """ Starts polling the config file for changes every interval seconds. Disabled when interval is 0. """
+    if interval <= 0:
+        return None
+    watcher = ConfigFileWatcher(_scoring_config.path, reload_scoring_config, interval)
+    watcher.start()
+    return watcher
+
+def calculate_risk_score(gender: Gender, vo2max: float, bmi: float = None, fmi: float = None, tv_hours: float = None, config: Optional[ScoringConfig] = None) -> int:
+    """ Function to calculate the overall risk score of the test-taker. Uses the active
+        scoring config unless a specific config snapshot is passed. """
+    return risk_rules(config or _scoring_config).score(gender, vo2max, bmi, fmi, tv_hours)
 
 def calculate_bmi_risk_score(classification: str) -> int:
     """ Helper function to return risk-score points based on BMI classification. """  
@@ -112,10 +136,88 @@ def calculate_tv_hours_risk_score(tv_hours: float) -> int:
     if tv_hours >=1:
         return 10
     
-def classify_risk_score(risk_score: int, gender: Gender) -> str:
+def classify_risk_score(risk_score: int, gender: Gender, config: Optional[ScoringConfig] = None) -> str:
     """ Function to classify the risk of early Diabetes 2 or IR based on the overall risk score of the test-taker. """
-    risk_cutoffs = config['risk_cutoffs']
-    for classification, cutoff in risk_cutoffs[gender].items():
-        if risk_score < cutoff:
-            return classification
-    raise InvalidInputError("The risk score you provided is not valid. Check the config file for the specified cut-offs.")
\ No newline at end of file
+    classification = (config or _scoring_config).risk_cutoffs[gender].classify(risk_score)
+    if classification is not None:
+        return classification
+    raise InvalidInputError("The risk score you provided is not valid. Check the config file for the specified cut-offs.")
+
+# risk score rules, shared by the single-row and the batch scoring
+VO2MAX_LOW_FITNESS = 37
+
+class RiskRules:
+    """ The risk score rules under one scoring config, with the points of every BMI and FMI
+    class resolved once. Both calculate_risk_score and calculate_risk_score_batch score
+    through score(), so the two cannot diverge. """
+
+    def __init__(self, config: ScoringConfig):
+        self.config = config
+        self.bmi_table, self.fmi_table = config.bmi_cutoffs, config.fmi_cutoffs
+        self.bmi_points = [calculate_bmi_risk_score(classification) for classification in self.bmi_table.labels]
+        self.fmi_points = [calculate_fmi_risk_score(classification) for classification in self.fmi_table.labels]
+        self.vo2max_points = {gender: (calculate_vo2max_risk_score("healthy", gender), calculate_vo2max_risk_score("low fitness", gender))
+                              for gender in Gender}
+
+    def score(self, gender: Gender, vo2max: float, bmi: Optional[float], fmi: Optional[float], tv_hours: Optional[float]) -> int:
+        """ Returns the risk score, or raises InsufficientDataError when the gender's data is missing. """
+        risk_score = 0
+        if gender == Gender.male:
+            if bmi is None:
+                raise InsufficientDataError("For male children, BMI is required to calculate risk score.")
+            index = self.bmi_table.index(bmi)
+            if index < len(self.bmi_table):
+                risk_score += self.bmi_points[index]
+        elif gender == Gender.female:
+            if fmi is None:
+                raise InsufficientDataError("For female children, FMI is required to calculate risk score.")
+            index = self.fmi_table.index(fmi)
+            if index < len(self.fmi_table):
+                risk_score += self.fmi_points[index]
+            if tv_hours is None:
+                raise InsufficientDataError("For female children, hours of TV viewed per day is required to calculate risk score.")
+            risk_score += calculate_tv_hours_risk_score(tv_hours)
+        risk_score += self.vo2max_points[gender][vo2max >= VO2MAX_LOW_FITNESS]
+        return risk_score
+
+# the rules of the active config, rebuilt when a reload swaps in a new one
+_risk_rules: Optional[RiskRules] = None
+
+def risk_rules(config: ScoringConfig) -> RiskRules:
+    """ Returns the rules for config, reusing those of the last config asked for. """
+    global _risk_rules
+    rules = _risk_rules
+    if rules is None or rules.config is not config:
+        rules = _risk_rules = RiskRules(config)
+    return rules
+
+# batch risk assessment
+def calculate_risk_score_batch(genders: Sequence[Gender], vo2max: Sequence[float], bmi: Sequence[Optional[float]],
+                               fmi: Sequence[Optional[float]], tv_hours: Sequence[Optional[float]]) -> List[Dict]:
+    """ Function to calculate and classify the risk score of many test-takers in one pass.
+        Takes parallel arrays (one entry per test-taker) and returns one dict per row with
+        the risk score, the classification, and an error message instead of raising, so a
+        single incomplete row does not abort the whole batch. """
+    if not len(genders) == len(vo2max) == len(bmi) == len(fmi) == len(tv_hours):
+        raise InvalidInputError("All input arrays of a batch must have the same length.")
+
+    # score every row against a single config version
+    config = _scoring_config
+    rules = risk_rules(config)
+
+    results = []
+    for row_gender, row_vo2max, row_bmi, row_fmi, row_tv_hours in zip(genders, vo2max, bmi, fmi, tv_hours):
+        gender = Gender(row_gender)
+        try:
+            risk_score = rules.score(gender, row_vo2max, row_bmi, row_fmi, row_tv_hours)
+        except InsufficientDataError as e:
+            results.append({"risk_score": None, "classification": None, "error": e.detail["error"]})
+            continue
+        try:
+            classification = classify_risk_score(risk_score, gender, config=config)
+        except InvalidInputError as e:
+            results.append({"risk_score": risk_score, "classification": None, "error": e.detail["error"]})
+            continue
+        results.append({"risk_score": risk_score, "classification": classification, "error": None})
+
+    return results
@@ -1,12 +1,20 @@
 import unittest
+from unittest import mock
 from fastapi.testclient import TestClient
-from ..main import app
-from ..services import calculate_bmi
+from .. import models
+from ..database.sketches import sketch_store
+from .. import main
+from ..main import app, user_cache
+from ..services.services import calculate_bmi
 
 class TestApp(unittest.TestCase):
 
     def setUp(self):
         self.client = TestClient(app)
+        patcher = mock.patch.object(main, "INTERNAL_TOKEN", "internal-secret")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.internal = {"X-Internal-Token": "internal-secret"}
 
     def test_calculate_bmi_endpoint(self):
         response = self.client.post("/calculate/bmi", json={"height_cm": 180, "weight_kg": 75})
@@ -139,6 +147,15 @@ class TestApp(unittest.TestCase):
         assert response.status_code == 200
         assert response.json() == {"risk_score": 22}
 
+        # obese male, previously not matched because of the "obesity" key in the config
+        response = self.client.post("/calculate/risk-score", json={
+            "gender": "male",
+            "vo2max": 30,
+            "bmi": 31
+        })
+        assert response.status_code == 200
+        assert response.json() == {"risk_score": 19}
+
         # successful case for female
         response = self.client.post("/calculate/risk-score", json={
             "gender": "female",
@@ -253,5 +270,172 @@ class TestApp(unittest.TestCase):
         assert response.status_code == 422
         assert "The risk score you provided is not valid. Check the config file for the specified cut-offs." in response.json()['detail']['error']
 
+    def test_calculate_risk_score_batch_endpoint(self):
+        rows = [
+            {"gender": "male", "vo2max": 45, "bmi": 25, "fmi": 10, "tv_hours": 2},
+            {"gender": "female", "vo2max": 30, "bmi": 17, "fmi": 10, "tv_hours": 2},
+            {"gender": "female", "vo2max": 40, "fmi": 10, "tv_hours": 2},
+            {"gender": "male", "vo2max": 40, "fmi": 10, "tv_hours": 2},
+            {"gender": "female", "vo2max": 40, "fmi": 10},
+        ]
+        response = self.client.post("/calculate/risk-score/batch", json={"rows": rows})
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert len(results) == len(rows)
+
+        # each complete row matches the single-row endpoints
+        for row, result in zip(rows[:3], results[:3]):
+            single = self.client.post("/calculate/risk-score", json=row).json()
+            classification = self.client.post("/classify/risk-score", json={
+                "risk_score": single["risk_score"],
+                "gender": row["gender"]
+            }).json()
+            assert result == {"risk_score": single["risk_score"], "classification": classification["classification"], "error": None}
+
+        # incomplete rows get a per-row error instead of failing the whole batch
+        assert results[3]["error"] == "For male children, BMI is required to calculate risk score."
+        assert results[3]["risk_score"] is None
+        assert results[4]["error"] == "For female children, hours of TV viewed per day is required to calculate risk score."
+
+        # an empty batch is rejected by validation
+        response = self.client.post("/calculate/risk-score/batch", json={"rows": []})
+        assert response.status_code == 422
+
+    def test_assess_endpoint(self):
+        # boy: BMI and VO2 max are derived, then scored and classified in one request
+        response = self.client.post("/assess", json={
+            "gender": "male", "height_cm": 180, "weight_kg": 75, "speed_km_per_h": 9, "age_yr": 12
+        })
+        assert response.status_code == 200
+        body = response.json()
+        vo2max = self.client.post("/calculate/vo2max", json={"speed_km_per_h": 9, "age_yr": 12}).json()["vo2max"]
+        risk_score = self.client.post("/calculate/risk-score", json={"gender": "male", "vo2max": vo2max, "bmi": 23.15}).json()["risk_score"]
+        classification = self.client.post("/classify/risk-score", json={"risk_score": risk_score, "gender": "male"}).json()["classification"]
+        assert body["bmi"] == 23.15 and body["vo2max"] == vo2max
+        assert body["risk_score"] == risk_score and body["classification"] == classification
+        assert body["result"] is None
+
+        # girl: FMI from body fat percentage
+        response = self.client.post("/assess", json={
+            "gender": "female", "height_cm": 160, "weight_kg": 50, "body_fat_percentage": 25,
+            "speed_km_per_h": 10, "age_yr": 14, "tv_hours": 2
+        })
+        assert response.status_code == 200
+        assert response.json()["fmi"] == 4.88
+
+        # the index the gender is not scored on is neither derived nor range-checked
+        response = self.client.post("/assess", json={
+            "gender": "female", "height_cm": 160, "weight_kg": 95, "body_fat_percentage": 30,
+            "speed_km_per_h": 10, "age_yr": 14, "tv_hours": 2
+        })
+        assert response.status_code == 200
+        assert response.json()["bmi"] is None and response.json()["fmi"] == 11.13
+        response = self.client.post("/assess", json={
+            "gender": "male", "height_cm": 180, "weight_kg": 75, "fat_mass_kg": 0.5, "speed_km_per_h": 9, "age_yr": 12
+        })
+        assert response.status_code == 200
+        assert response.json()["bmi"] == 23.15 and response.json()["fmi"] is None
+
+        # missing data for the gender's score
+        response = self.client.post("/assess", json={"gender": "female", "height_cm": 160, "speed_km_per_h": 10, "age_yr": 14, "tv_hours": 2})
+        assert response.status_code == 400
+
+        # persisting requires a token
+        response = self.client.post("/assess", json={
+            "gender": "male", "height_cm": 180, "weight_kg": 75, "speed_km_per_h": 9, "age_yr": 12,
+            "persist": True, "questionnaire_id": "q1"
+        })
+        assert response.status_code == 401
+
+    def test_percentiles_endpoint(self):
+        # an authenticated user, without a database round trip
+        user_cache.set("percentile-token", models.UserBase(email="clinician@example.com", full_name="Clinician", disabled=False))
+        headers = {"Authorization": "Bearer percentile-token"}
+        for bmi in range(14, 34):
+            sketch_store.record(models.QuestionnaireResultResponse(user_id="u", questionnaire_id="q", gender="female", vo2max=40, score=10,
+                                                                   classification="low", bmi=bmi))
+
+        response = self.client.get("/percentiles", params={"gender": "female", "bmi": 23.5, "vo2max": 40}, headers=headers)
+        assert response.status_code == 200
+        ranks = response.json()["ranks"]
+        assert 45 <= ranks["bmi"]["percentile"] <= 55 and ranks["bmi"]["count"] >= 20
+        assert set(ranks) == {"bmi", "vo2max"}
+
+        # nothing stored for boys yet, and at least one measurement is required
+        response = self.client.get("/percentiles", params={"gender": "male", "score": 12}, headers=headers)
+        assert response.json()["ranks"]["score"] == {"value": 12, "percentile": None, "count": 0}
+        assert self.client.get("/percentiles", params={"gender": "male"}, headers=headers).status_code == 422
+        assert self.client.get("/percentiles", params={"gender": "male", "bmi": 20}).status_code == 401
+
+    def test_calculation_etag(self):
+        params = {"height_cm": 172, "weight_kg": 64}
+        response = self.client.get("/calculate/bmi", params=params)
+        assert response.status_code == 200
+        assert response.json() == self.client.post("/calculate/bmi", json=params).json()
+        etag = response.headers["etag"]
+        assert "max-age" in response.headers["cache-control"]
+
+        # revalidating with the ETag skips the handler
+        response = self.client.get("/calculate/bmi", params=params, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+        # other inputs get another ETag, and errors are not tagged
+        response = self.client.get("/calculate/bmi", params={"height_cm": 172, "weight_kg": 65}, headers={"If-None-Match": etag})
+        assert response.status_code == 200 and response.headers["etag"] != etag
+        response = self.client.get("/calculate/bmi", params={"height_cm": 172})
+        assert response.status_code == 422 and "etag" not in response.headers
+        assert response.json()["detail"][0]["loc"] == ["query", "weight_kg"]
+        assert self.client.get("/calculate/bmi", params={"height_cm": 172, "weight_kg": 400}).status_code == 422
+
+        # POST responses are never cached by clients, so they are not tagged or revalidated
+        response = self.client.post("/calculate/bmi", json=params, headers={"If-None-Match": etag})
+        assert response.status_code == 200 and "etag" not in response.headers
+
+        assert self.client.get("/internal/http-cache-stats", headers=self.internal).json()["not_modified"] >= 1
+
+    def test_internal_endpoints_need_token(self):
+        assert self.client.get("/internal/pool-stats").status_code == 403
+        assert self.client.get("/internal/pool-stats", headers={"X-Internal-Token": "wrong"}).status_code == 403
+        assert self.client.get("/internal/pool-stats", headers=self.internal).status_code == 200
+        # without a token only loopback clients are answered, and the test client is not one
+        with mock.patch.object(main, "INTERNAL_TOKEN", None):
+            assert self.client.get("/internal/pool-stats", headers=self.internal).status_code == 403
+
+    def test_admission_stats_endpoint(self):
+        response = self.client.get("/internal/admission-stats", headers=self.internal)
+        assert response.status_code == 200
+        stats = response.json()
+        assert {"/token", "/users/create/", "/download_questionnaire"} <= set(stats)
+        assert stats["/download_questionnaire"]["key"] == "user"
+        assert {"in_flight", "rejected_concurrency", "rejected_rate", "max_concurrent"} <= set(stats["/token"])
+
+    def test_pool_stats_endpoint(self):
+        response = self.client.get("/internal/pool-stats", headers=self.internal)
+        assert response.status_code == 200
+        stats = response.json()
+        assert set(stats) >= {"sync", "async"}
+        for pool in ("sync", "async"):
+            assert {"checkouts", "wait_max_ms", "overflow_checkouts", "connection_age_max_s", "pool_size"} <= set(stats[pool])
+
+    def test_auth_pool_stats_endpoint(self):
+        response = self.client.get("/internal/auth-pool-stats", headers=self.internal)
+        assert response.status_code == 200
+        stats = response.json()
+        assert {"workers", "max_queue", "queue_depth", "in_flight", "rejected", "timeouts"} <= set(stats)
+        assert stats["queue_depth"] >= 0
+
+    def test_metrics_endpoint(self):
+        self.client.post("/calculate/bmi", json={"height_cm": 180, "weight_kg": 75})
+        assert self.client.get("/metrics").status_code == 403
+        response = self.client.get("/metrics", headers=self.internal)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'http_request_duration_seconds_count{method="POST",route="/calculate/bmi",status="200"}' in response.text
+        assert "db_pool_checked_out" in response.text
+        # a configured scraper needs no token
+        with mock.patch.object(main, "METRICS_SCRAPER_HOSTS", ["testclient"]):
+            assert self.client.get("/metrics").status_code == 200
+
 if __name__ == "__main__":
     unittest.main()
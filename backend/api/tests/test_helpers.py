@@ -0,0 +1,678 @@
+import asyncio
+import gc
+import io
+import json
+import logging
+import os
+import queue
+import random
+import tempfile
+import time
+import unittest
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from ..helpers.admission import AdmissionControlMiddleware, RouteLimit
+from ..helpers.bloom import BloomFilter
+from ..helpers.cache import TTLCache
+from ..helpers.config import CutoffTable, compile_config
+from ..helpers.exceptions import InsufficientDataError, InvalidConfigError, InvalidInputError
+from ..helpers.log import JsonFormatter, NonBlockingQueueHandler, Sampler, parse_sample_rates
+from ..helpers.metrics import Histogram, normalize_statement
+from ..helpers.pagination import decode_cursor, encode_cursor
+from ..helpers.sketch import TDigest
+from ..helpers.startup import StartupReport
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.schema import CreateTable
+from ..database import async_crud, schemas
+from ..database.bulk_import import CREATE_PARTITIONS_FOR_RANGE, ImportReport, import_rows, read_ndjson
+from ..database.database import UNKNOWN_POSITION, ReplicaRouter
+from ..database.partitions import next_month, partition_month
+from ..database.revocation import RevocationList
+from ..services import auth
+from ..services.bcrypt_cost import calibrate
+from ..database.rescore import RescoreReport, load_checkpoint, save_checkpoint, score_chunk
+from ..database.sketches import SketchStore
+from ..database.write_behind import SubmissionBatcher
+from ..helpers.exceptions import SubmissionConflictError, SubmissionQueueFullError
+from .. import models
+from ..serve import worker_pool_settings
+
+class RecordingSession:
+    """ Stands in for a sync Session, recording the statements executed on it. """
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(str(statement))
+        return []
+
+    def add_all(self, rows):
+        pass
+
+    def commit(self):
+        self.statements.append("COMMIT")
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_hit_miss_and_expiry(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        assert cache.get("token") is None
+        cache.set("token", "user")
+        assert cache.get("token") == "user"
+
+        # a shorter per-entry ttl wins over the cache default
+        cache.set("short", "user", ttl=0.01)
+        time.sleep(0.02)
+        assert cache.get("short") is None
+
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 2
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.stats()["evictions"] == 1
+
+    def test_invalidation(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("t1", "alice")
+        cache.set("t2", "bob")
+        cache.invalidate("t1")
+        assert cache.get("t1") is None
+        assert cache.get("t2") == "bob"
+        assert cache.stats()["invalidations"] == 1
+
+
+class TestRiskScoreBatch(unittest.TestCase):
+
+    def test_batch_matches_single_rows_at_band_edges(self):
+        from ..services import services as srv
+        config = srv.get_scoring_config()
+
+        def around(bounds):
+            return [value for bound in bounds for value in (bound - 0.01, bound, bound + 0.01)] + [None]
+
+        rows = []
+        for vo2max in (36.99, 37, 37.01):
+            rows += [("male", vo2max, bmi, None, None) for bmi in around(config.bmi_cutoffs.bounds)]
+            rows += [("female", vo2max, None, fmi, tv_hours) for fmi in around(config.fmi_cutoffs.bounds) for tv_hours in (0.99, 1, None)]
+        results = srv.calculate_risk_score_batch(*zip(*rows))
+
+        for row, result in zip(rows, results):
+            try:
+                risk_score = srv.calculate_risk_score(*row)
+            except InsufficientDataError as e:
+                assert result == {"risk_score": None, "classification": None, "error": e.detail["error"]}, row
+                continue
+            assert result["risk_score"] == risk_score, row
+            try:
+                assert result["classification"] == srv.classify_risk_score(risk_score, row[0]) and result["error"] is None, row
+            except InvalidInputError as e:
+                assert result["classification"] is None and result["error"] == e.detail["error"], row
+
+class TestScoringConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = {
+            "bmi_cutoffs": {"healthy": 24.99, "overweight": 29.99, "obese": 50.0},
+            "fmi_cutoffs": {"normal": 9, "obese": 21},
+            "risk_cutoffs": {"male": {"low": 10, "high": 30}, "female": {"low": 14, "high": 44}},
+        }
+        self.known_labels = {"bmi_cutoffs": ["healthy", "overweight", "obese"], "fmi_cutoffs": ["normal", "obese"]}
+
+    def test_cutoff_table_classify(self):
+        table = CutoffTable("bmi_cutoffs", self.raw["bmi_cutoffs"])
+        assert table.classify(20) == "healthy"
+        assert table.classify(24.99) == "overweight"
+        assert table.classify(31) == "obese"
+        assert table.classify(50) is None
+
+    def test_compile_and_version(self):
+        config = compile_config(self.raw, self.known_labels, ["male", "female"])
+        assert config.risk_cutoffs["male"].classify(12) == "high"
+        assert config.version == compile_config(dict(self.raw), self.known_labels, ["male", "female"]).version
+        with self.assertRaises(AttributeError):
+            config.version = "changed"
+
+    def test_rejects_invalid_config(self):
+        # labels without risk points, like the old "obesity" key
+        self.raw["bmi_cutoffs"] = {"healthy": 24.99, "obesity": 50.0}
+        with self.assertRaises(InvalidConfigError):
+            compile_config(self.raw, self.known_labels, ["male", "female"])
+
+        # cutoffs that are not increasing
+        self.raw["bmi_cutoffs"] = {"healthy": 24.99, "overweight": 20, "obese": 50.0}
+        with self.assertRaises(InvalidConfigError):
+            compile_config(self.raw, self.known_labels, ["male", "female"])
+
+        # missing gender
+        self.raw["bmi_cutoffs"] = {"healthy": 24.99}
+        del self.raw["risk_cutoffs"]["female"]
+        with self.assertRaises(InvalidConfigError):
+            compile_config(self.raw, self.known_labels, ["male", "female"])
+
+class TestPagination(unittest.TestCase):
+
+    def test_cursor_round_trip(self):
+        timestamp = datetime(2024, 2, 13, 11, 48, 32, 907939)
+        assert decode_cursor(encode_cursor(timestamp, 42)) == (timestamp, 42)
+        assert decode_cursor(None) is None
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidInputError):
+            decode_cursor("not-a-cursor")
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_is_cumulative(self):
+        histogram = Histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(("/calculate/bmi",), value)
+        lines = histogram.render()
+        assert 'latency_seconds_bucket{route="/calculate/bmi",le="0.1"} 1' in lines
+        assert 'latency_seconds_bucket{route="/calculate/bmi",le="1.0"} 2' in lines
+        assert 'latency_seconds_bucket{route="/calculate/bmi",le="+Inf"} 3' in lines
+        assert 'latency_seconds_count{route="/calculate/bmi"} 3' in lines
+
+    def test_normalize_statement(self):
+        statement = "SELECT users.id FROM users\n WHERE users.email = %(email_1)s LIMIT 1"
+        assert normalize_statement(statement) == "SELECT users.id FROM users WHERE users.email = ? LIMIT ?"
+        multi_row = "INSERT INTO t (a, b) VALUES (%(a_m0)s, %(b_m0)s), (%(a_m1)s, %(b_m1)s), (%(a_m2)s, %(b_m2)s)"
+        assert normalize_statement(multi_row) == "INSERT INTO t (a, b) VALUES (?, ?), ..."
+
+    def test_statement_labels_are_capped_not_the_memo(self):
+        from ..helpers import metrics
+        saved = (metrics._normalized_statements.copy(), metrics._statement_labels.copy())
+        self.addCleanup(lambda: (metrics._normalized_statements.clear(), metrics._normalized_statements.update(saved[0]),
+                                 metrics._statement_labels.clear(), metrics._statement_labels.update(saved[1])))
+        # multi-row INSERTs of every length share one label, so they do not use up the label budget
+        for rows in range(2, metrics.MAX_STATEMENT_LABELS + 50):
+            values = ", ".join(f"(%(a_m{i})s)" for i in range(rows))
+            assert normalize_statement(f"INSERT INTO batched (a) VALUES {values}") == "INSERT INTO batched (a) VALUES (?), ..."
+        assert normalize_statement("SELECT count(*) FROM shape_after_inserts") == "SELECT count(*) FROM shape_after_inserts"
+        assert len(metrics._normalized_statements) <= metrics.MAX_STATEMENT_MEMO
+        # past the label budget new shapes are reported as "other"
+        for shape in range(metrics.MAX_STATEMENT_LABELS):
+            normalize_statement(f"SELECT c FROM shape_{shape}")
+        assert normalize_statement("SELECT c FROM one_shape_too_many") == "other"
+        assert len(metrics._statement_labels) == metrics.MAX_STATEMENT_LABELS
+
+class TestLogging(unittest.TestCase):
+
+    def test_sampling_rates(self):
+        sampler = Sampler(parse_sample_rates("/calculate/*=0, /calculate/risk-score=1, /token=0.5"), default=1.0)
+        assert sampler.rate("/calculate/bmi") == 0
+        assert sampler.rate("/calculate/risk-score") == 1
+        assert sampler.rate("/token") == 0.5
+        assert sampler.rate("/other") == 1.0
+        assert not sampler.keep("/calculate/bmi")
+        with self.assertRaises(ValueError):
+            parse_sample_rates("/token=2")
+
+    def test_json_formatter_redacts_fields(self):
+        record = logging.LogRecord("api", logging.INFO, __file__, 1, "user_login", None, None)
+        record.fields = {"user_email": "a@b.c", "password": "secret", "route": "/token", "note": "x" * 1000, "score": 3}
+        entry = json.loads(JsonFormatter(["password", "user_email"]).format(record))
+        assert entry["event"] == "user_login"
+        assert entry["user_email"] == "[redacted]" and entry["password"] == "[redacted]"
+        assert entry["score"] == 3
+        assert len(entry["note"]) < 300
+
+    def test_queue_handler_drops_when_full(self):
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+        for _ in range(3):
+            handler.emit(logging.LogRecord("api", logging.INFO, __file__, 1, "event", None, None))
+        assert handler.dropped == 2
+
+class TestStartupReport(unittest.TestCase):
+
+    def test_phases(self):
+        report = StartupReport()
+        with report.phase("config"):
+            pass
+        with report.phase("db_pool", optional=True, connections=2):
+            raise ConnectionRefusedError("down")
+        with self.assertRaises(ValueError):
+            with report.phase("settings"):
+                raise ValueError("bad")
+        assert not report.as_dict()["ready"]
+        report.finish()
+
+        summary = report.as_dict()
+        assert summary["ready"] and summary["total_ms"] >= 0
+        assert summary["phases"]["config"]["ok"]
+        assert summary["phases"]["db_pool"] == {"duration_ms": summary["phases"]["db_pool"]["duration_ms"], "ok": False,
+                                                "error": "ConnectionRefusedError: down", "connections": 2}
+        assert not summary["phases"]["settings"]["ok"]
+
+class TestWorkerPoolSettings(unittest.TestCase):
+
+    def test_pools_fit_max_connections(self):
+        # plenty of room: the configured sizes are kept
+        assert worker_pool_settings(workers=2, max_connections=100, reserved=10, pool_size=5, max_overflow=10) == (5, 10)
+        # 8 workers share 90 connections: 11 each
+        pool_size, max_overflow = worker_pool_settings(workers=8, max_connections=100, reserved=10, pool_size=5, max_overflow=10)
+        assert (pool_size, max_overflow) == (5, 6)
+        assert 8 * (pool_size + max_overflow) <= 90
+        # tight budgets shrink the pool itself
+        assert worker_pool_settings(workers=16, max_connections=50, reserved=10, pool_size=5, max_overflow=10) == (2, 0)
+        with self.assertRaises(ValueError):
+            worker_pool_settings(workers=64, max_connections=50, reserved=10, pool_size=5, max_overflow=10)
+        # the sync engine of every worker counts against the budget: 8 * (5 + 5 + 1) <= 90
+        assert worker_pool_settings(workers=8, max_connections=100, reserved=10, pool_size=5, max_overflow=10, sync_connections=1) == (5, 5)
+        # replicas with fewer connections than the primary cap the pools
+        assert worker_pool_settings(workers=8, max_connections=100, reserved=10, pool_size=5, max_overflow=10,
+                                    sync_connections=1, replica_max_connections=50) == (5, 0)
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def test_token_bucket(self):
+        limit = RouteLimit("/token", rate=2, burst=2)
+        assert limit.take_token("a", now=0.0) == 0
+        assert limit.take_token("a", now=0.0) == 0
+        assert limit.take_token("a", now=0.0) == 0.5
+        # other keys have their own bucket, and tokens refill over time
+        assert limit.take_token("b", now=0.0) == 0
+        assert limit.take_token("a", now=0.5) == 0
+
+    def test_middleware_rejects_with_retry_after(self):
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+
+        app = FastAPI()
+
+        @app.post("/token")
+        def token():
+            return {"ok": True}
+
+        limits = {"/token": RouteLimit("/token", max_concurrent=1, rate=0.5, burst=1)}
+        app.add_middleware(AdmissionControlMiddleware, limits=limits)
+        client = TestClient(app)
+        assert client.post("/token").status_code == 200
+        response = client.post("/token")
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "2"
+
+        # a route at its concurrency limit sheds load with 503
+        limits["/token"].in_flight = 1
+        response = client.post("/token")
+        assert response.status_code == 503 and response.headers["retry-after"] == "1"
+        assert limits["/token"].stats()["rejected_rate"] == 1 and limits["/token"].stats()["rejected_concurrency"] == 1
+
+class TestSubmissionBatcher(unittest.TestCase):
+
+    def test_batches_and_per_row_errors(self):
+        batches = []
+
+        async def flush(submissions):
+            batches.append(len(submissions))
+            return [SubmissionConflictError("exists") if result.questionnaire_id == "dup" else result.questionnaire_id
+                    for _, result in submissions]
+
+        def result(questionnaire_id):
+            return models.QuestionnaireResultCreate(questionnaire_id=questionnaire_id, gender="male", vo2max=40, score=10, classification="low")
+
+        async def scenario():
+            batcher = SubmissionBatcher(flush=flush, max_batch=3, max_delay=0.05, max_queue=10)
+            with self.assertRaises(SubmissionQueueFullError):
+                batcher.submit("a@b.c", result("q0"))
+            batcher.start()
+            futures = [batcher.submit("a@b.c", result(f"q{i}")) for i in range(4)] + [batcher.submit("a@b.c", result("dup"))]
+            # size threshold: the first batch is flushed full, the rest after the delay
+            assert await futures[0] == "q0"
+            await asyncio.sleep(0.1)
+            assert batches == [3, 2]
+            with self.assertRaises(SubmissionConflictError):
+                await futures[4]
+            # shutdown writes what is still queued
+            pending = batcher.submit("a@b.c", result("q9"))
+            await batcher.stop()
+            assert pending.result() == "q9"
+            stats = batcher.stats()
+            assert stats["rows_written"] == 5 and stats["rows_rejected"] == 1 and not stats["running"]
+
+        asyncio.run(scenario())
+
+class TestReplicaRouter(unittest.TestCase):
+
+    def test_routing_pinning_and_lag_fallback(self):
+        # two SQLite files stand in for the primary and a replica that has not caught up yet
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        lag = {"replica1": 0.0}
+        replayed = {"replica1": 100}
+
+        async def probe(engine):
+            if lag["replica1"] is None:
+                raise ConnectionError("replica unreachable")
+            return lag["replica1"], replayed["replica1"]
+
+        async def scenario():
+            primary = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(directory.name, 'primary.db')}")
+            replica = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(directory.name, 'replica.db')}")
+            for engine in (primary, replica):
+                async with engine.begin() as connection:
+                    await connection.run_sync(schemas.User.__table__.create)
+            primary_sessions = async_sessionmaker(bind=primary, class_=AsyncSession, expire_on_commit=False)
+            async with primary_sessions() as db:
+                db.add(schemas.User(email="a@b.c", hashed_password="x"))
+                await db.commit()
+
+            async def found(router, read_after):
+                async with router.session(read_after) as db:
+                    return await async_crud.get_user(db, "a@b.c") is not None
+
+            router = ReplicaRouter(primary_sessions, {"replica1": replica}, max_lag=1, probe=probe)
+            # an unmeasured replica is not used
+            assert await found(router, None)
+            await router.check_lag()
+            assert not await found(router, None)
+            # read-your-writes: a read after a write the replica has not replayed goes to the primary
+            assert await found(router, 150)
+            assert await found(router, UNKNOWN_POSITION)
+            assert not await found(router, 100)
+            replayed["replica1"] = 200
+            await router.check_lag()
+            assert not await found(router, 150)
+            # lagging or unreachable replicas fall back to the primary
+            lag["replica1"] = 5.0
+            await router.check_lag()
+            assert await found(router, None)
+            lag["replica1"] = None
+            await router.check_lag()
+            assert await found(router, None)
+
+            stats = router.stats()
+            assert stats["replica_reads"] == 3 and stats["pinned_reads"] == 2 and stats["fallback_reads"] == 3
+            assert stats["lag_check_errors"] == 1 and stats["replicas"]["replica1"] == {"lag_s": None, "replayed": None, "fresh": False}
+
+            # without replicas everything goes to the primary and writes hand out no position
+            primary_only = ReplicaRouter(primary_sessions, {})
+            async with primary_sessions() as db:
+                assert await primary_only.write_position(db) is None
+                assert await router.write_position(db) == UNKNOWN_POSITION
+            assert await found(primary_only, 150)
+            await primary.dispose()
+            await replica.dispose()
+
+        asyncio.run(scenario())
+
+class TestPartitions(unittest.TestCase):
+
+    def test_partition_months(self):
+        assert partition_month("questionnaire_results_2024_09") == date(2024, 9, 1)
+        assert partition_month("questionnaire_results_default") is None
+        assert next_month(date(2024, 12, 1)) == date(2025, 1, 1)
+        assert next_month(date(2024, 9, 1)) == date(2024, 10, 1)
+
+    def test_partitioned_table(self):
+        ddl = str(CreateTable(schemas.QuestionnaireResult.__table__).compile(dialect=postgresql.dialect()))
+        assert "PARTITION BY RANGE (timestamp)" in ddl
+        # a unique constraint on a partitioned table must include the partition key, so none may remain
+        assert "UNIQUE" not in ddl and "PRIMARY KEY (id, timestamp)" in ddl
+        assert [column.name for column in schemas.QuestionnaireResultKey.__table__.primary_key] == ["questionnaire_id", "user_id"]
+
+class TestTDigest(unittest.TestCase):
+
+    def test_accuracy_merge_and_round_trip(self):
+        rng = random.Random(7)
+        values = [rng.gauss(20, 4) for _ in range(20000)]
+        whole, first, second = TDigest(), TDigest(), TDigest()
+        for value in values:
+            whole.add(value)
+        for value in values[:10000]:
+            first.add(value)
+        for value in values[10000:]:
+            second.add(value)
+        first.merge(second)
+
+        ordered = sorted(values)
+        for q in (0.01, 0.1, 0.5, 0.9, 0.99):
+            value = ordered[int(q * len(ordered))]
+            assert abs(whole.cdf(value) - q) < 0.005
+            assert abs(first.cdf(value) - q) < 0.005
+        assert abs(whole.quantile(0.5) - ordered[10000]) < 0.05
+        assert whole.cdf(ordered[0] - 1) == 0 and whole.cdf(ordered[-1]) == 1
+        # bounded memory, whatever the number of values
+        assert len(whole) < 200 and first.count == 20000
+
+        restored = TDigest.from_dict(json.loads(json.dumps(whole.to_dict())))
+        assert restored.count == whole.count and restored.cdf(21.5) == whole.cdf(21.5)
+        assert TDigest().cdf(1) is None and TDigest.from_dict(TDigest().to_dict()).count == 0
+
+class TestSketchStore(unittest.TestCase):
+
+    def test_record_and_load(self):
+        def result(gender, bmi, score):
+            return models.QuestionnaireResultResponse(user_id="u", questionnaire_id="q", gender=gender, vo2max=40, score=score,
+                                                      classification="low", bmi=bmi)
+
+        store = SketchStore()
+        for bmi in range(15, 25):
+            store.record(result("male", bmi, 10))
+        store.record(result("female", None, 5))
+        assert store.percentile_rank("bmi", "female", 20) == (None, 0)
+        assert store.percentile_rank("bmi", "male", 30) == (100.0, 10)
+        assert store.stats()["pending_values"] == 10 * 3 + 2
+
+        # loading replaces the view with the shared sketches plus what is still pending here
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        shared = TDigest()
+        for bmi in range(25, 35):
+            shared.add(bmi)
+
+        async def scenario():
+            engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(directory.name, 'sketches.db')}")
+            async with engine.begin() as connection:
+                await connection.run_sync(schemas.QuestionnaireResultSketch.__table__.create)
+            sessions = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+            async with sessions() as db:
+                db.add(schemas.QuestionnaireResultSketch(metric="bmi", gender="male", digest=shared.to_dict(), count=10))
+                await db.commit()
+                await store.load(db)
+            await engine.dispose()
+
+        asyncio.run(scenario())
+        percentile, count = store.percentile_rank("bmi", "male", 24.5)
+        assert count == 20 and 45 <= percentile <= 55
+
+    def test_rollup_rebuild_locks_the_table_first(self):
+        from ..database.crud import LOCK_ROLLUPS, rebuild_rollups
+        db = RecordingSession()
+        rebuild_rollups(db)
+        assert db.statements[0] == LOCK_ROLLUPS and db.statements[-1] == "COMMIT"
+
+    def test_sketch_rebuild_locks_the_table_first(self):
+        from ..database.sketches import LOCK_SKETCHES, rebuild
+        db = RecordingSession()
+        rebuild(db)
+        assert db.statements[0] == LOCK_SKETCHES and db.statements[-1] == "COMMIT"
+
+class TestBulkImport(unittest.TestCase):
+
+    def test_rejects_malformed_ndjson_lines(self):
+        source = io.StringIO('{"user_email": "a@b.c"\n\n[1, 2]\n{"user_email": "a@b.c"}\n')
+        # no row is valid, so nothing reaches the database
+        report = import_rows(None, read_ndjson(source))
+        assert report.rows_read == 3 and report.rows_inserted == 0
+        reasons = dict(report.rejected)
+        assert reasons[1].startswith("invalid: json") and reasons[3] == "invalid: json expected an object, got list"
+        assert reasons[4].startswith("invalid: ")
+        assert report.errors == 3
+
+    def test_already_stored_rows_are_not_errors(self):
+        report = ImportReport()
+        report.rejected.extend([(2, "already exists"), (3, "already exists")])
+        assert report.errors == 0 and report.summary()["errors"] == 0
+        report.rejected.append((4, "unknown user"))
+        assert report.errors == 1
+
+    def test_chunks_create_their_partitions(self):
+        executed = []
+
+        class Cursor:
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc):
+                return False
+            def execute(self, statement, params=None):
+                executed.append((statement, params))
+            def copy_expert(self, statement, buffer):
+                pass
+            def fetchall(self):
+                return []
+
+        class Connection:
+            def cursor(self):
+                return Cursor()
+            def commit(self):
+                pass
+
+        row = {"user_email": "a@b.c", "gender": "male", "vo2max": 40, "bmi": 20, "score": 0, "classification": "low risk"}
+        rows = [(1, {**row, "questionnaire_id": "q1", "timestamp": "2019-03-15T10:00:00"}),
+                (2, {**row, "questionnaire_id": "q2", "timestamp": "2018-11-02T08:00:00"}),
+                (3, {**row, "questionnaire_id": "q3", "timestamp": "2020-01-31T23:59:00"}),
+                (4, {**row, "questionnaire_id": "q4"})]
+        report = import_rows(Connection(), rows, chunk_size=3)
+        assert report.rows_inserted == 4
+        ranges = [params for statement, params in executed if statement == CREATE_PARTITIONS_FOR_RANGE]
+        # the chunk without timestamps only needs the current month, which is always kept ready
+        assert ranges == [(date(2018, 11, 1), date(2020, 1, 1))]
+
+class TestRevocation(unittest.TestCase):
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(f"revoked-{i}")
+        assert all(f"revoked-{i}" in bloom for i in range(1000))
+        false_positives = sum(f"valid-{i}" in bloom for i in range(10000))
+        assert false_positives < 300
+        assert len(bloom) == 1000
+
+    def test_revocation_list(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        now = datetime.utcnow()
+        revocations = RevocationList(capacity=100)
+
+        async def scenario():
+            engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(directory.name, 'revocations.db')}")
+            async with engine.begin() as connection:
+                await connection.run_sync(schemas.RevokedToken.__table__.create)
+            sessions = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+            async with sessions() as db:
+                db.add_all([schemas.RevokedToken(jti="loaded", expires_at=now + timedelta(minutes=5), revoked_at=now),
+                            schemas.RevokedToken(jti="expired", expires_at=now - timedelta(minutes=1), revoked_at=now)])
+                await db.commit()
+                await revocations.load(db)
+                assert revocations.active
+                assert await revocations.is_revoked(db, "loaded")
+                assert not await revocations.is_revoked(db, "expired")
+                assert not await revocations.is_revoked(db, "valid")
+
+                # a row stored by another worker is picked up by the next refresh
+                db.add(schemas.RevokedToken(jti="elsewhere", expires_at=now + timedelta(minutes=5), revoked_at=now + timedelta(seconds=1)))
+                await db.commit()
+                await revocations.refresh(db)
+                assert revocations.recent.keys() == {"elsewhere"}
+                assert await revocations.is_revoked(db, "elsewhere")
+
+                await revocations.prune(db)
+                assert revocations.pruned == 1
+                await revocations.load(db)
+                assert not revocations.recent and len(revocations.filter) == 2
+            await engine.dispose()
+
+        asyncio.run(scenario())
+        # only the filter hit on "loaded" needed a query
+        assert revocations.stats()["db_checks"] == 1
+
+class TestPasswordHashingPool(unittest.TestCase):
+
+    def test_timed_out_failure_is_retrieved(self):
+        pool = auth.PasswordHashingPool(workers=1, max_queue=1, timeout=0.05)
+        self.addCleanup(pool.shutdown)
+        unhandled = []
+
+        def fail():
+            time.sleep(0.1)
+            raise ValueError("hash failed")
+
+        async def scenario():
+            asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+            with self.assertRaises(auth.PasswordHashingBusyError):
+                await pool.run(fail)
+            await asyncio.sleep(0.15)
+
+        asyncio.run(scenario())
+        gc.collect()
+        assert unhandled == [] and pool.stats()["timeouts"] == 1
+
+class TestBcryptCost(unittest.TestCase):
+
+    def test_calibrate(self):
+        result = calibrate(target_ms=10000, min_rounds=4, max_rounds=5, samples=1)
+        assert result["rounds"] == 5 and set(result["timings_ms"]) == {4, 5}
+        # stops at the first cost over the target, and falls back to the lowest one
+        result = calibrate(target_ms=0, min_rounds=4, max_rounds=6, samples=1)
+        assert result["rounds"] == 4 and set(result["timings_ms"]) == {4}
+
+    def test_rehash_on_other_cost(self):
+        from passlib.hash import bcrypt
+        old_hash = bcrypt.using(rounds=4).hash("secret")
+        assert auth.verify_and_update_password("wrong", old_hash) == (False, None)
+        verified, new_hash = auth.verify_and_update_password("secret", old_hash)
+        assert verified and bcrypt.from_string(new_hash).rounds == auth.BCRYPT_ROUNDS
+        assert auth.verify_and_update_password("secret", new_hash) == (True, None)
+
+class TestRescore(unittest.TestCase):
+
+    def test_score_chunk_and_report(self):
+        from ..services import services as srv
+        timestamp = datetime(2024, 1, 1)
+        rows = [
+            (1, timestamp, "male", Decimal("40"), Decimal("31"), None, None, 0, "very low"),
+            (2, timestamp, "female", Decimal("30"), None, Decimal("10"), Decimal("2"), 0, "very low"),
+            (3, timestamp, "female", Decimal("30"), None, None, Decimal("2"), 0, "very low"),
+        ]
+        version, scored = score_chunk(rows)
+        assert version == srv.get_scoring_config().version
+        assert [row[0] for row in scored] == [1, 2, 3]
+        assert scored[0][2] == srv.calculate_risk_score("male", 40, bmi=31)
+        assert scored[2][2] is None and "FMI" in scored[2][4]
+
+        # the row already matching its new score is read but not changed
+        rows[1] = rows[1][:7] + (scored[1][2], scored[1][3])
+        report = RescoreReport()
+        report.add(rows, scored)
+        assert report.rows_read == 3 and report.rows_changed == 1 and report.score_changed == 1
+        assert report.classification_changed == {f"very low -> {scored[0][3]}": 1}
+        assert report.score_delta_min == report.score_delta_max == scored[0][2]
+        assert sum(report.unscorable.values()) == 1
+
+    def test_checkpoint(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "rescore.checkpoint.json")
+        assert load_checkpoint(path, "v1") == (0, None)
+
+        report = RescoreReport()
+        report.rows_read, report.rows_changed = 10, 4
+        save_checkpoint(path, "v1", 42, report)
+        last_id, totals = load_checkpoint(path, "v1")
+        assert last_id == 42 and RescoreReport(totals).totals() == report.totals()
+        # a checkpoint of another config version is not resumed
+        assert load_checkpoint(path, "v2") == (0, None)
+
+if __name__ == "__main__":
+    unittest.main()
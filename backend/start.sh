@@ -15,6 +15,6 @@ wait_for_postgres
 echo "Running Alembic Upgrade"
 alembic upgrade head
 
-# Start Uvicorn
-echo "Starting Uvicorn Server"
-exec uvicorn api.main:app --host 0.0.0.0 --port 8000
+# Start the server: one preloaded master forking a worker per CPU (WEB_CONCURRENCY overrides)
+echo "Starting API server"
+exec python -m api.serve --host 0.0.0.0 --port 8000